@@ -0,0 +1,217 @@
+import logging
+import os
+import re
+
+from bulk_loader import JSON_SUFFIXES, load_files, load_keyed
+from incremental import read_manifest, strip_quotes
+from ingest_filter import ingest_filter_for
+from sql_queries import (copy_staging_order, copy_table_queries, staging_manifest_copies, redshift_table_info,
+                         postgres_table_info, redshift_analyze_compression, redshift_disable_result_cache,
+                         redshift_maintenance_info, redshift_maintenance_commands, postgres_maintenance_info,
+                         postgres_maintenance_commands)
+
+logger = logging.getLogger(__name__)
+
+# Redshift physical design clauses: column distkey, diststyle, table distkey and sortkey
+PHYSICAL_DESIGN_PATTERNS = [
+    re.compile(r'\s+distkey\b(?!\s*\()', re.IGNORECASE),
+    re.compile(r'\bdiststyle\s+(all|even|key|auto)\b', re.IGNORECASE),
+    re.compile(r'\bdistkey\s*\([^)]*\)', re.IGNORECASE),
+    re.compile(r'\b(compound\s+|interleaved\s+)?sortkey\s*\([^)]*\)', re.IGNORECASE),
+]
+
+# Redshift column compression encoding, e.g. ENCODE zstd
+ENCODE_PATTERN = re.compile(r'\s+ENCODE\s+\w+', re.IGNORECASE)
+
+# table a COPY statement loads
+COPY_TARGET = re.compile(r'^(\s*copy\s+)\w+', re.IGNORECASE)
+
+# Redshift only DDL and the Postgres equivalent, applied in order
+POSTGRES_TRANSLATIONS = [
+    (re.compile(r'IDENTITY\(0,\s*1\)', re.IGNORECASE), 'GENERATED BY DEFAULT AS IDENTITY (START WITH 0 MINVALUE 0)'),
+] + [(pattern, '') for pattern in PHYSICAL_DESIGN_PATTERNS + [ENCODE_PATTERN]]
+
+# Postgres only accepts ON CONFLICT on columns backed by a unique index
+POSTGRES_CREATE_QUERIES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS songplays_natural_key ON songplays (start_time, user_id, session_id)",
+]
+
+
+class RedshiftBackend:
+    """
+    Runs the pipeline on a Redshift cluster, loading staging tables with COPY from S3.
+    """
+    name = 'redshift'
+    section = 'CLUSTER'
+    # Redshift rejects COPY FROM STDIN, local files are sent as multi-row INSERTs instead
+    supports_copy_from_stdin = False
+    # COPY reads the files from S3 directly, so ingest filters and key index flags only apply to split inputs
+    applies_ingest_filters = False
+    # id of the last statement of the session, recorded by metrics.py
+    query_id_query = "SELECT PG_LAST_QUERY_ID()"
+    # approximate table statistics read by table_stats.py
+    table_info_query = redshift_table_info
+    # table churn and VACUUM/ANALYZE statements, used by maintenance.py
+    maintenance_info_query = redshift_maintenance_info
+    maintenance_commands = redshift_maintenance_commands
+    # suggested column encodings and result cache switch, used by compression.py
+    analyze_compression_query = redshift_analyze_compression
+    disable_result_cache_query = redshift_disable_result_cache
+
+    def __init__(self, config):
+        self.config = config
+
+    def connection_string(self):
+        """
+        Builds the psycopg2 connection string from the backend's config section.
+        """
+        section = self.section
+        return "host={} dbname={} user={} password={} port={}".format(
+            self.config.get(section, 'HOST'), self.config.get(section, 'DB_NAME'),
+            self.config.get(section, 'DB_USER'), self.config.get(section, 'DB_PASSWORD'),
+            self.config.get(section, 'DB_PORT'))
+
+    def translate(self, query):
+        """
+        Rewrites a statement from sql_queries.py for this backend.
+        """
+        return query
+
+    def create_queries(self, queries):
+        """
+        Translates the CREATE TABLE statements and appends backend specific DDL.
+        """
+        return [self.translate(query) for query in queries]
+
+    def log_data(self):
+        """
+        Location of the log dataset.
+        """
+        return strip_quotes(self.config.get('S3', 'LOG_DATA'))
+
+    def song_data(self):
+        """
+        Location of the song dataset.
+        """
+        return strip_quotes(self.config.get('S3', 'SONG_DATA'))
+
+    def staging_sources(self):
+        """
+        Returns a dict of staging table -> source loaded by load_staging_table.
+        """
+        return dict(zip(copy_staging_order, copy_table_queries))
+
+    def manifest_location(self, location, key='MANIFEST_LOCATION'):
+        """
+        Checks that COPY can read a manifest written to location: Redshift only reads manifests from S3,
+        so a local path fails before anything is loaded rather than at COPY time.
+
+        Return:
+            The location
+        """
+        if not location.startswith('s3://'):
+            raise ValueError(f"COPY on {self.name} only reads manifests from S3, set {key} to an s3:// url "
+                             f"instead of {location}")
+        return location
+
+    def manifest_source(self, location, table='staging_events_table'):
+        """
+        Returns the source loading a staging table from a manifest.
+        """
+        return staging_manifest_copies[table].format(location)
+
+    def load_staging_table(self, cur, table, source):
+        """
+        Loads a staging table with the song match key of its rows, the source being the COPY statement.
+        """
+        copy_staging_table(cur, table, source)
+
+
+class PostgresBackend(RedshiftBackend):
+    """
+    Runs the pipeline on a local Postgres database, loading staging tables from local JSON files.
+    """
+    name = 'postgres'
+    section = 'LOCAL'
+    supports_copy_from_stdin = True
+    applies_ingest_filters = True
+    query_id_query = None
+    table_info_query = postgres_table_info
+    maintenance_info_query = postgres_maintenance_info
+    maintenance_commands = postgres_maintenance_commands
+    analyze_compression_query = None
+    disable_result_cache_query = None
+
+    def translate(self, query):
+        for pattern, replacement in POSTGRES_TRANSLATIONS:
+            query = pattern.sub(replacement, query)
+        return query
+
+    def create_queries(self, queries):
+        return super().create_queries(queries) + POSTGRES_CREATE_QUERIES
+
+    def log_data(self):
+        return self.config.get('LOCAL', 'LOG_DATA')
+
+    def song_data(self):
+        return self.config.get('LOCAL', 'SONG_DATA')
+
+    def staging_sources(self):
+        return {'staging_events_table': list_json_files(self.config.get('LOCAL', 'LOG_DATA')),
+                'staging_songs_table': list_json_files(self.config.get('LOCAL', 'SONG_DATA'))}
+
+    def manifest_location(self, location, key='MANIFEST_LOCATION'):
+        return location
+
+    def manifest_source(self, location, table='staging_events_table'):
+        return read_manifest(location)
+
+    def load_staging_table(self, cur, table, source):
+        """
+        Loads a staging table with the song match key of its rows, the source being a list of local JSON files
+        (optionally gzip, zstd or bzip2 compressed) streamed through COPY FROM STDIN.
+        """
+        ingest_filter = ingest_filter_for(self.config, table)
+        chunk_size = self.config.getint('ETL', 'COPY_CHUNK_ROWS', fallback=10000)
+        load_keyed(cur, table, lambda target: load_files(cur, table, source, chunk_size, ingest_filter=ingest_filter,
+                                                         target=target))
+        if ingest_filter:
+            ingest_filter.report()
+
+
+BACKENDS = {backend.name: backend for backend in (RedshiftBackend, PostgresBackend)}
+
+
+def copy_staging_table(cur, table, copy):
+    """
+    Runs the COPY statement of a staging table against its load table, see load_keyed.
+    """
+    load_keyed(cur, table, lambda target: cur.execute(COPY_TARGET.sub(rf"\g<1>{target}", copy, count=1)))
+
+
+def strip_physical_design(query):
+    """
+    Removes the distribution and sort clauses of a CREATE TABLE statement.
+    """
+    for pattern in PHYSICAL_DESIGN_PATTERNS:
+        query = pattern.sub('', query)
+    return query
+
+
+def get_backend(config):
+    """
+    Returns the backend selected by ETL.BACKEND in the config (redshift by default).
+    """
+    name = config.get('ETL', 'BACKEND', fallback='redshift')
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name}, expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name](config)
+
+
+def list_json_files(directory):
+    """
+    Lists the JSON files below a directory, compressed ones included, sorted by path.
+    """
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(directory)
+                  for name in names if name.endswith(JSON_SUFFIXES))
+
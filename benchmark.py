@@ -0,0 +1,150 @@
+import argparse
+import configparser
+import json
+import logging.config
+import os
+import platform
+import resource
+import time
+from datetime import datetime
+
+from backends import get_backend
+from calendar_dim import time_insert_query
+from connection import connect
+from create_tables import drop_tables, create_tables
+from generate_data import generate
+from sql_queries import drop_table_queries, create_table_queries, insert_table_queries_by_table
+
+# Setting up logger
+logging.config.fileConfig("logging.conf")
+logger = logging.getLogger(__name__)
+
+
+def peak_memory_mb():
+    """
+    Peak resident memory of this process in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if platform.system() == 'Darwin' else 1024), 1)
+
+
+def measure(stages, name, func):
+    """
+    Runs one benchmark stage and appends its latency, throughput and peak memory to stages.
+    Arguments:
+        stages: list of stage results
+        name: name of the stage
+        func: callable running the stage and returning the number of rows it produced
+
+    Return:
+        The stage result
+    """
+    start = time.perf_counter()
+    rows = func()
+    elapsed = time.perf_counter() - start
+    result = {'stage': name, 'seconds': round(elapsed, 4), 'rows': rows,
+              'rows_per_second': round(rows / elapsed, 1) if rows and elapsed else None,
+              'peak_memory_mb': peak_memory_mb()}
+    logger.info(f"{name}: {result['seconds']}s, {rows} rows")
+    stages.append(result)
+    return result
+
+
+def run(cur, conn, backend, config, create_queries=None):
+    """
+    Runs create -> stage -> insert and measures every statement group.
+    create_queries optionally replaces the backend's CREATE statements, e.g. with a physical design variant.
+
+    Return:
+        List of stage results
+    """
+    stages = []
+
+    def create():
+        drop_tables(cur, conn, [backend.translate(query) for query in drop_table_queries])
+        create_tables(cur, conn, create_queries or backend.create_queries(create_table_queries))
+        return 0
+    measure(stages, 'create', create)
+
+    for table, source in backend.staging_sources().items():
+        def stage(table=table, source=source):
+            backend.load_staging_table(cur, table, source)
+            conn.commit()
+            cur.execute(f"SELECT COUNT(*) FROM {table}")
+            return cur.fetchone()[0]
+        measure(stages, f"stage:{table}", stage)
+
+    for table, query in dict(insert_table_queries_by_table, time=time_insert_query(config)).items():
+        def insert(query=query):
+            cur.execute(backend.translate(query))
+            rows = cur.rowcount
+            conn.commit()
+            return rows
+        measure(stages, f"insert:{table}", insert)
+    return stages
+
+
+def compare(stages, previous_path):
+    """
+    Logs the latency change of every stage against a previous results file.
+    """
+    with open(previous_path) as f:
+        previous = {stage['stage']: stage for stage in json.load(f)['stages']}
+    for stage in stages:
+        before = previous.get(stage['stage'])
+        if before and before['seconds']:
+            change = (stage['seconds'] - before['seconds']) / before['seconds'] * 100
+            logger.info(f"{stage['stage']}: {before['seconds']}s -> {stage['seconds']}s ({change:+.1f}%)")
+
+
+def main():
+    """
+    Benchmarks the pipeline end to end on a local database, optionally generating the dataset first.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--data', default='data', help='directory holding song_data and log_data')
+    parser.add_argument('--generate-events', type=int, help='generate a dataset of this many events first')
+    parser.add_argument('--songs', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--artists', type=int, default=5000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--backend', default='postgres')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='previous results file to compare with')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    for section in ('ETL', 'LOCAL'):
+        if not config.has_section(section):
+            config.add_section(section)
+    config.set('ETL', 'BACKEND', args.backend)
+    config.set('LOCAL', 'LOG_DATA', os.path.join(args.data, 'log_data'))
+    config.set('LOCAL', 'SONG_DATA', os.path.join(args.data, 'song_data'))
+    backend = get_backend(config)
+
+    dataset = None
+    if args.generate_events:
+        dataset = generate(args.data, events=args.generate_events, songs=args.songs, artists=args.artists,
+                           users=args.users, days=args.days)
+
+    conn = connect(backend, config)
+    cur = conn.cursor()
+    start = time.perf_counter()
+    stages = run(cur, conn, backend, config)
+    conn.close()
+
+    results = {'run': {'started_at': datetime.utcnow().isoformat(timespec='seconds'), 'backend': backend.name,
+                       'data': args.data, 'dataset': dataset, 'total_seconds': round(time.perf_counter() - start, 4)},
+               'stages': stages}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+    logger.info(f"Wrote results to {args.output}")
+
+    if args.compare:
+        compare(stages, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import argparse
+import configparser
+import logging.config
+import random
+import string
+import time
+
+from backends import get_backend
+from bulk_loader import copy_rows, load_keyed
+from connection import connect
+
+# Setting up logger
+logging.config.fileConfig("logging.conf")
+logger = logging.getLogger(__name__)
+
+# songplays join before and after the song match key
+three_column_join = ("""SELECT COUNT(*) FROM staging_events_table st
+    JOIN staging_songs_table s
+    ON st.song = s.title AND st.artist = s.artist_name AND st.length = s.duration;
+""")
+
+song_key_join = ("""SELECT COUNT(*) FROM staging_events_table st
+    JOIN staging_songs_table s
+    ON st.song_key = s.song_key;
+""")
+
+
+def random_name(rng, length):
+    """
+    Returns a random title-like string.
+    """
+    return ' '.join(''.join(rng.choices(string.ascii_letters, k=rng.randint(3, 9)))
+                    for _ in range(max(1, length // 6)))
+
+
+def synthetic_songs(rng, count):
+    """
+    Yields (title, artist_name, duration) rows for the songs staging table.
+    """
+    for _ in range(count):
+        yield random_name(rng, 30), random_name(rng, 18), round(rng.uniform(60, 600), 5)
+
+
+def synthetic_events(rng, songs, count, match_rate):
+    """
+    Yields (song, artist, length) rows for the events staging table, match_rate of them playing a known song.
+    """
+    for _ in range(count):
+        if rng.random() < match_rate:
+            yield rng.choice(songs)
+        else:
+            yield random_name(rng, 30), random_name(rng, 18), round(rng.uniform(60, 600), 5)
+
+
+def time_query(cur, query, repeat):
+    """
+    Runs a query repeat times and returns (best elapsed time in seconds, result).
+    """
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cur.execute(query)
+        result = cur.fetchone()[0]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    """
+    Compares the three column songplays join with the song match key join on synthetic staging data.
+    Tables must exist (python create_tables.py); the staging tables are truncated.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--songs', type=int, default=100000)
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--match-rate', type=float, default=0.3)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    rng = random.Random(args.seed)
+
+    conn = connect(backend, config)
+    cur = conn.cursor()
+    cur.execute("TRUNCATE staging_events_table")
+    cur.execute("TRUNCATE staging_songs_table")
+
+    logger.info(f"Staging {args.songs} songs and {args.events} events")
+    songs = list(synthetic_songs(rng, args.songs))
+    start = time.perf_counter()
+    load_keyed(cur, 'staging_songs_table',
+               lambda target: copy_rows(cur, target, ['title', 'artist_name', 'duration'], songs,
+                                        use_copy=backend.supports_copy_from_stdin))
+    load_keyed(cur, 'staging_events_table',
+               lambda target: copy_rows(cur, target, ['song', 'artist', 'length'],
+                                        synthetic_events(rng, songs, args.events, args.match_rate),
+                                        use_copy=backend.supports_copy_from_stdin))
+    key_elapsed = time.perf_counter() - start
+    conn.commit()
+    cur.execute("ANALYZE staging_events_table")
+    cur.execute("ANALYZE staging_songs_table")
+    conn.commit()
+
+    before, before_rows = time_query(cur, three_column_join, args.repeat)
+    after, after_rows = time_query(cur, song_key_join, args.repeat)
+    logger.info(f"Staging with song keys took {key_elapsed:.2f}s")
+    logger.info(f"Three column join: {before:.3f}s, {before_rows} rows")
+    logger.info(f"Song key join: {after:.3f}s, {after_rows} rows")
+    logger.info(f"Speedup: {before / after if after else float('inf'):.2f}x")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
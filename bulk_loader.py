@@ -0,0 +1,213 @@
+import argparse
+import bz2
+import codecs
+import configparser
+import csv
+import gzip
+import io
+import json
+import logging.config
+import time
+
+from psycopg2.extras import execute_values
+
+from sql_queries import (song_key_sources, staging_columns, staging_keyed_insert, staging_load_create,
+                         staging_load_drop)
+
+logger = logging.getLogger(__name__)
+
+copy_from_stdin = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)"
+insert_values = "INSERT INTO {} ({}) VALUES %s"
+
+# file names of the JSON inputs, plain or gzip/zstd/bzip2 compressed
+JSON_SUFFIXES = ('.json', '.json.gz', '.json.zst', '.json.bz2')
+
+
+def open_json_file(path, fileobj=None):
+    """
+    Opens a JSON file for reading as text, decompressing .gz, .zst and .bz2 files on the fly.
+    fileobj optionally supplies the binary stream of the file, e.g. the body of an S3 object.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(fileobj or path, 'rt')
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(f"Reading {path} requires the zstandard package (pip install zstandard)")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(fileobj or open(path, 'rb')))
+    if path.endswith('.bz2'):
+        return bz2.open(fileobj or path, 'rt')
+    return codecs.getreader('utf-8')(fileobj) if fileobj else open(path)
+
+
+def read_json_records(path, ingest_filter=None):
+    """
+    Yields the records of a newline delimited JSON file one line at a time, never holding the whole file.
+    ingest_filter optionally drops records and fields the star schema does not need.
+    """
+    with open_json_file(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if ingest_filter is None:
+                yield json.loads(line)
+            else:
+                record = ingest_filter.apply(line)
+                if record is not None:
+                    yield record
+
+
+def flatten_record(record, columns):
+    """
+    Picks the staging columns out of a JSON record, mapping empty strings to NULL like COPY does.
+    """
+    values = []
+    for _, key in columns:
+        value = record.get(key)
+        values.append(None if value == '' else value)
+    return tuple(values)
+
+
+def iter_rows(paths, columns, ingest_filter=None):
+    """
+    Yields the flattened staging rows of every record of every file.
+    """
+    for path in paths:
+        for record in read_json_records(path, ingest_filter):
+            yield flatten_record(record, columns)
+
+
+def iter_chunks(rows, chunk_size):
+    """
+    Groups rows into lists of at most chunk_size rows.
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def to_csv(rows):
+    """
+    Renders rows as a CSV buffer readable by COPY, None values becoming unquoted NULLs.
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    buffer.seek(0)
+    return buffer
+
+
+def copy_rows(cur, table, column_names, rows, chunk_size=10000, use_copy=True):
+    """
+    Streams rows into a table in chunks of bounded size.
+    Arguments:
+        cur: cursor object
+        table: name of the target table
+        column_names: target columns, in row order
+        rows: iterable of row tuples
+        chunk_size: maximum number of rows sent per round trip
+        use_copy: COPY FROM STDIN when True, multi-row INSERT for databases without it (Redshift)
+
+    Return:
+        Number of rows loaded
+    """
+    columns = ', '.join(column_names)
+    total = 0
+    for number, chunk in enumerate(iter_chunks(rows, chunk_size), start=1):
+        start = time.perf_counter()
+        if use_copy:
+            cur.copy_expert(copy_from_stdin.format(table, columns), to_csv(chunk))
+        else:
+            execute_values(cur, insert_values.format(table, columns), chunk, page_size=len(chunk))
+        elapsed = time.perf_counter() - start
+        total += len(chunk)
+        logger.info(f"{table} chunk {number}: {len(chunk)} rows in {elapsed:.2f}s "
+                    f"({len(chunk) / elapsed if elapsed else 0:.0f} rows/s)")
+    return total
+
+
+def load_files(cur, table, paths, chunk_size=10000, use_copy=True, ingest_filter=None, target=None):
+    """
+    Streams local JSON log or song files into their staging table.
+    Arguments:
+        cur: cursor object
+        table: staging table, a key of staging_columns
+        paths: local JSON files
+        chunk_size: maximum number of rows sent per round trip
+        use_copy: COPY FROM STDIN when True, multi-row INSERT otherwise
+        ingest_filter: optional IngestFilter applied to every record
+        target: table the rows are written to instead of table, e.g. the load table of load_keyed
+
+    Return:
+        Number of rows loaded
+    """
+    columns = staging_columns[table]
+    target = target or table
+    start = time.perf_counter()
+    total = copy_rows(cur, target, [column for column, _ in columns], iter_rows(paths, columns, ingest_filter),
+                      chunk_size, use_copy)
+    elapsed = time.perf_counter() - start
+    logger.info(f"Loaded {total} rows from {len(paths)} files into {target} in {elapsed:.2f}s")
+    return total
+
+
+def load_keyed(cur, table, load):
+    """
+    Loads a staging table with the song match key of its rows: load fills an empty temporary table with the
+    staging columns, whose rows are then inserted into the staging table together with their key.
+    Arguments:
+        cur: cursor object
+        table: staging table, a key of staging_columns
+        load: callable loading the rows into the table named by its argument
+
+    Return:
+        Value returned by load
+    """
+    columns = ', '.join(column for column, _ in staging_columns[table])
+    target = f"{table}_load"
+    cur.execute(staging_load_create.format(load=target, table=table, columns=columns))
+    result = load(target)
+    cur.execute(staging_keyed_insert.format(table=table, columns=columns, song_key=song_key_sources[table],
+                                            load=target))
+    cur.execute(staging_load_drop.format(load=target))
+    return result
+
+
+def main():
+    """
+    Loads locally produced JSON files into a staging table of the configured backend.
+    """
+    from backends import get_backend
+    from connection import connect
+    from query_cache import bump_versions
+
+    logging.config.fileConfig("logging.conf")
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('table', choices=sorted(staging_columns))
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    chunk_size = config.getint('ETL', 'COPY_CHUNK_ROWS', fallback=10000)
+
+    conn = connect(backend, config)
+    try:
+        with conn.cursor() as cur:
+            load_keyed(cur, args.table, lambda target: load_files(cur, args.table, args.paths, chunk_size,
+                                                                  backend.supports_copy_from_stdin, target=target))
+            conn.commit()
+            bump_versions(cur, conn, [args.table])
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import logging
+from datetime import datetime, timedelta
+
+from bulk_loader import copy_rows
+from sql_queries import (calendar_columns, time_table_insert, time_table_insert_from_calendar, time_table_select,
+                         time_table_select_from_calendar)
+
+logger = logging.getLogger(__name__)
+
+
+def calendar_rows(start, end):
+    """
+    Yields one calendar row per hour between start and end (both included).
+    Arguments:
+        start: first day, datetime or 'YYYY-MM-DD'
+        end: last day, datetime or 'YYYY-MM-DD'
+
+    Return:
+        Generator of (calendar_hour, hour, day, week, month, year, weekday), weekday 0 being Sunday like EXTRACT(DOW)
+    """
+    if isinstance(start, str):
+        start = datetime.strptime(start, '%Y-%m-%d')
+    if isinstance(end, str):
+        end = datetime.strptime(end, '%Y-%m-%d')
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    last = end.replace(hour=23, minute=0, second=0, microsecond=0)
+    while hour <= last:
+        yield (hour, hour.hour, hour.day, hour.isocalendar()[1], hour.month, hour.year,
+               (hour.weekday() + 1) % 7)
+        hour += timedelta(hours=1)
+
+
+def build_calendar(cur, conn, start, end, use_copy=True):
+    """
+    Fills the calendar table with every hour between start and end.
+    Arguments:
+        cur: cursor object
+        conn: connection object to the database
+        start: first day, 'YYYY-MM-DD'
+        end: last day, 'YYYY-MM-DD'
+        use_copy: COPY FROM STDIN when the database supports it, multi-row INSERT otherwise
+
+    Return:
+        Number of calendar rows
+    """
+    cur.execute("TRUNCATE calendar")
+    total = copy_rows(cur, 'calendar', calendar_columns, calendar_rows(start, end), use_copy=use_copy)
+    conn.commit()
+    logger.info(f"Built calendar from {start} to {end}: {total} hours")
+    return total
+
+
+def time_insert_query(config):
+    """
+    Returns the time dimension insert, backed by the calendar when ETL.TIME_CALENDAR is enabled.
+    """
+    if config.getboolean('ETL', 'TIME_CALENDAR', fallback=False):
+        return time_table_insert_from_calendar
+    return time_table_insert
+
+
+def time_select_query(config):
+    """
+    Returns the SELECT of the time dimension rows, backed by the calendar when ETL.TIME_CALENDAR is enabled.
+    """
+    if config.getboolean('ETL', 'TIME_CALENDAR', fallback=False):
+        return time_table_select_from_calendar
+    return time_table_select
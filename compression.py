@@ -0,0 +1,231 @@
+import argparse
+import configparser
+import json
+import logging.config
+import os
+import re
+import time
+
+from backends import ENCODE_PATTERN, get_backend
+from connection import connect
+from sql_queries import column_scan, create_table_queries_by_table, copy_staging_order, insert_table_order
+from table_stats import catalog_stats
+
+logger = logging.getLogger(__name__)
+
+# column name, data type with optional length/precision, and optional IDENTITY at the start of a column definition
+COLUMN_DEFINITION = re.compile(r'^(\s*([a-z_]\w*)\s+(BIGINT|INTEGER|INT|SMALLINT|VARCHAR|CHAR|NUMERIC|DECIMAL|FLOAT4|'
+                               r'FLOAT8|FLOAT|REAL|TIMESTAMP|DATE|BOOLEAN)\b(?:\s*\([^)]*\))?'
+                               r'(\s+IDENTITY\s*\([^)]*\))?)', re.IGNORECASE | re.MULTILINE)
+CREATE_TABLE = re.compile(r'CREATE\s+TABLE\s+(\w+)', re.IGNORECASE)
+SORTKEY = re.compile(r'\bsortkey\s*\(\s*(\w+)', re.IGNORECASE)
+
+# encodings by data type: AZ64 for numbers and timestamps, ZSTD for text and floating point
+TYPE_ENCODINGS = {'BIGINT': 'az64', 'INTEGER': 'az64', 'INT': 'az64', 'SMALLINT': 'az64', 'NUMERIC': 'az64',
+                  'DECIMAL': 'az64', 'TIMESTAMP': 'az64', 'DATE': 'az64', 'BOOLEAN': 'raw'}
+# columns holding a handful of distinct values, stored as a per block dictionary
+LOW_CARDINALITY_COLUMNS = {'level', 'gender', 'auth', 'method', 'page', 'status'}
+
+
+def column_definitions(create_query):
+    """
+    Returns the (column, data type, identity) definitions of a CREATE TABLE statement, in order.
+    """
+    return [(match.group(2).lower(), match.group(3).upper(), bool(match.group(4)))
+            for match in COLUMN_DEFINITION.finditer(create_query)]
+
+
+def default_encodings(create_query):
+    """
+    Picks a compression encoding for every column of a CREATE TABLE statement from its data type.
+    The leading sort key column stays RAW so range restricted scans can skip blocks on it.
+    """
+    sortkey = SORTKEY.search(create_query)
+    encodings = {}
+    for column, data_type, _ in column_definitions(create_query):
+        if sortkey and column == sortkey.group(1).lower():
+            encodings[column] = 'raw'
+        elif column in LOW_CARDINALITY_COLUMNS and data_type in ('VARCHAR', 'CHAR'):
+            encodings[column] = 'bytedict'
+        else:
+            encodings[column] = TYPE_ENCODINGS.get(data_type, 'zstd')
+    return encodings
+
+
+def apply_encodings(create_query, encodings):
+    """
+    Rewrites a CREATE TABLE statement with an ENCODE setting on every column found in encodings.
+    """
+    query = ENCODE_PATTERN.sub('', create_query)
+
+    def encode(match):
+        encoding = encodings.get(match.group(2).lower())
+        return f"{match.group(1)} ENCODE {encoding}" if encoding else match.group(1)
+    return COLUMN_DEFINITION.sub(encode, query)
+
+
+def read_encodings(path):
+    """
+    Reads the encodings written by --analyze: dict of table -> dict of column -> encoding.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def table_encodings(config):
+    """
+    Returns the encodings selected by ETL.ENCODINGS: 'off' (default) for none, 'default' for the
+    data type based ones, 'analyzed' for the ones written to ETL.ENCODINGS_FILE by --analyze.
+
+    Return:
+        dict of table -> dict of column -> encoding
+    """
+    mode = config.get('ETL', 'ENCODINGS', fallback='off')
+    if mode == 'off':
+        return {}
+    encodings = {table: default_encodings(query) for table, query in create_table_queries_by_table.items()}
+    if mode == 'analyzed':
+        path = config.get('ETL', 'ENCODINGS_FILE', fallback='encodings.json')
+        if os.path.exists(path):
+            for table, columns in read_encodings(path).items():
+                encodings.setdefault(table, {}).update(columns)
+        else:
+            logger.warning(f"{path} not found, using the default encodings")
+    elif mode != 'default':
+        raise ValueError(f"Unknown encodings mode {mode}, expected 'off', 'default' or 'analyzed'")
+    return encodings
+
+
+def encoded_create_queries(config, queries):
+    """
+    Applies the encodings selected in the config to CREATE TABLE statements.
+    """
+    encodings = table_encodings(config)
+    if not encodings:
+        return list(queries)
+    tables = {query: CREATE_TABLE.search(query).group(1).lower() for query in queries}
+    return [apply_encodings(query, encodings.get(tables[query], {})) for query in queries]
+
+
+def analyze_compression(cur, backend, table, sample_rows):
+    """
+    Asks the database which encoding compresses each column of a table best, on a sample of its rows.
+
+    Return:
+        dict of column -> (encoding, estimated reduction %)
+    """
+    if backend.analyze_compression_query is None:
+        raise ValueError(f"The {backend.name} backend does not support ANALYZE COMPRESSION")
+    cur.execute(backend.analyze_compression_query.format(table, sample_rows))
+    return {column.strip(): (encoding.strip(), float(reduction))
+            for _, column, encoding, reduction in cur.fetchall()}
+
+
+def scan_seconds(cur, table, columns, repeat=3):
+    """
+    Best elapsed time of a scan reading every column of a table.
+    """
+    query = column_scan.format(columns=', '.join(f"MAX({column})" for column in columns), table=table)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cur.execute(query)
+        cur.fetchall()
+        best = min(best or float('inf'), time.perf_counter() - start)
+    return best
+
+
+def saving(before, after):
+    """
+    Relative saving of after over before, in percent.
+    """
+    return round((before - after) / before * 100, 1) if before and after is not None else None
+
+
+def measure_encodings(cur, conn, backend, table, encodings):
+    """
+    Copies a table into an encoded twin and compares their size and full scan time.
+
+    Return:
+        dict of size and scan time of both tables and the savings in percent
+    """
+    copy = f"{table}_encoded"
+    definitions = column_definitions(create_table_queries_by_table[table])
+    columns = ', '.join(column for column, _, identity in definitions if not identity)
+    create = CREATE_TABLE.sub(f"CREATE TABLE {copy}", create_table_queries_by_table[table], count=1)
+    cur.execute(f"DROP TABLE IF EXISTS {copy}")
+    cur.execute(backend.translate(apply_encodings(create, encodings)))
+    cur.execute(f"INSERT INTO {copy} ({columns}) SELECT {columns} FROM {table}")
+    conn.commit()
+    try:
+        sizes = catalog_stats(cur, backend, [table, copy])
+        scanned = [column for column, _, _ in definitions]
+        result = {'size_mb': sizes.get(table, {}).get('size_mb'),
+                  'encoded_size_mb': sizes.get(copy, {}).get('size_mb'),
+                  'scan_seconds': round(scan_seconds(cur, table, scanned), 4),
+                  'encoded_scan_seconds': round(scan_seconds(cur, copy, scanned), 4)}
+    finally:
+        conn.rollback()
+        cur.execute(f"DROP TABLE IF EXISTS {copy}")
+        conn.commit()
+    result['storage_saving_pct'] = saving(result['size_mb'], result['encoded_size_mb'])
+    result['scan_saving_pct'] = saving(result['scan_seconds'], result['encoded_scan_seconds'])
+    return result
+
+
+def main():
+    """
+    Derives column encodings with ANALYZE COMPRESSION and reports the storage and scan time saved per table.
+    """
+    logging.config.fileConfig("logging.conf")
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--analyze', action='store_true',
+                        help='derive encodings from ANALYZE COMPRESSION and write them to ETL.ENCODINGS_FILE')
+    parser.add_argument('--tables', nargs='+', default=copy_staging_order + insert_table_order)
+    parser.add_argument('--output', default='compression_report.json')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    sample_rows = config.getint('ETL', 'COMPRESSION_SAMPLE_ROWS', fallback=100000)
+
+    conn = connect(backend, config)
+    cur = conn.cursor()
+    if backend.disable_result_cache_query:
+        cur.execute(backend.disable_result_cache_query)
+
+    encodings = {table: default_encodings(create_table_queries_by_table[table]) for table in args.tables}
+    suggestions = {}
+    if args.analyze:
+        conn.commit()
+        conn.autocommit = True  # ANALYZE COMPRESSION is run outside of a transaction block
+        for table in args.tables:
+            suggestions[table] = analyze_compression(cur, backend, table, sample_rows)
+            encodings[table].update({column: encoding for column, (encoding, _) in suggestions[table].items()
+                                     if column in encodings[table]})
+        conn.autocommit = False
+        path = config.get('ETL', 'ENCODINGS_FILE', fallback='encodings.json')
+        with open(path, 'w') as f:
+            json.dump(encodings, f, indent=2, sort_keys=True)
+        logger.info(f"Wrote the analyzed encodings to {path}")
+
+    report = {}
+    for table in args.tables:
+        report[table] = measure_encodings(cur, conn, backend, table, encodings[table])
+        report[table]['encodings'] = encodings[table]
+        if table in suggestions:
+            report[table]['estimated_reduction_pct'] = {column: reduction
+                                                        for column, (_, reduction) in suggestions[table].items()}
+        logger.info(f"{table}: {report[table]['size_mb']} -> {report[table]['encoded_size_mb']} MB "
+                    f"({report[table]['storage_saving_pct']}%), scan {report[table]['scan_seconds']}s -> "
+                    f"{report[table]['encoded_scan_seconds']}s ({report[table]['scan_saving_pct']}%)")
+    conn.close()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    logger.info(f"Wrote the compression report to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,476 @@
+import logging
+import random
+import re
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import cursor
+from psycopg2.pool import PoolError
+
+import metrics
+from query_cache import normalize_sql
+
+logger = logging.getLogger(__name__)
+
+# SQLSTATEs worth retrying: serialization failures and deadlocks, lock timeouts, too many connections,
+# and the server shutting down or starting up; the whole 08 class (connection exceptions) is retried too
+TRANSIENT_PGCODES = {'40001', '40P01', '55P03', '53300', '57P01', '57P02', '57P03'}
+# errors without a useful SQLSTATE: lost connections, and Redshift's serializable isolation violation (XX000)
+TRANSIENT_MESSAGE = re.compile(r'server closed the connection|connection already closed|terminating connection|'
+                               r'could not (?:connect|receive|send)|ssl syscall|connection timed out|'
+                               r'timeout expired|serializable isolation violation|connection reset',
+                               re.IGNORECASE)
+# connection errors that will not go away by retrying
+FATAL_MESSAGE = re.compile(r'authentication failed|does not exist|no pg_hba\.conf entry|permission denied',
+                           re.IGNORECASE)
+# statements leaving the database in the same state however many times they run
+IDEMPOTENT = re.compile(r'^(?:select|show|set|reset|analyze|vacuum|truncate|delete|'
+                        r'create (?:unique )?(?:table|index|schema|view) if not exists|create or replace|'
+                        r'drop \w+ if exists)\b')
+WITH_READ = re.compile(r'^with\b(?!.*\b(?:insert|update|delete)\b)')
+# statements kept per transaction to replay it on a new connection, beyond which it is not replayed
+REPLAY_MAX_STATEMENTS = 1000
+
+
+def is_transient(error):
+    """
+    Tells whether an error may go away by running the transaction again on a healthy connection:
+    lost connections, server restarts, serialization failures and deadlocks. Statement timeouts,
+    syntax, data and constraint errors are fatal.
+    """
+    if isinstance(error, psycopg2.InterfaceError):
+        return True
+    if not isinstance(error, psycopg2.Error):
+        return False
+    code = error.pgcode
+    if code and code != 'XX000':
+        return code in TRANSIENT_PGCODES or code.startswith('08')
+    message = str(error)
+    if TRANSIENT_MESSAGE.search(message):
+        return True
+    return isinstance(error, psycopg2.OperationalError) and not code and not FATAL_MESSAGE.search(message)
+
+
+def is_idempotent(statement):
+    """
+    Tells whether running a statement twice leaves the same state as running it once.
+    """
+    if isinstance(statement, bytes):
+        statement = statement.decode('utf-8', 'replace')
+    text = normalize_sql(str(statement))
+    return bool(IDEMPOTENT.match(text) or WITH_READ.match(text))
+
+
+def retry_delay(attempt, backoff=1.0, max_backoff=60.0):
+    """
+    Seconds to wait before a retry: exponential backoff capped at max_backoff, with jitter so
+    concurrent stages do not reconnect at the same time.
+    """
+    return min(max_backoff, backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class ResilientCursor:
+    """
+    Cursor of a ResilientConnection. It stays valid across reconnections: the underlying psycopg2
+    cursor is recreated on the new connection, with the attributes set on it, e.g. itersize.
+    """
+
+    def __init__(self, connection, args, kwargs):
+        self._connection = connection
+        self._args = args
+        self._kwargs = kwargs
+        self._attributes = {}
+        self._cursor = None
+        self._generation = None
+
+    def _current(self):
+        if self._cursor is None or self._generation != self._connection.generation:
+            self._cursor = self._connection.raw().cursor(*self._args, **self._kwargs)
+            self._generation = self._connection.generation
+            for name, value in self._attributes.items():
+                setattr(self._cursor, name, value)
+        return self._cursor
+
+    def execute(self, query, vars=None):
+        return self._connection.run(self, 'execute', query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._connection.run(self, 'executemany', query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._connection.run(self, 'copy_expert', sql, file, size)
+
+    def close(self):
+        if self._cursor is not None and not self._cursor.closed:
+            self._cursor.close()
+
+    def __getattr__(self, name):
+        return getattr(self._current(), name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            self._attributes[name] = value
+            setattr(self._current(), name, value)
+
+    def __iter__(self):
+        return iter(self._current())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ResilientConnection:
+    """
+    psycopg2 connection surviving transient failures. The statements of the open transaction are kept,
+    and when one fails with a transient error (see is_transient) the connection is reopened with backoff
+    and the transaction replayed, so a network blip or a leader node restart costs a retry instead of the
+    run. A transaction that failed before its commit was rolled back by the server, so it is always safe
+    to replay; a failed commit or autocommit statement may have been applied, so it is only replayed when
+    every statement is idempotent. Transactions streaming files (COPY FROM STDIN) or reading server side
+    cursors are not replayed.
+    Each statement also runs under the statement_timeout of the metrics stage running it, set only when
+    it changes, and every new session first runs the session statements, e.g. a SET search_path.
+    """
+
+    def __init__(self, connect, retries=5, backoff=1.0, max_backoff=60.0, statement_timeouts=None,
+                 sleep=time.sleep, session_statements=None):
+        """
+        Arguments:
+            connect: callable opening a psycopg2 connection
+            retries: retries of a failed transaction or connection attempt
+            backoff: seconds waited before the first retry, doubled at every retry
+            max_backoff: longest wait between two retries
+            statement_timeouts: dict of stage name or prefix (e.g. 'insert') -> seconds, 'default' for the
+                other stages, 0 for no timeout
+            session_statements: statements run and committed on every new connection, before any other
+        """
+        self.connect = connect
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statement_timeouts = statement_timeouts or {}
+        self.session_statements = session_statements or []
+        self.sleep = sleep
+        self.connection = None
+        self.generation = 0
+        self.closed = 0
+        self.autocommit_mode = False
+        self.statement_timeout = self.committed_timeout = 0
+        self.transaction = []
+        self.reconnect()
+
+    def reconnect(self):
+        """
+        Opens a new connection, retrying transient connection errors with backoff.
+        """
+        if self.connection is not None and not self.connection.closed:
+            try:
+                self.connection.close()
+            except psycopg2.Error:
+                pass
+        for attempt in range(self.retries + 1):
+            try:
+                self.connection = self.connect()
+                break
+            except psycopg2.Error as e:
+                if attempt == self.retries or not is_transient(e):
+                    raise
+                delay = retry_delay(attempt, self.backoff, self.max_backoff)
+                logger.warning(f"Could not connect ({str(e).strip()}), retrying in {delay:.1f}s")
+                self.sleep(delay)
+        self.connection.autocommit = self.autocommit_mode
+        if self.session_statements:
+            with self.connection.cursor(cursor_factory=cursor) as cur:
+                for statement in self.session_statements:
+                    cur.execute(statement)
+            if not self.autocommit_mode:
+                self.connection.commit()
+        self.generation += 1
+        # a new session starts with the server default, taken as no timeout
+        self.statement_timeout = self.committed_timeout = 0
+
+    def raw(self):
+        """
+        Underlying psycopg2 connection.
+        """
+        if self.closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        return self.connection
+
+    def cursor(self, *args, **kwargs):
+        return ResilientCursor(self, args, kwargs)
+
+    @property
+    def autocommit(self):
+        return self.autocommit_mode
+
+    @autocommit.setter
+    def autocommit(self, value):
+        self.raw().autocommit = value
+        self.autocommit_mode = value
+
+    def stage_timeout(self, stage_name):
+        """
+        Statement timeout in seconds of a stage, e.g. 'insert:songs' falls back to 'insert' then 'default'.
+        """
+        for name in (stage_name, stage_name.split(':')[0], 'default'):
+            if name in self.statement_timeouts:
+                return self.statement_timeouts[name]
+        return 0
+
+    def apply_timeout(self):
+        """
+        Sets the statement_timeout of the current stage on the connection when it changed.
+        """
+        timeout = self.stage_timeout(metrics.recorder.current_stage())
+        if timeout != self.statement_timeout:
+            with self.connection.cursor(cursor_factory=cursor) as cur:
+                cur.execute(f"SET statement_timeout TO {int(timeout * 1000)}")
+            self.statement_timeout = timeout
+            if self.autocommit_mode:
+                self.committed_timeout = timeout
+
+    def remember(self, method, args):
+        """
+        Keeps a statement of the open transaction for replay.
+        """
+        if self.autocommit_mode or self.transaction is None:
+            return
+        replayable = method != 'copy_expert' and not (method == 'executemany' and not isinstance(args[1], (list, tuple)))
+        if replayable and len(self.transaction) < REPLAY_MAX_STATEMENTS:
+            self.transaction.append((method, args))
+        else:
+            self.transaction = None
+
+    def replayable(self, method, statement):
+        """
+        Tells whether a failed statement can run again on a new connection: any statement of a replayable
+        transaction, since the server rolled it back, but only idempotent ones in autocommit mode.
+        """
+        if method == 'copy_expert':
+            return False
+        if self.autocommit_mode:
+            return is_idempotent(statement)
+        return self.transaction is not None
+
+    def run(self, resilient_cursor, method, *args):
+        """
+        Runs a cursor method, reopening the connection and replaying the transaction on transient errors.
+        """
+        statement = args[0]
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                if error is not None:
+                    self.recover(error, attempt, statement)
+                self.apply_timeout()
+                cur = resilient_cursor._current()
+                result = getattr(cur, method)(*args)
+                if cur.name is not None:
+                    self.transaction = None  # rows are fetched from the server after execute
+                self.remember(method, args)
+                return result
+            except psycopg2.Error as e:
+                if attempt == self.retries or not self.replayable(method, statement) or not is_transient(e):
+                    raise
+                error = e
+
+    def recover(self, error, attempt, statement):
+        """
+        Waits, reopens the connection (or rolls the aborted transaction back) and replays the statements
+        of the open transaction.
+        """
+        delay = retry_delay(attempt - 1, self.backoff, self.max_backoff)
+        replayed = len(self.transaction or [])
+        metrics.recorder.emit({'type': 'connection_retry', 'stage': metrics.recorder.current_stage(),
+                               'statement': metrics.statement_summary(statement), 'attempt': attempt,
+                               'error': str(error).strip(), 'delay_seconds': round(delay, 3), 'replayed': replayed})
+        logger.warning(f"Transient error ({str(error).strip()}), retrying in {delay:.1f}s "
+                       f"and replaying {replayed} statements")
+        self.sleep(delay)
+        if self.connection.closed:
+            self.reconnect()
+        else:
+            self.connection.rollback()
+            self.statement_timeout = self.committed_timeout
+        if self.transaction:
+            self.apply_timeout()
+            with self.connection.cursor() as cur:
+                for method, args in self.transaction:
+                    getattr(cur, method)(*args)
+
+    def commit(self):
+        """
+        Commits the open transaction. A commit lost with the connection may or may not have been applied,
+        so the transaction is only replayed and committed again when it is idempotent.
+        """
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                if error is not None:
+                    self.recover(error, attempt, 'COMMIT')
+                self.raw().commit()
+                self.transaction = []
+                self.committed_timeout = self.statement_timeout
+                return
+            except psycopg2.Error as e:
+                transaction = self.transaction
+                if (attempt == self.retries or not is_transient(e) or transaction is None
+                        or not all(is_idempotent(args[0]) for _, args in transaction)):
+                    self.transaction = []
+                    raise
+                error = e
+
+    def rollback(self):
+        """
+        Rolls the open transaction back; on a lost connection the next statement reconnects.
+        """
+        self.transaction = []
+        self.statement_timeout = self.committed_timeout
+        try:
+            self.raw().rollback()
+        except psycopg2.Error as e:
+            if not is_transient(e):
+                raise
+            self.reconnect()
+
+    def close(self):
+        if not self.closed:
+            self.closed = 1
+            if not self.connection.closed:
+                self.connection.close()
+
+    def __getattr__(self, name):
+        return getattr(self.raw(), name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+
+class ConnectionPool:
+    """
+    Bounded, thread safe pool of ResilientConnections, opened on first use and reused by every stage.
+    getconn waits up to timeout seconds for a connection to be returned instead of failing when
+    max_connections are in use.
+    """
+
+    def __init__(self, connect, max_connections, timeout=None):
+        self.connect = connect
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def getconn(self):
+        if self.closed:
+            raise PoolError('connection pool is closed')
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolError(f"no connection returned to the pool within {self.timeout}s")
+        try:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            return conn if conn is not None and not conn.closed else self.connect()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        try:
+            if close or self.closed:
+                conn.close()
+            elif not conn.closed:
+                conn.rollback()
+                with self.lock:
+                    self.idle.append(conn)
+        finally:
+            self.slots.release()
+
+    def closeall(self):
+        self.closed = True
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+def connection_options(config, cursor_factory=None):
+    """
+    psycopg2.connect keyword arguments of the CONNECTION section: connect timeout and TCP keepalives,
+    which detect a dead connection within KEEPALIVES_IDLE + KEEPALIVES_INTERVAL * KEEPALIVES_COUNT seconds
+    instead of waiting on it for hours.
+    """
+    section = 'CONNECTION'
+    options = {'connect_timeout': config.getint(section, 'CONNECT_TIMEOUT', fallback=10),
+               'keepalives': 1,
+               'keepalives_idle': config.getint(section, 'KEEPALIVES_IDLE', fallback=60),
+               'keepalives_interval': config.getint(section, 'KEEPALIVES_INTERVAL', fallback=10),
+               'keepalives_count': config.getint(section, 'KEEPALIVES_COUNT', fallback=5),
+               'application_name': config.get(section, 'APPLICATION_NAME', fallback='sparkify_etl')}
+    if cursor_factory is not None:
+        options['cursor_factory'] = cursor_factory
+    return options
+
+
+def statement_timeouts(config):
+    """
+    Statement timeouts in seconds per stage: CONNECTION.STATEMENT_TIMEOUT for every stage, overridden per
+    stage or stage prefix in the STATEMENT_TIMEOUTS section, e.g. insert = 3600.
+    """
+    timeouts = {'default': config.getfloat('CONNECTION', 'STATEMENT_TIMEOUT', fallback=0)}
+    if config.has_section('STATEMENT_TIMEOUTS'):
+        timeouts.update({name: float(value) for name, value in config.items('STATEMENT_TIMEOUTS')
+                         if name not in config.defaults()})
+    return timeouts
+
+
+def connect(backend, config, cursor_factory=None, session_statements=None):
+    """
+    Opens a ResilientConnection to the backend database, set up by the CONNECTION section of dwh.cfg.
+    Arguments:
+        backend: backend providing the connection string
+        config: parsed dwh.cfg
+        cursor_factory: optional cursor class, e.g. MetricsCursor
+        session_statements: optional statements run on every new connection, see ResilientConnection
+
+    Return:
+        ResilientConnection
+    """
+    section = 'CONNECTION'
+    dsn = backend.connection_string()
+    options = connection_options(config, cursor_factory)
+    return ResilientConnection(lambda: psycopg2.connect(dsn, **options),
+                               retries=config.getint(section, 'RETRIES', fallback=5),
+                               backoff=config.getfloat(section, 'RETRY_BACKOFF_SECONDS', fallback=1),
+                               max_backoff=config.getfloat(section, 'RETRY_MAX_BACKOFF_SECONDS', fallback=60),
+                               statement_timeouts=statement_timeouts(config),
+                               session_statements=session_statements)
+
+
+def open_pool(backend, config, max_connections, cursor_factory=None):
+    """
+    Creates the bounded pool of resilient connections shared by the concurrent stages of a run.
+    Arguments:
+        backend: backend providing the connection string
+        config: parsed dwh.cfg
+        max_connections: maximum number of open connections
+        cursor_factory: optional cursor class, e.g. MetricsCursor
+
+    Return:
+        ConnectionPool
+    """
+    timeout = config.getfloat('CONNECTION', 'POOL_TIMEOUT_SECONDS', fallback=0) or None
+    return ConnectionPool(lambda: connect(backend, config, cursor_factory), max_connections, timeout)
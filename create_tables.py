@@ -1,75 +1,131 @@
+import argparse
 import logging.config
 import configparser
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from backends import get_backend
+from calendar_dim import build_calendar
+from connection import connect
+from compression import encoded_create_queries
+import metrics
+from metrics import MetricsCursor, stage
+from profiler import typed_create_queries
+from query_cache import CATALOG, bump_versions
+from run_ledger import invalidate_tables
+from sql_queries import create_table_queries, create_table_queries_by_table, drop_table_queries, existing_tables
 
 # Setting up logger
 logging.config.fileConfig("logging.conf")
 logger = logging.getLogger(__name__)
 
 
-def drop_tables(cur, conn):
+def drop_tables(cur, conn, queries=drop_table_queries):
     """
     DROP TABLES
     Arguments:
         cur: cursor object
         conn: connection object to redshift
+        queries: DROP statements
 
     Return: 
         None
     """
-    [cur.execute(query) for query in drop_table_queries] # execute all queries in list
+    [cur.execute(query) for query in queries] # execute all queries in list
     conn.commit() # commit the changes to the database
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, queries=create_table_queries):
     """
     CREATE TABLES
     Arguments:
         cur: the cursor object
         conn: connection object to redshift
+        queries: CREATE statements, translated for the backend
 
     Return: 
         None
     """
-    [cur.execute(query) for query in create_table_queries] # execute all queries in list
+    [cur.execute(query) for query in queries] # execute all queries in list
     conn.commit() # commit the changes to the database
 
+
+def missing_tables(cur, conn):
+    """
+    MISSING TABLES
+    Arguments:
+        cur: the cursor object
+        conn: connection object to redshift
+
+    Return:
+        Tables of create_table_queries_by_table that do not exist yet
+    """
+    cur.execute(existing_tables)
+    existing = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    return [table for table in create_table_queries_by_table if table not in existing]
+
 # Run all function
 def main():
     """
     - Establish connection to redshift, 
-    - calls the drop tables function,
+    - calls the drop tables function (unless --missing-only is given),
     - calls the create tables function
     """
+    parser = argparse.ArgumentParser(description="Drops and creates the tables of the data warehouse")
+    parser.add_argument('--missing-only', action='store_true',
+                        help='only create the tables that do not exist, keeping the loaded ones')
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
+    backend = get_backend(config)
+    metrics.configure(config, backend)
 
     # Connection parameters
-    host = config.get('CLUSTER', 'HOST')
-    dbname = config.get('CLUSTER', 'DB_NAME')
-    user = config.get('CLUSTER', 'DB_USER')
-    password = config.get('CLUSTER', 'DB_PASSWORD')
-    port = config.get('CLUSTER', 'DB_PORT')
+    host = config.get(backend.section, 'HOST')
 
     # Establish the database connection
-    logger.info("Establishing connection to redshift cluster")
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    logger.info(f"Establishing connection to {backend.name} database")
+    conn = connect(backend, config, MetricsCursor)
     cur = conn.cursor()
     logger.debug(f"Response: {conn}")
-    logger.info(f"Connected to redshift cluster at {host}")
-
-    # Drop tables
-    logger.info(f"Dropping tables")
-    drop_tables(cur, conn)
-    logger.info(f"Dropped tables ")
-    logger.info(msg="-"*50)
-
-    # Create tables
-    logger.info(f"Creating tables")
-    create_tables(cur, conn)
-    logger.info(f"Created tables ")
-    logger.info(msg="-"*50)
+    logger.info(f"Connected to {backend.name} database at {host}")
+
+    if args.missing_only:
+        # Create the missing tables only, and forget the completed loads of those recreated empty
+        tables = missing_tables(cur, conn)
+        logger.info(f"Creating missing tables {tables}")
+        with stage('create_tables'):
+            queries = typed_create_queries(config, [create_table_queries_by_table[table] for table in tables])
+            create_tables(cur, conn, backend.create_queries(encoded_create_queries(config, queries)))
+        invalidate_tables(cur, conn, tables)
+        logger.info(f"Created {len(tables)} tables ")
+        logger.info(msg="-"*50)
+    else:
+        # Drop tables
+        logger.info(f"Dropping tables")
+        with stage('drop_tables'):
+            drop_tables(cur, conn)
+        logger.info(f"Dropped tables ")
+        logger.info(msg="-"*50)
+
+        # Create tables
+        tables = list(create_table_queries_by_table)
+        logger.info(f"Creating tables")
+        with stage('create_tables'):
+            queries = typed_create_queries(config, create_table_queries)
+            create_tables(cur, conn, backend.create_queries(encoded_create_queries(config, queries)))
+        logger.info(f"Created tables ")
+        logger.info(msg="-"*50)
+
+    # Precompute the calendar the time dimension is looked up in
+    if config.getboolean('ETL', 'TIME_CALENDAR', fallback=False) and 'calendar' in tables:
+        logger.info(f"Building calendar")
+        with stage('build_calendar'):
+            build_calendar(cur, conn, config.get('ETL', 'CALENDAR_START', fallback='2018-01-01'),
+                           config.get('ETL', 'CALENDAR_END', fallback='2019-12-31'), backend.supports_copy_from_stdin)
+        logger.info(msg="-"*50)
+
+    # Invalidate the cached results of the previous tables and catalog
+    bump_versions(cur, conn, tables + [CATALOG])
 
 
 if __name__ == '__main__':
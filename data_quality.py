@@ -0,0 +1,199 @@
+import argparse
+import configparser
+import json
+import logging.config
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from metrics import stage
+from sql_queries import (quality_checks, quality_conditions, quality_duplicate_count, quality_duplicate_sample,
+                         quality_reference_join, quality_sample, quality_scan, quality_violation_count)
+
+logger = logging.getLogger(__name__)
+
+QUALITY_MODES = ('off', 'warn', 'fail')
+
+
+def check_name(check):
+    """
+    Name of a (check, column, argument) in results and samples, e.g. 'references:song_id'.
+    """
+    return f"{check[0]}:{check[1]}"
+
+
+def check_condition(check, column, argument, alias=None):
+    """
+    SQL condition true for the rows violating a not_null, references or range check.
+    """
+    if check == 'range':
+        low, high = argument
+        return quality_conditions[check].format(column=column, low=low, high=high)
+    return quality_conditions[check].format(column=column, alias=alias)
+
+
+def compile_checks(table, checks):
+    """
+    Compiles every check of a table into one aggregate query, so the table is scanned once.
+    Referenced tables are joined as sets of distinct keys, which keeps one row per scanned row.
+    Arguments:
+        table: table checked
+        checks: list of (check, column, argument), see quality_checks
+
+    Return:
+        (query returning the row count then the violations of each check, joins keyed by check index)
+    """
+    aggregates, joins = [], {}
+    for index, (check, column, argument) in enumerate(checks):
+        if check == 'unique':
+            aggregates.append(quality_duplicate_count.format(column=column))
+            continue
+        if check not in quality_conditions:
+            raise ValueError(f"Unknown check {check} on {table}.{column}")
+        alias = None
+        if check == 'references':
+            alias = f"r{index}"
+            joins[index] = quality_reference_join.format(column=column, reference=argument, alias=alias)
+        aggregates.append(quality_violation_count.format(condition=check_condition(check, column, argument, alias)))
+    return quality_scan.format(aggregates=', '.join(aggregates), table=table, joins=' '.join(joins.values())), joins
+
+
+def sample_query(table, checks, index, joins, limit):
+    """
+    Query returning up to limit rows violating one check of a table.
+    """
+    check, column, argument = checks[index]
+    if check == 'unique':
+        return quality_duplicate_sample.format(table=table, column=column, limit=limit)
+    return quality_sample.format(table=table, joins=joins.get(index, ''), limit=limit,
+                                 condition=check_condition(check, column, argument, f"r{index}"))
+
+
+def write_samples(conn, table, checks, violated, joins, limit, directory):
+    """
+    Streams the rows violating checks to a JSON lines file through server side (named) cursors,
+    fetching itersize rows per round trip instead of the whole result.
+
+    Return:
+        Path of the samples file
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{table}.jsonl")
+    with open(path, 'w') as f:
+        for index in violated:
+            with conn.cursor(name=f"quality_{table}_{index}") as cur:
+                cur.itersize = 1000
+                cur.execute(sample_query(table, checks, index, joins, limit))
+                columns = None
+                for row in cur:
+                    if columns is None:
+                        columns = [column[0] for column in cur.description]
+                    f.write(json.dumps({'check': check_name(checks[index]), 'row': dict(zip(columns, row))},
+                                       default=str) + '\n')
+    return path
+
+
+def check_table(connection_pool, table, checks, sample_rows=100, samples_dir=None):
+    """
+    Runs all the checks of a table in a single scan on its own pooled connection, then samples
+    the violating rows when samples_dir is set.
+
+    Return:
+        List of result dicts: table, check, rows scanned, violations
+    """
+    query, joins = compile_checks(table, checks)
+    conn = connection_pool.getconn()
+    try:
+        with stage(f"quality:{table}"):
+            with conn.cursor() as cur:
+                cur.execute(query)
+                counts = cur.fetchone()
+            violated = [index for index, count in enumerate(counts[1:]) if count]
+            if violated and samples_dir and sample_rows:
+                path = write_samples(conn, table, checks, violated, joins, sample_rows, samples_dir)
+                logger.info(f"Wrote samples of the {table} violations to {path}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        connection_pool.putconn(conn)
+    return [{'table': table, 'check': check_name(check), 'rows': counts[0], 'violations': count or 0}
+            for check, count in zip(checks, counts[1:])]
+
+
+def run_checks(connection_pool, checks=quality_checks, max_workers=4, sample_rows=100, samples_dir=None):
+    """
+    Checks tables in parallel, one pooled connection and one scan per table, and emits a
+    'quality_check' metrics record per check.
+    Arguments:
+        connection_pool: pool to borrow connections from
+        checks: dict of table -> list of (check, column, argument)
+        max_workers: maximum number of tables checked at the same time
+        sample_rows: violating rows sampled per failed check
+        samples_dir: directory the samples are written to, None to skip sampling
+
+    Return:
+        List of result dicts, failed checks first
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(check_table, connection_pool, table, table_checks, sample_rows, samples_dir)
+                   for table, table_checks in checks.items()]
+        results = [result for future in futures for result in future.result()]
+    for result in results:
+        metrics.recorder.emit(dict(result, type='quality_check'))
+        if result['violations']:
+            logger.warning(f"Quality check {result['check']} failed on {result['table']}: "
+                           f"{result['violations']} of {result['rows']} rows")
+    failed = [result for result in results if result['violations']]
+    logger.info(f"{len(results) - len(failed)} of {len(results)} quality checks passed on {len(checks)} tables")
+    return failed + [result for result in results if not result['violations']]
+
+
+def quality_stage(config, connection_pool, tables=None):
+    """
+    Runs the post load quality checks as set in the QUALITY section.
+    Arguments:
+        config: parsed dwh.cfg
+        connection_pool: pool to borrow connections from
+        tables: tables to check, defaults to every table of quality_checks
+
+    Return:
+        List of failed check results
+    """
+    section = 'QUALITY'
+    checks = {table: table_checks for table, table_checks in quality_checks.items() if tables is None or table in tables}
+    results = run_checks(connection_pool, checks, config.getint(section, 'CONCURRENCY', fallback=4),
+                         config.getint(section, 'SAMPLE_ROWS', fallback=100),
+                         config.get(section, 'SAMPLES_DIR', fallback='quality_samples') or None)
+    return [result for result in results if result['violations']]
+
+
+def main():
+    """
+    Runs the data quality checks of the loaded tables.
+    """
+    from backends import get_backend
+    from connection import open_pool
+    from metrics import MetricsCursor
+
+    logging.config.fileConfig("logging.conf")
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('tables', nargs='*', help='tables to check, all by default')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    metrics.configure(config, backend)
+    connection_pool = open_pool(backend, config, config.getint('QUALITY', 'CONCURRENCY', fallback=4), MetricsCursor)
+    try:
+        failed = quality_stage(config, connection_pool, args.tables or None)
+    finally:
+        connection_pool.closeall()
+    return not failed
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -1,7 +1,26 @@
 import logging.config
 import configparser
-import psycopg2
-import logging.config
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import boto3
+from backends import copy_staging_table, get_backend
+from calendar_dim import time_insert_query, time_select_query
+from connection import connect, open_pool
+from data_quality import QUALITY_MODES, quality_stage
+from file_splitter import split_staging_inputs
+from incremental import find_new_files, prepare_incremental_load, record_loaded_files
+from key_index import prepare_key_index, update_key_index
+from maintenance import maintenance_stage
+import metrics
+from metrics import MetricsCursor, stage
+from query_cache import bump_versions
+from rollups import refresh_rollups
+from run_ledger import RunLedger, insert_fingerprints, staging_fingerprints
+from scheduler import run_stages
+from table_stats import table_stats
+from upsert import upsert_table_queries
 from sql_queries import *
 
 # Setting up logger
@@ -9,40 +28,160 @@ logging.config.fileConfig("logging.conf")
 logger = logging.getLogger(__name__)
 
 
-def load_staging_tables(cur, conn):
+def load_staging_tables(cur, conn, sources=None, backend=None):
     """
     Loads staging tables from S3 bucket to  redshift cluster.
+    sources optionally replaces copy_table_queries with a dict of table name -> source loaded by the backend.
     """
-    [cur.execute(query) for query in copy_table_queries] # execute all queries in list
+    if sources is None:
+        sources = dict(zip(copy_staging_order, copy_table_queries))
+    for table, source in sources.items():
+        with stage(f"load_staging:{table}"):
+            if backend is None:
+                copy_staging_table(cur, table, source)
+            else:
+                backend.load_staging_table(cur, table, source)
     conn.commit() # commit the changes to the table
 
-def insert_tables(cur, conn):
+
+def load_staging_table(connection_pool, table, query, backend=None):
     """
-    Inserts data from staging tables to fact and dimension tables.
+    Loads a single staging table on its own pooled connection and commits it.
+    Arguments:
+        connection_pool: pool to borrow the connection from
+        table: name of the staging table
+        query: COPY statement loading the table, or the source handed to the backend
+        backend: backend loading the table, None to execute query as is
+
+    Return:
+        Elapsed time in seconds
     """
-    [cur.execute(query) for query in insert_table_queries] # execute all queries in list
+    conn = connection_pool.getconn()
+    try:
+        start = time.perf_counter()
+        with stage(f"load_staging:{table}"), conn.cursor() as cur:
+            if backend is None:
+                copy_staging_table(cur, table, query)
+            else:
+                backend.load_staging_table(cur, table, query)
+        conn.commit()
+        return time.perf_counter() - start
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        connection_pool.putconn(conn)
+
+
+def load_staging_tables_concurrently(connection_pool, max_workers=2, queries=None, backend=None):
+    """
+    Loads staging tables concurrently, one pooled connection per COPY.
+    Every table is committed on its own, so one failed load does not roll back the others.
+    Arguments:
+        connection_pool: pool to borrow connections from
+        max_workers: maximum number of COPY statements running at the same time
+        queries: dict of table name -> COPY statement, defaults to copy_table_queries
+        backend: backend loading the tables, None to execute the queries as is
+
+    Return:
+        dict of table name -> exception raised while loading it (None on success)
+    """
+    if queries is None:
+        queries = dict(zip(copy_staging_order, copy_table_queries))
+
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(load_staging_table, connection_pool, table, query, backend): table
+                   for table, query in queries.items()}
+        for future in as_completed(futures):
+            table = futures[future]
+            try:
+                elapsed = future.result()
+                logger.info(f"Loaded {table} in {elapsed:.2f}s")
+                errors[table] = None
+            except Exception as e:
+                logger.error(f"Error loading {table}: {e}")
+                errors[table] = e
+    return errors
+
+def insert_tables(cur, conn, queries=insert_table_queries_by_table):
+    """
+    Inserts data from staging tables to fact and dimension tables, in a single transaction.
+    queries is a dict of table name -> INSERT statement, or list of statements.
+    """
+    for table, statements in queries.items():
+        with stage(f"insert:{table}"):
+            [cur.execute(query) for query in ([statements] if isinstance(statements, str) else statements)]
     conn.commit() # commit the changes to the table
 
 
+def insert_tables_concurrently(connection_pool, max_workers=4, queries=insert_table_queries_by_table,
+                               on_complete=None):
+    """
+    Inserts data from staging tables to fact and dimension tables, running independent
+    inserts at the same time. Each table is committed on its own pooled connection.
+    Arguments:
+        connection_pool: pool to borrow connections from
+        max_workers: maximum number of inserts running at the same time
+        queries: dict of table name -> INSERT statement, or list of statements
+        on_complete: optional callable(table, elapsed) called as each insert commits
 
-def count_staging(cur, conn):
+    Return:
+        dict of table name -> elapsed time in seconds
     """
-    Counts the number of rows in staging tables.
+    timings = run_stages(connection_pool, queries, insert_table_dependencies, max_workers, stage_prefix='insert:',
+                         on_complete=on_complete)
+    logger.info(f"Insert stage timings: {timings}")
+    return timings
+
+
+
+def insert_table_statements(config, backend, tables=None):
     """
-    for query in count_staging_queries:
-        cur.execute(query)
-        conn.commit()
-        print(cur.fetchall())
+    Builds the statements loading the fact and dimension tables, with ON CONFLICT inserts or,
+    when ETL.UPSERT is set, the set based upsert, translated for the backend.
+    Arguments:
+        config: parsed dwh.cfg
+        backend: backend the statements run on
+        tables: tables to load, in order, defaults to all of insert_table_queries_by_table
+
+    Return:
+        dict of table name -> list of statements
+    """
+    if config.getboolean('ETL', 'UPSERT', fallback=False):
+        queries = upsert_table_queries(config, dict(insert_table_selects, time=time_select_query(config)))
+    else:
+        queries = {table: [query] for table, query in
+                   dict(insert_table_queries_by_table, time=time_insert_query(config)).items()}
+    return {table: [backend.translate(query) for query in queries[table]] for table in tables or queries}
 
 
-def dim_query_count(cur, conn):
+def emit_table_stats(cur, conn, backend, tables, mode, stage_name):
     """
-    Counts the number of rows in dimension tables.
+    Reads the statistics of tables in one round trip and emits them as metrics records.
     """
-    for query in count_fact_dim_queries:
-        cur.execute(query)
+    with stage(stage_name):
+        stats = table_stats(cur, backend, tables, mode)
         conn.commit()
-        print(cur.fetchall())
+    for table, values in stats.items():
+        metrics.recorder.emit(dict(values, type='table_stats', stage=stage_name, table=table, mode=mode))
+    return stats
+
+
+def count_staging(cur, conn, backend=None, mode='exact'):
+    """
+    Counts the number of rows in staging tables.
+    mode is 'exact' for a single UNION ALL count, or 'fast' for catalog statistics.
+    """
+    return emit_table_stats(cur, conn, backend, copy_staging_order, mode, 'count_staging')
+
+
+def dim_query_count(cur, conn, backend=None, mode='exact'):
+    """
+    Counts the number of rows in fact and dimension tables.
+    mode is 'exact' for a single UNION ALL count, or 'fast' for catalog statistics.
+    """
+    return emit_table_stats(cur, conn, backend, insert_table_order, mode, 'count_fact_dim')
 
 
 # Run all function
@@ -57,45 +196,190 @@ def main():
     """
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
+    backend = get_backend(config)
+    metrics.configure(config, backend)
+    quality_mode = config.get('ETL', 'QUALITY_CHECKS', fallback='off')
+    if quality_mode not in QUALITY_MODES:
+        raise ValueError(f"Unknown quality checks mode {quality_mode}, expected one of {QUALITY_MODES}")
+    # Redshift reads the manifest of new log files from S3 only, check it before loading anything
+    incremental = config.getboolean('ETL', 'INCREMENTAL', fallback=False)
+    if incremental:
+        manifest_location = backend.manifest_location(config.get('ETL', 'MANIFEST_LOCATION',
+                                                                 fallback='manifests/staging_events.manifest'))
 
     # Connection parameters
-    host = config.get('CLUSTER', 'HOST')
-    dbname = config.get('CLUSTER', 'DB_NAME')
-    user = config.get('CLUSTER', 'DB_USER')
-    password = config.get('CLUSTER', 'DB_PASSWORD')
-    port = config.get('CLUSTER', 'DB_PORT')
+    host = config.get(backend.section, 'HOST')
 
     # Establish the database connection
-    logger.info("Establishing connection to redshift cluster")
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    logger.info(f"Establishing connection to {backend.name} database")
+    conn = connect(backend, config, MetricsCursor)
     cur = conn.cursor()
     logger.debug(f"Response: {conn}")
-    logger.info(f"Connected to redshift cluster at {host}")
+    logger.info(f"Connected to {backend.name} database at {host}")
+
+    # Connections shared by the concurrent staging loads, inserts and quality checks, opened on first use
+    pool_size = max(config.getint('ETL', 'STAGING_CONCURRENCY', fallback=1),
+                    config.getint('ETL', 'INSERT_CONCURRENCY', fallback=1),
+                    config.getint('QUALITY', 'CONCURRENCY', fallback=4) if quality_mode != 'off' else 1)
+    connection_pool = open_pool(backend, config, pool_size, MetricsCursor)
+
+    # Every stage is recorded in the run ledger; a resumed run skips the ones completed with the same inputs
+    run_ledger = RunLedger(cur, conn, config.getboolean('ETL', 'RESUME', fallback=False))
+    logger.info(f"Starting run {run_ledger.run_id}{' (resuming)' if run_ledger.resume else ''}")
+
+    # Only load log files missing from the load ledger
+    staging_sources = backend.staging_sources()
+    new_files = []
+    split_inputs = config.getboolean('ETL', 'SPLIT_INPUTS', fallback=False)
+    s3_client = None
+    if backend.log_data().startswith('s3://'):
+        s3_client = boto3.client('s3', region_name='us-west-2', aws_access_key_id=config.get('AWS', 'KEY'),
+                                 aws_secret_access_key=config.get('AWS', 'SECRET'))
+    if incremental:
+        logger.info(f"Looking for new log files")
+        with stage('incremental_plan'):
+            new_files = find_new_files(cur, backend.log_data(), s3_client)
+    with stage('fingerprint'):
+        staging_inputs = staging_fingerprints(backend, list(staging_sources),
+                                              {'staging_events_table': new_files} if incremental else None, s3_client)
+    pending = run_ledger.pending('load_staging', staging_inputs)
+    staging_sources = {table: source for table, source in staging_sources.items() if table in pending}
+    if incremental and 'staging_events_table' in staging_sources:
+        with stage('incremental_plan'):
+            manifest, new_files = prepare_incremental_load(cur, conn, backend.log_data(), manifest_location,
+                                                           s3_client, new_files)
+        if manifest is None:
+            del staging_sources['staging_events_table']
+        else:
+            staging_sources['staging_events_table'] = backend.manifest_source(manifest)
+    if 'staging_songs_table' in staging_sources:
+        with stage('load_staging:staging_songs_table'):
+            cur.execute(staging_songs_truncate)
+            conn.commit()
+
+    # Flag the staged songs and artists that are already loaded, so only the new ones are ranked.
+    # staging_songs_table was just emptied, so every unflagged row left after the load is a new key.
+    key_index_file = config.get('ETL', 'KEY_INDEX_FILE', fallback='key_index.json.gz')
+    key_index = config.getboolean('ETL', 'KEY_INDEX', fallback=False) and 'staging_songs_table' in staging_sources
+    if key_index and not (split_inputs or backend.applies_ingest_filters):
+        logger.warning(f"KEY_INDEX needs the song records to pass through the client (SPLIT_INPUTS = true or the "
+                       f"postgres backend), a plain COPY cannot flag them: skipping the key index")
+        key_index = False
+    if key_index:
+        with stage('key_index'):
+            prepare_key_index(cur, conn, key_index_file)
+
+    # Compact or split the inputs into parts sized for the cluster slices
+    if split_inputs:
+        logger.info(f"Splitting staging inputs")
+        with stage('split_inputs'):
+            staging_sources = split_staging_inputs(config, backend, list(staging_sources),
+                                                   {'staging_events_table': new_files} if incremental else None,
+                                                   s3_client)
 
     # Load data
+    staging_concurrency = config.getint('ETL', 'STAGING_CONCURRENCY', fallback=1)
     logger.info(f"Loading data into staging tables")
-    load_staging_tables(cur, conn)
+    run_ledger.record('load_staging', {table: staging_inputs[table] for table in staging_sources})
+    if staging_concurrency > 1:
+        errors = load_staging_tables_concurrently(connection_pool, staging_concurrency, staging_sources, backend)
+        failed = [table for table, error in errors.items() if error is not None]
+        run_ledger.finish('load_staging', [table for table in errors if table not in failed])
+        if failed:
+            run_ledger.finish('load_staging', failed, 'failed')
+            logger.error(f"Failed to load staging tables: {failed}")
+            connection_pool.closeall()
+            conn.close()
+            return False
+    else:
+        try:
+            load_staging_tables(cur, conn, staging_sources, backend)
+        except Exception:
+            conn.rollback()
+            run_ledger.finish('load_staging', staging_sources, 'failed')
+            raise
+        run_ledger.finish('load_staging', staging_sources)
+    bump_versions(cur, conn, staging_sources)
     logger.info(f"Loaded data into staging tables ")
     logger.info(msg="-"*50)
 
     # Count copy to staging tables
-    count_staging(cur, conn)
+    count_mode = config.get('ETL', 'COUNT_MODE', fallback='exact')
+    if count_mode != 'off':
+        run_ledger.record_rows('load_staging', count_staging(cur, conn, backend, count_mode))
 
     # Insert data
+    insert_concurrency = config.getint('ETL', 'INSERT_CONCURRENCY', fallback=1)
     logger.info(f"Inserting data into tables")
-    insert_tables(cur, conn)
+    insert_queries = insert_table_statements(config, backend)
+    insert_inputs = insert_fingerprints(insert_queries, staging_inputs)
+    pending = run_ledger.pending('insert', insert_inputs)
+    insert_queries = {table: queries for table, queries in insert_queries.items() if table in pending}
+    run_ledger.record('insert', {table: insert_inputs[table] for table in insert_queries})
+    inserted = []
+
+    def insert_completed(table, elapsed):
+        inserted.append(table)
+        run_ledger.finish('insert', [table])
+
+    try:
+        if insert_concurrency > 1:
+            insert_tables_concurrently(connection_pool, insert_concurrency, insert_queries, insert_completed)
+        else:
+            insert_tables(cur, conn, insert_queries)
+            inserted = list(insert_queries)
+            run_ledger.finish('insert', inserted)
+    except Exception:
+        conn.rollback()
+        run_ledger.finish('insert', [table for table in insert_queries if table not in inserted], 'failed')
+        raise
+    bump_versions(cur, conn, insert_queries)
+    if key_index:
+        with stage('key_index'):
+            update_key_index(cur, conn, key_index_file)
     logger.info(f"Inserted data into tables ")
     logger.info(msg="-"*50)
 
+    # Add the new songplays to the rollups
+    if config.getboolean('ETL', 'ROLLUPS', fallback=False):
+        logger.info(f"Refreshing rollups")
+        refresh_rollups(cur, conn)
+
+    # Mark the new log files as loaded
+    if incremental:
+        with stage('incremental_record'):
+            record_loaded_files(cur, conn, new_files)
+            bump_versions(cur, conn, ['load_ledger'])
+
+    # Re-sort, reclaim and re-analyze the tables whose churn passed the MAINTENANCE thresholds
+    if config.getboolean('ETL', 'MAINTENANCE', fallback=False):
+        logger.info(f"Running table maintenance")
+        rollup_tables = list(rollup_dimensions) if config.getboolean('ETL', 'ROLLUPS', fallback=False) else []
+        maintenance_stage(cur, conn, backend, config, insert_table_order + rollup_tables)
+
     # Count data insert
-    dim_query_count(cur, conn)
+    if count_mode != 'off':
+        run_ledger.record_rows('insert', dim_query_count(cur, conn, backend, count_mode))
+
+    # Check the loaded data, one scan per table, tables in parallel
+    failed_checks = []
+    if quality_mode != 'off':
+        logger.info(f"Running data quality checks")
+        failed_checks = quality_stage(config, connection_pool)
 
     # Close connection
     logger.info(f"Closing connection")
+    connection_pool.closeall()
     conn.close()
     logger.info(f"Connection closed")
+    metrics.recorder.write_prometheus()
+    if failed_checks and quality_mode == 'fail':
+        logger.error(f"{len(failed_checks)} data quality checks failed")
+        return False
+    return True
 
 
 if __name__ == '__main__':
-    main()
+    succeeded = main()
     logger.info(f"Script completed")
+    sys.exit(0 if succeeded else 1)
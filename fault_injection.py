@@ -0,0 +1,214 @@
+import argparse
+import configparser
+import logging.config
+import sys
+import time
+
+import psycopg2
+from psycopg2.pool import PoolError
+
+from backends import get_backend
+from connection import connect, open_pool
+
+# Setting up logger
+logging.config.fileConfig("logging.conf")
+logger = logging.getLogger(__name__)
+
+# scratch table written by the scenarios, dropped at the end
+SCRATCH_TABLE = 'fault_injection'
+
+
+class FaultInjector:
+    """
+    Kills the server backend of a connection with pg_terminate_backend, from a separate admin connection,
+    the way a leader node restart or a dropped network link ends a session.
+    """
+
+    def __init__(self, dsn):
+        self.admin = psycopg2.connect(dsn)
+        self.admin.autocommit = True
+
+    def kill(self, conn):
+        """
+        Terminates the backend of a connection and waits until it is gone.
+
+        Return:
+            pid of the terminated backend
+        """
+        with conn.raw().cursor() as cur:
+            cur.execute("SELECT pg_backend_pid()")
+            pid = cur.fetchone()[0]
+        with self.admin.cursor() as cur:
+            cur.execute("SELECT pg_terminate_backend(%s)", (pid,))
+            for _ in range(100):
+                cur.execute("SELECT 1 FROM pg_stat_activity WHERE pid = %s", (pid,))
+                if cur.fetchone() is None:
+                    break
+                time.sleep(0.05)
+        return pid
+
+    def count(self):
+        """
+        Rows in the scratch table, read on the admin connection.
+        """
+        with self.admin.cursor() as cur:
+            cur.execute(f"SELECT COUNT(*) FROM {SCRATCH_TABLE}")
+            return cur.fetchone()[0]
+
+    def reset(self):
+        with self.admin.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {SCRATCH_TABLE}")
+            cur.execute(f"CREATE TABLE {SCRATCH_TABLE} (id INT NOT NULL)")
+
+    def close(self):
+        with self.admin.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {SCRATCH_TABLE}")
+        self.admin.close()
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def transaction_replay(backend, config, injector):
+    """
+    A transaction whose connection is killed between two statements is replayed on a new connection
+    and commits every row once.
+    """
+    conn = connect(backend, config)
+    cur = conn.cursor()
+    cur.execute(f"INSERT INTO {SCRATCH_TABLE} (id) VALUES (1)")
+    generation = conn.generation
+    injector.kill(conn)
+    cur.execute(f"INSERT INTO {SCRATCH_TABLE} (id) VALUES (2)")
+    conn.commit()
+    check(conn.generation > generation, "the connection was not reopened")
+    check(injector.count() == 2, f"expected 2 rows after the replay, found {injector.count()}")
+    conn.close()
+
+
+def autocommit_refusal(backend, config, injector):
+    """
+    In autocommit mode an idempotent statement is retried on a new connection, while a non-idempotent
+    one fails instead of being applied twice.
+    """
+    conn = connect(backend, config)
+    conn.autocommit = True
+    cur = conn.cursor()
+    injector.kill(conn)
+    cur.execute("SELECT 1")
+    check(cur.fetchone()[0] == 1, "the idempotent statement was not retried")
+
+    injector.kill(conn)
+    try:
+        cur.execute(f"INSERT INTO {SCRATCH_TABLE} (id) VALUES (1)")
+    except psycopg2.Error:
+        pass
+    else:
+        raise AssertionError("the non-idempotent autocommit statement was retried")
+    check(injector.count() == 0, f"expected no row after the refused statement, found {injector.count()}")
+    conn.close()
+
+
+def named_cursor(backend, config, injector):
+    """
+    A server side cursor lost with its connection is not replayed, since rows already fetched would be
+    read twice; the connection recovers once the transaction is rolled back.
+    """
+    conn = connect(backend, config)
+    cur = conn.cursor('fault_injection_cursor')
+    cur.itersize = 10
+    cur.execute("SELECT n FROM generate_series(1, 100) AS n")
+    check(len(cur.fetchmany(10)) == 10, "the named cursor returned no rows")
+    injector.kill(conn)
+    try:
+        cur.fetchmany(10)
+    except psycopg2.Error:
+        pass
+    else:
+        raise AssertionError("the named cursor kept fetching from a killed connection")
+    try:
+        conn.cursor().execute(f"INSERT INTO {SCRATCH_TABLE} (id) VALUES (1)")
+    except psycopg2.Error:
+        pass
+    else:
+        raise AssertionError("the transaction of the named cursor was replayed")
+    conn.rollback()
+    plain = conn.cursor()
+    plain.execute(f"INSERT INTO {SCRATCH_TABLE} (id) VALUES (1)")
+    conn.commit()
+    check(injector.count() == 1, f"expected 1 row after the rollback, found {injector.count()}")
+    conn.close()
+
+
+def pool(backend, config, injector):
+    """
+    A pooled connection killed while checked out is reopened when it is returned and used again, and a
+    full pool waits POOL_TIMEOUT_SECONDS before failing.
+    """
+    connection_pool = open_pool(backend, config, 1)
+    conn = connection_pool.getconn()
+    injector.kill(conn)
+    connection_pool.putconn(conn)
+    conn = connection_pool.getconn()
+    cur = conn.cursor()
+    cur.execute(f"INSERT INTO {SCRATCH_TABLE} (id) VALUES (1)")
+    conn.commit()
+    check(injector.count() == 1, f"expected 1 row from the reused connection, found {injector.count()}")
+
+    start = time.perf_counter()
+    try:
+        connection_pool.getconn()
+    except PoolError:
+        pass
+    else:
+        raise AssertionError("a full pool handed out a second connection")
+    check(time.perf_counter() - start >= connection_pool.timeout * 0.9, "the full pool did not wait")
+    connection_pool.putconn(conn)
+    connection_pool.closeall()
+
+
+SCENARIOS = [transaction_replay, autocommit_refusal, named_cursor, pool]
+
+
+def main():
+    """
+    Kills the connections of connection.py with pg_terminate_backend while they are in use and checks
+    that they recover: transaction replay, autocommit retries, named cursors and the pool.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--backend', default='postgres')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run, all of them by default')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    if not config.has_section('ETL'):
+        config.add_section('ETL')
+    config.set('ETL', 'BACKEND', args.backend)
+    # fail over quickly instead of waiting on production backoffs
+    config.read_dict({'CONNECTION': {'RETRIES': '3', 'RETRY_BACKOFF_SECONDS': '0.1',
+                                     'RETRY_MAX_BACKOFF_SECONDS': '1', 'POOL_TIMEOUT_SECONDS': '1'}})
+    backend = get_backend(config)
+
+    scenarios = [scenario for scenario in SCENARIOS if not args.scenarios or scenario.__name__ in args.scenarios]
+    injector = FaultInjector(backend.connection_string())
+    failed = []
+    try:
+        for scenario in scenarios:
+            injector.reset()
+            try:
+                scenario(backend, config, injector)
+                logger.info(f"{scenario.__name__}: passed")
+            except (AssertionError, psycopg2.Error) as e:
+                logger.error(f"{scenario.__name__}: failed: {str(e).strip()}")
+                failed.append(scenario.__name__)
+    finally:
+        injector.close()
+    logger.info(f"{len(scenarios) - len(failed)} of {len(scenarios)} scenarios passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import argparse
+import bz2
+import configparser
+import gzip
+import heapq
+import io
+import json
+import logging.config
+import math
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from bulk_loader import open_json_file
+from incremental import list_source_files, split_s3_url, write_manifest
+from ingest_filter import ingest_filter_for
+
+logger = logging.getLogger(__name__)
+
+# suffix of the parts written with each compression
+PART_SUFFIXES = {'': '.json', 'gzip': '.json.gz', 'zstd': '.json.zst', 'bzip2': '.json.bz2'}
+
+
+def part_count(total_bytes, slices, max_part_bytes, multiple=1):
+    """
+    Number of parts to split an input of total_bytes into: a multiple of the slice count, so every slice
+    loads the same number of parts, with enough parts to keep each one under max_part_bytes.
+    """
+    multiple = max(multiple, math.ceil(total_bytes / (slices * max_part_bytes)) if max_part_bytes else 1, 1)
+    return slices * multiple
+
+
+def read_lines(url, s3_client=None):
+    """
+    Yields the non empty lines of a local or S3 JSON file, decompressing it on the fly.
+    """
+    fileobj = None
+    if url.startswith('s3://'):
+        bucket, key = split_s3_url(url)
+        fileobj = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    with open_json_file(url, fileobj) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def open_part(path, compression=''):
+    """
+    Opens a part for writing as text, compressing it with gzip, zstd or bzip2.
+    """
+    if compression == 'gzip':
+        return gzip.open(path, 'wt')
+    if compression == 'bzip2':
+        return bz2.open(path, 'wt')
+    if compression == 'zstd':
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, 'wb')))
+    if compression:
+        raise ValueError(f"Unsupported part compression {compression}, expected gzip, zstd or bzip2")
+    return open(path, 'w')
+
+
+def split_files(files, directory, parts, compression='', s3_client=None, ingest_filter=None):
+    """
+    Rewrites the records of many JSON files into a fixed number of evenly sized parts. Every line goes
+    to the part holding the fewest bytes so far, so the parts differ by at most one record.
+    Arguments:
+        files: list of (file url, size in bytes), local or s3://
+        directory: local directory the parts are written to
+        parts: number of parts
+        compression: '', 'gzip', 'zstd' or 'bzip2'
+        s3_client: boto3 S3 client, required for s3:// files
+        ingest_filter: optional IngestFilter dropping records and fields before they are written
+
+    Return:
+        List of (part path, size in bytes)
+    """
+    if compression not in PART_SUFFIXES:
+        raise ValueError(f"Unsupported part compression {compression}, expected gzip, zstd or bzip2")
+    os.makedirs(directory, exist_ok=True)
+    paths = [os.path.join(directory, f"part-{index:05d}{PART_SUFFIXES[compression]}") for index in range(parts)]
+    outputs = [open_part(path, compression) for path in paths]
+    sizes = [(0, index) for index in range(parts)]
+    try:
+        for url, _ in files:
+            for line in read_lines(url, s3_client):
+                if ingest_filter is not None:
+                    record = ingest_filter.apply(line)
+                    if record is None:
+                        continue
+                    line = json.dumps(record)
+                written, index = heapq.heappop(sizes)
+                outputs[index].write(line + '\n')
+                heapq.heappush(sizes, (written + len(line) + 1, index))
+    finally:
+        for output in outputs:
+            output.close()
+    return [(path, os.path.getsize(path)) for path in paths]
+
+
+def upload_parts(parts, location, s3_client, max_workers=8):
+    """
+    Uploads local parts below an s3:// location, several at a time.
+
+    Return:
+        List of (part url, size in bytes)
+    """
+    bucket, prefix = split_s3_url(location)
+    prefix = prefix.rstrip('/')
+    uploaded = [(f"s3://{bucket}/{prefix}/{os.path.basename(path)}", size) for path, size in parts]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda path: s3_client.upload_file(path, bucket, f"{prefix}/{os.path.basename(path)}"),
+                          [path for path, _ in parts]))
+    return uploaded
+
+
+def split_source(files, location, slices, max_part_bytes, multiple=1, compression='', s3_client=None,
+                 ingest_filter=None):
+    """
+    Compacts or splits the files of a staging table into evenly sized parts and writes their manifest.
+    Arguments:
+        files: list of (file url, size in bytes)
+        location: local directory or s3:// prefix the parts and the manifest are written to
+        slices: slice count of the cluster
+        max_part_bytes: largest uncompressed part
+        multiple: minimum number of parts per slice
+        compression: '', 'gzip', 'zstd' or 'bzip2'
+        s3_client: boto3 S3 client, required for s3:// files and locations
+        ingest_filter: optional IngestFilter applied to every record
+
+    Return:
+        Location of the manifest listing the parts
+    """
+    total = sum(size for _, size in files)
+    parts = part_count(total, slices, max_part_bytes, multiple)
+    manifest = location.rstrip('/') + '/manifest.json'
+    if location.startswith('s3://'):
+        directory = tempfile.mkdtemp(prefix='parts-')
+        try:
+            written = upload_parts(split_files(files, directory, parts, compression, s3_client, ingest_filter),
+                                   location, s3_client)
+        finally:
+            shutil.rmtree(directory)
+    else:
+        written = split_files(files, location, parts, compression, s3_client, ingest_filter)
+    sizes = [size for _, size in written]
+    logger.info(f"Split {len(files)} files ({total} bytes) into {parts} parts of {min(sizes)} to {max(sizes)} bytes")
+    return write_manifest(written, manifest, s3_client)
+
+
+def split_staging_inputs(config, backend, tables, files=None, s3_client=None):
+    """
+    Splits the inputs of staging tables into parts sized for the cluster slices, as set in the ETL section.
+    Arguments:
+        config: parsed dwh.cfg
+        backend: backend loading the staging tables
+        tables: staging tables to split the inputs of
+        files: optional dict of table -> list of (file url, size), e.g. the new files of an incremental load
+        s3_client: boto3 S3 client, required for s3:// files and locations
+
+    Return:
+        dict of table -> source loading the table from the manifest of its parts
+    """
+    slices = config.getint('ETL', 'CLUSTER_SLICES', fallback=8)
+    multiple = config.getint('ETL', 'SPLIT_PARTS_PER_SLICE', fallback=1)
+    max_part_bytes = config.getint('ETL', 'SPLIT_MAX_PART_MB', fallback=256) * 1024 * 1024
+    location = config.get('ETL', 'SPLIT_LOCATION', fallback='split')
+    compression = config.get('S3', 'COMPRESSION', fallback='').strip().lower()
+    sources = {'staging_events_table': backend.log_data(), 'staging_songs_table': backend.song_data()}
+
+    split = {}
+    for table in tables:
+        table_files = (files or {}).get(table)
+        if table_files is None:
+            table_files = list_source_files(sources[table], s3_client=s3_client)
+        # a backend applying the filters while loading the parts gets them unfiltered, so each record is
+        # filtered and counted once
+        ingest_filter = None if backend.applies_ingest_filters else ingest_filter_for(config, table)
+        manifest = split_source(table_files, f"{location.rstrip('/')}/{table}", slices, max_part_bytes, multiple,
+                                compression, s3_client, ingest_filter)
+        if ingest_filter:
+            ingest_filter.report()
+        split[table] = backend.manifest_source(manifest, table)
+    return split
+
+
+def main():
+    """
+    Splits the song and log datasets into evenly sized parts, a multiple of the cluster slice count, and
+    writes a COPY manifest per staging table.
+    """
+    import boto3
+    from backends import get_backend
+
+    logging.config.fileConfig("logging.conf")
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('tables', nargs='*', default=['staging_events_table', 'staging_songs_table'])
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    s3_client = None
+    if backend.name == 'redshift':
+        s3_client = boto3.client('s3', region_name='us-west-2', aws_access_key_id=config.get('AWS', 'KEY'),
+                                 aws_secret_access_key=config.get('AWS', 'SECRET'))
+    split_staging_inputs(config, backend, args.tables, s3_client=s3_client)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import argparse
+import bisect
+import itertools
+import json
+import logging.config
+import os
+import random
+import string
+from datetime import datetime, timedelta, timezone
+
+# Setting up logger
+logging.config.fileConfig("logging.conf")
+logger = logging.getLogger(__name__)
+
+FIRST_NAMES = ['Lily', 'Jacob', 'Kate', 'Chloe', 'Aleena', 'Tegan', 'Ryan', 'Ava', 'Jayden', 'Mohammad', 'Layla',
+               'Matthew', 'Sara', 'Kevin', 'Rylan', 'Emily', 'Noah', 'Sienna', 'Wyatt', 'Amiya']
+LAST_NAMES = ['Koch', 'Klein', 'Harrell', 'Cuevas', 'Kirby', 'Levine', 'Smith', 'Rodriguez', 'Graham', 'Jones',
+              'Taylor', 'Jackson', 'Arellano', 'Cruz', 'George', 'Perez', 'Williams', 'Martinez', 'Owens', 'Lynch']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Portland-South Portland, ME', 'Atlanta-Sandy Springs-Roswell, GA',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'Lansing-East Lansing, MI', 'New York-Newark-Jersey City, NY-NJ-PA',
+             'Houston-The Woodlands-Sugar Land, TX', 'Seattle-Tacoma-Bellevue, WA', 'Tampa-St. Petersburg-Clearwater, FL']
+USER_AGENTS = ['"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Chrome/36.0.1985.143 Safari/537.36"',
+               '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.77.4 (KHTML, like Gecko) '
+               'Version/7.0.5 Safari/537.77.4"',
+               'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0']
+# share of events per page, NextSong being the only page that carries a song
+PAGES = [('NextSong', 0.82), ('Home', 0.07), ('Logout', 0.02), ('Settings', 0.02), ('Upgrade', 0.02),
+         ('Help', 0.02), ('About', 0.01), ('Downgrade', 0.01), ('Save Settings', 0.01)]
+
+
+def zipf_cum_weights(count, skew):
+    """
+    Cumulative weights of a Zipf distribution over count items, skew 0 being uniform.
+    """
+    return list(itertools.accumulate(1.0 / rank ** skew for rank in range(1, count + 1)))
+
+
+def pick(rng, cum_weights):
+    """
+    Picks an index following cumulative weights.
+    """
+    return bisect.bisect(cum_weights, rng.random() * cum_weights[-1])
+
+
+def random_word(rng, low=3, high=9):
+    """
+    Returns a random capitalized word.
+    """
+    return ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(low, high))).capitalize()
+
+
+def random_id(rng, prefix, length=16):
+    """
+    Returns a Million Song Dataset style id, e.g. SOABCDE12AB0180F1.
+    """
+    return prefix + ''.join(rng.choices(string.ascii_uppercase + string.digits, k=length))
+
+
+def make_artists(rng, count):
+    """
+    Returns the artists of the song dataset.
+    """
+    artists = []
+    for _ in range(count):
+        has_location = rng.random() < 0.6
+        artists.append({
+            'artist_id': random_id(rng, 'AR'),
+            'artist_name': ' '.join(random_word(rng) for _ in range(rng.randint(1, 3))),
+            'artist_location': rng.choice(LOCATIONS) if has_location else '',
+            'artist_latitude': round(rng.uniform(-60, 70), 5) if has_location else None,
+            'artist_longitude': round(rng.uniform(-150, 150), 5) if has_location else None,
+        })
+    return artists
+
+
+def make_songs(rng, count, artists, artist_skew):
+    """
+    Returns the songs of the song dataset, prolific artists getting more songs when artist_skew > 0.
+    """
+    artist_weights = zipf_cum_weights(len(artists), artist_skew)
+    songs = []
+    for _ in range(count):
+        song = dict(artists[pick(rng, artist_weights)])
+        song.update({
+            'num_songs': 1,
+            'song_id': random_id(rng, 'SO', 15),
+            'title': ' '.join(random_word(rng) for _ in range(rng.randint(1, 4))),
+            'duration': round(rng.uniform(90, 480), 5),
+            'year': rng.choice([0] + list(range(1960, 2019))),
+        })
+        songs.append(song)
+    return songs
+
+
+def make_users(rng, count):
+    """
+    Returns the app users.
+    """
+    return [{'userId': str(user_id), 'firstName': rng.choice(FIRST_NAMES), 'lastName': rng.choice(LAST_NAMES),
+             'gender': rng.choice('MF'), 'level': 'paid' if rng.random() < 0.25 else 'free',
+             'location': rng.choice(LOCATIONS), 'userAgent': rng.choice(USER_AGENTS),
+             'registration': float(rng.randint(1535000000000, 1541000000000))}
+            for user_id in range(1, count + 1)]
+
+
+def write_songs(songs, output):
+    """
+    Writes one JSON file per song, partitioned by the first three letters of the track id like the real dataset.
+    """
+    for song in songs:
+        track_id = 'TR' + song['song_id'][2:]
+        directory = os.path.join(output, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{track_id}.json"), 'w') as f:
+            json.dump(song, f)
+
+
+def generate_events(rng, users, songs, count, start, days, user_skew, song_skew, session_length):
+    """
+    Yields (day, event) for count log events spread evenly over days.
+    Arguments:
+        rng: random.Random instance
+        users: app users
+        songs: songs of the song dataset
+        count: number of events
+        start: first day
+        days: number of days covered
+        user_skew: Zipf skew of user activity
+        song_skew: Zipf skew of song popularity
+        session_length: mean number of events per session
+    """
+    user_weights = zipf_cum_weights(len(users), user_skew)
+    song_weights = zipf_cum_weights(len(songs), song_skew)
+    page_weights = list(itertools.accumulate(share for _, share in PAGES))
+    sessions = {}
+    next_session_id = itertools.count(1)
+    per_day = -(-count // days)
+    for day_number in range(days):
+        day = start + timedelta(days=day_number)
+        day_ms = int(day.replace(tzinfo=timezone.utc).timestamp() * 1000)
+        offsets = sorted(rng.randrange(86400000) for _ in range(min(per_day, count - day_number * per_day)))
+        for offset in offsets:
+            user = users[pick(rng, user_weights)]
+            session_id, item = sessions.get(user['userId'], (None, 0))
+            if session_id is None or rng.random() < 1.0 / session_length:
+                session_id, item = next(next_session_id), 0
+            sessions[user['userId']] = (session_id, item + 1)
+            page = PAGES[pick(rng, page_weights)][0]
+            song = songs[pick(rng, song_weights)] if page == 'NextSong' else None
+            yield day, {
+                'artist': song['artist_name'] if song else None, 'auth': 'Logged In',
+                'firstName': user['firstName'], 'gender': user['gender'], 'itemInSession': item,
+                'lastName': user['lastName'], 'length': song['duration'] if song else None,
+                'level': user['level'], 'location': user['location'], 'method': 'PUT' if song else 'GET',
+                'page': page, 'registration': user['registration'], 'sessionId': session_id,
+                'song': song['title'] if song else None, 'status': 200, 'ts': day_ms + offset,
+                'userAgent': user['userAgent'], 'userId': user['userId'],
+            }
+
+
+def write_events(events, output):
+    """
+    Writes the events as one newline delimited JSON file per day, partitioned by year and month.
+
+    Return:
+        Number of events written
+    """
+    total = 0
+    for day, day_events in itertools.groupby(events, key=lambda event: event[0]):
+        directory = os.path.join(output, 'log_data', day.strftime('%Y'), day.strftime('%m'))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, day.strftime('%Y-%m-%d-events.json')), 'w') as f:
+            for _, event in day_events:
+                f.write(json.dumps(event) + '\n')
+                total += 1
+    return total
+
+
+def generate(output, events=10000, songs=1000, artists=500, users=100, days=30, start='2018-11-01',
+             user_skew=1.0, artist_skew=0.5, song_skew=1.0, session_length=20, seed=42):
+    """
+    Writes a synthetic Sparkify song and log dataset under output/song_data and output/log_data.
+
+    Return:
+        dict with the number of songs and events written
+    """
+    rng = random.Random(seed)
+    artist_list = make_artists(rng, artists)
+    song_list = make_songs(rng, songs, artist_list, artist_skew)
+    user_list = make_users(rng, users)
+    write_songs(song_list, output)
+    logger.info(f"Wrote {len(song_list)} songs by {len(artist_list)} artists")
+    total = write_events(generate_events(rng, user_list, song_list, events, datetime.strptime(start, '%Y-%m-%d'),
+                                         days, user_skew, song_skew, session_length), output)
+    logger.info(f"Wrote {total} events of {len(user_list)} users over {days} days")
+    return {'songs': len(song_list), 'events': total}
+
+
+def main():
+    """
+    Generates a synthetic Sparkify dataset shaped like the S3 song and log datasets.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--output', default='data')
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--songs', type=int, default=1000)
+    parser.add_argument('--artists', type=int, default=500)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--start', default='2018-11-01')
+    parser.add_argument('--user-skew', type=float, default=1.0)
+    parser.add_argument('--artist-skew', type=float, default=0.5)
+    parser.add_argument('--song-skew', type=float, default=1.0)
+    parser.add_argument('--session-length', type=float, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    generate(args.output, args.events, args.songs, args.artists, args.users, args.days, args.start,
+             args.user_skew, args.artist_skew, args.song_skew, args.session_length, args.seed)
+
+
+if __name__ == '__main__':
+    main()
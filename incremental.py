@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import re
+from datetime import datetime
+
+from bulk_loader import JSON_SUFFIXES
+from sql_queries import load_ledger_watermark, load_ledger_select, load_ledger_insert, staging_events_truncate
+
+logger = logging.getLogger(__name__)
+
+PARTITION_PATTERN = re.compile(r'(\d{4})/(\d{2})/')
+
+
+def strip_quotes(value):
+    """
+    Removes the SQL quotes the config values are stored with.
+    """
+    return value.strip().strip("'\"")
+
+
+def partition_of(key):
+    """
+    Returns the year/month partition of a log file key, e.g. '2018/11', or '' when the key is not partitioned.
+    """
+    match = PARTITION_PATTERN.search(key)
+    return f"{match.group(1)}/{match.group(2)}" if match else ''
+
+
+def split_s3_url(url):
+    """
+    Splits an s3://bucket/prefix url into (bucket, prefix).
+    """
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    return bucket, prefix
+
+
+# List source files
+def list_source_files(source, watermark='', s3_client=None):
+    """
+    Lists the JSON files of the log dataset, compressed ones included, skipping partitions older than the watermark.
+    Arguments:
+        source: s3:// url or local directory holding the dataset
+        watermark: newest partition already loaded, e.g. '2018/11'
+        s3_client: boto3 S3 client, required for s3:// sources
+
+    Return:
+        List of (file url, size in bytes) sorted by url
+    """
+    files = []
+    if source.startswith('s3://'):
+        bucket, prefix = split_s3_url(source)
+        prefix = prefix.rstrip('/') + '/' if prefix else ''
+        paginate_args = {'Bucket': bucket, 'Prefix': prefix}
+        if watermark:
+            # keys are listed in lexicographic order, so older partitions are never fetched
+            paginate_args['StartAfter'] = prefix + watermark
+        for page in s3_client.get_paginator('list_objects_v2').paginate(**paginate_args):
+            for item in page.get('Contents', []):
+                if item['Key'].endswith(JSON_SUFFIXES):
+                    files.append((f"s3://{bucket}/{item['Key']}", item['Size']))
+    else:
+        for root, _, names in os.walk(source):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith(JSON_SUFFIXES) and partition_of(path.replace(os.sep, '/')) >= watermark:
+                    files.append((os.path.abspath(path), os.path.getsize(path)))
+    return sorted(files)
+
+
+def find_new_files(cur, source, s3_client=None):
+    """
+    Compares every source file with the load ledger. Every partition is listed, not only the ones from the
+    watermark on, so files arriving late in a partition already loaded are picked up too.
+    Arguments:
+        cur: cursor object
+        source: s3:// url or local directory holding the dataset
+        s3_client: boto3 S3 client, required for s3:// sources
+
+    Return:
+        List of (file url, size in bytes) not yet recorded in the ledger
+    """
+    cur.execute(load_ledger_watermark)
+    watermark = cur.fetchone()[0] or ''
+    cur.execute(load_ledger_select, ('',))
+    loaded = {row[0] for row in cur.fetchall()}
+    files = list_source_files(source, s3_client=s3_client)
+    new_files = [(url, size) for url, size in files if url not in loaded]
+    log_late_files(new_files, watermark)
+    logger.info(f"Watermark {watermark or 'none'}: {len(new_files)} new of {len(files)} listed files")
+    return new_files
+
+
+def log_late_files(files, watermark):
+    """
+    Logs the new files of partitions older than the watermark, which arrived after their partition was loaded.
+
+    Return:
+        List of the late file urls
+    """
+    late = [url for url, _ in files if partition_of(url) < watermark]
+    if late:
+        logger.warning(f"{len(late)} files arrived late in partitions older than the watermark {watermark}, "
+                       f"loading them: {', '.join(late[:5])}{' ...' if len(late) > 5 else ''}")
+    return late
+
+
+# Write COPY manifest
+def write_manifest(files, location, s3_client=None):
+    """
+    Writes a Redshift COPY manifest listing the given files.
+    Arguments:
+        files: list of (file url, size in bytes)
+        location: s3:// url or local path of the manifest
+        s3_client: boto3 S3 client, required for s3:// locations
+
+    Return:
+        The manifest location
+    """
+    manifest = {'entries': [{'url': url, 'mandatory': True, 'meta': {'content_length': size}}
+                            for url, size in files]}
+    body = json.dumps(manifest, indent=2)
+    if location.startswith('s3://'):
+        bucket, key = split_s3_url(location)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(location)), exist_ok=True)
+        with open(location, 'w') as f:
+            f.write(body)
+    logger.info(f"Wrote manifest with {len(files)} files to {location}")
+    return location
+
+
+def read_manifest(location):
+    """
+    Reads the file urls listed in a local manifest.
+    """
+    with open(location) as f:
+        return [entry['url'] for entry in json.load(f)['entries']]
+
+
+def prepare_incremental_load(cur, conn, source, location, s3_client=None, new_files=None):
+    """
+    Empties the events staging table and writes a manifest listing only the new log files,
+    so the fact and dimension inserts that follow only see new rows.
+    Arguments:
+        cur: cursor object
+        conn: connection object to redshift
+        source: s3:// url or local directory holding the log dataset
+        location: s3:// url or local path the manifest is written to
+        s3_client: boto3 S3 client, required for s3:// sources
+        new_files: new files already found by find_new_files, looked up when None
+
+    Return:
+        (manifest location or None when there is nothing new, list of new files)
+    """
+    if new_files is None:
+        new_files = find_new_files(cur, source, s3_client)
+    cur.execute(staging_events_truncate)
+    conn.commit()
+    if not new_files:
+        return None, []
+    return write_manifest(new_files, location, s3_client), new_files
+
+
+def record_loaded_files(cur, conn, files):
+    """
+    Records files in the load ledger once their rows reached the fact and dimension tables.
+    Arguments:
+        cur: cursor object
+        conn: connection object to redshift
+        files: list of (file url, size in bytes)
+
+    Return:
+        None
+    """
+    loaded_at = datetime.utcnow()
+    cur.executemany(load_ledger_insert, [(url, partition_of(url), size, loaded_at) for url, size in files])
+    conn.commit()
+    logger.info(f"Recorded {len(files)} files in the load ledger")
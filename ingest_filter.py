@@ -0,0 +1,121 @@
+import json
+import logging
+
+import metrics
+from key_index import key_index_annotator
+from sql_queries import ingest_filter_columns, ingest_filter_rules, staging_columns
+
+logger = logging.getLogger(__name__)
+
+# staging tables an ingest filter can be configured for, and the tables loaded from them
+FILTERED_TABLES = {'staging_events_table': ['songplays', 'time', 'users']}
+
+
+def parse_rule(value):
+    """
+    Parses a row rule of the INGEST_FILTER section, e.g. 'page=NextSong, user_id'.
+
+    Return:
+        dict of staging column -> required value, None requiring any non empty value
+    """
+    rule = {}
+    for condition in value.split(','):
+        column, _, required = condition.partition('=')
+        if column.strip():
+            rule[column.strip()] = required.strip() or None
+    return rule
+
+
+class IngestFilter:
+    """
+    Drops the log records no target table needs and the fields none of the targets matching a record reads,
+    before they reach the staging table. Counts the rows and bytes dropped.
+    """
+
+    def __init__(self, table, targets, rules, columns):
+        """
+        Arguments:
+            table: staging table the records are loaded into
+            targets: tables loaded from the staging table that the kept rows must serve
+            rules: dict of target -> row rule, see parse_rule
+            columns: dict of target -> staging columns it reads
+        """
+        keys = dict(staging_columns[table])
+        self.table = table
+        self.targets = [({keys[column]: value for column, value in rules[target].items()},
+                         {keys[column] for column in columns[target]}) for target in targets]
+        self.rows_in = self.rows_out = self.bytes_in = self.bytes_out = 0
+
+    @staticmethod
+    def matches(record, rule):
+        """
+        Tells whether a record satisfies every condition of a row rule.
+        """
+        for key, required in rule.items():
+            value = record.get(key)
+            if required is None:
+                if value in (None, ''):
+                    return False
+            elif str(value) != required:
+                return False
+        return True
+
+    def apply(self, line):
+        """
+        Filters one JSON line.
+
+        Return:
+            The record reduced to the fields its targets read, None when no target needs it
+        """
+        self.rows_in += 1
+        self.bytes_in += len(line.encode('utf-8')) + 1
+        record = json.loads(line)
+        keep = set()
+        for rule, keys in self.targets:
+            if self.matches(record, rule):
+                keep |= keys
+        if not keep:
+            return None
+        record = {key: value for key, value in record.items() if key in keep}
+        self.rows_out += 1
+        self.bytes_out += len(json.dumps(record).encode('utf-8')) + 1
+        return record
+
+    def report(self):
+        """
+        Logs and emits the rows and bytes dropped so far.
+
+        Return:
+            dict of counters
+        """
+        counters = {'rows_in': self.rows_in, 'rows_dropped': self.rows_in - self.rows_out,
+                    'bytes_in': self.bytes_in, 'bytes_dropped': self.bytes_in - self.bytes_out}
+        metrics.recorder.emit(dict(counters, type='ingest_filter', table=self.table))
+        if self.rows_in:
+            logger.info(f"Ingest filter {self.table}: dropped {counters['rows_dropped']} of {self.rows_in} rows, "
+                        f"{counters['bytes_dropped']} of {self.bytes_in} bytes "
+                        f"({counters['bytes_dropped'] / self.bytes_in * 100 if self.bytes_in else 0:.1f}%)")
+        return counters
+
+
+def ingest_filter_for(config, table):
+    """
+    Returns the ingest filter of a staging table when ETL.INGEST_FILTER is set, None otherwise.
+    INGEST_FILTER.TARGETS selects the tables the kept rows must serve, and a key named after a target
+    overrides its row rule, e.g. users = page=NextSong.
+    Song records are not filtered, but flagged by the key index when ETL.KEY_INDEX is set.
+    """
+    if table == 'staging_songs_table':
+        return key_index_annotator(config, table)
+    if table not in FILTERED_TABLES or not config.getboolean('ETL', 'INGEST_FILTER', fallback=False):
+        return None
+    section = 'INGEST_FILTER'
+    targets = [target.strip() for target in
+               config.get(section, 'TARGETS', fallback=', '.join(FILTERED_TABLES[table])).split(',')
+               if target.strip()]
+    unknown = set(targets) - set(FILTERED_TABLES[table])
+    if unknown:
+        raise ValueError(f"Unknown ingest filter targets {sorted(unknown)}, expected {FILTERED_TABLES[table]}")
+    rules = {target: parse_rule(config.get(section, target)) if config.has_option(section, target)
+             else ingest_filter_rules[target] for target in targets}
+    return IngestFilter(table, targets, rules, ingest_filter_columns)
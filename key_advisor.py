@@ -0,0 +1,266 @@
+import argparse
+import configparser
+import json
+import logging.config
+import re
+import time
+from collections import Counter
+
+from backends import get_backend, strip_physical_design
+from benchmark import run
+from connection import connect
+from sql_queries import (analytics_queries, create_table_queries, create_table_queries_by_table, insert_table_order,
+                         insert_table_queries_by_table, scratch_schema_create, scratch_schema_drop,
+                         scratch_search_path)
+
+# Setting up logger
+logging.config.fileConfig("logging.conf")
+logger = logging.getLogger(__name__)
+
+TABLE_REFERENCE = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)'
+                             r'(?:\s+(?:AS\s+)?(?!ON\b|WHERE\b|JOIN\b|GROUP\b|ORDER\b|LIMIT\b)(\w+))?', re.IGNORECASE)
+EQUI_JOIN = re.compile(r'\b(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)\b')
+CLAUSE = {'filter': re.compile(r'\bWHERE\b(.*?)(?=\bGROUP\s+BY\b|\bORDER\s+BY\b|\bLIMIT\b|\bON\s+CONFLICT\b|;|$)',
+                               re.IGNORECASE | re.DOTALL),
+          'group': re.compile(r'\bGROUP\s+BY\b(.*?)(?=\bORDER\s+BY\b|\bLIMIT\b|\bHAVING\b|;|$)',
+                              re.IGNORECASE | re.DOTALL)}
+COLUMN_REFERENCE = re.compile(r'\b(?:(\w+)\.)?([a-z_]\w*)\b', re.IGNORECASE)
+CREATE_TABLE = re.compile(r'CREATE\s+TABLE\s+(\w+)', re.IGNORECASE)
+COLUMN_DEFINITION = re.compile(r'^\s*([a-z_]\w*)\s+(?:BIGINT|INT|SMALLINT|VARCHAR|CHAR|NUMERIC|FLOAT|REAL|TIMESTAMP)',
+                               re.IGNORECASE | re.MULTILINE)
+SCHEMA_NAME = re.compile(r'^[a-z_]\w*$', re.IGNORECASE)
+# schemas holding live tables, never used as the benchmark scratch schema
+LIVE_SCHEMAS = {'public', 'pg_catalog', 'information_schema'}
+
+
+def table_columns(create_query):
+    """
+    Returns the column names declared by a CREATE TABLE statement.
+    """
+    return [match.group(1).lower() for match in COLUMN_DEFINITION.finditer(create_query)]
+
+
+def capture_workload(queries, schema):
+    """
+    Counts how often each column of the schema is used as a join key, filter or grouping column.
+    Arguments:
+        queries: SQL statements of the workload
+        schema: dict of table name -> list of column names
+
+    Return:
+        dict of (table, column) -> Counter of usage ('join', 'filter', 'group')
+    """
+    usage = {}
+    for query in queries:
+        aliases = {}
+        for table, alias in TABLE_REFERENCE.findall(query):
+            if table.lower() in schema:
+                aliases[table.lower()] = table.lower()
+                if alias:
+                    aliases[alias.lower()] = table.lower()
+        referenced = set(aliases.values())
+
+        def resolve(qualifier, column):
+            column = column.lower()
+            if qualifier:
+                table = aliases.get(qualifier.lower())
+                return (table, column) if table and column in schema[table] else None
+            owners = [table for table in referenced if column in schema[table]]
+            return (owners[0], column) if len(owners) == 1 else None
+
+        for left_alias, left_column, right_alias, right_column in EQUI_JOIN.findall(query):
+            for key in (resolve(left_alias, left_column), resolve(right_alias, right_column)):
+                if key:
+                    usage.setdefault(key, Counter())['join'] += 1
+        for kind, pattern in CLAUSE.items():
+            for clause in pattern.findall(query):
+                for qualifier, column in set(COLUMN_REFERENCE.findall(clause)):
+                    key = resolve(qualifier, column)
+                    if key:
+                        usage.setdefault(key, Counter())[kind] += 1
+    return usage
+
+
+def profile_column(cur, table, column):
+    """
+    Profiles a candidate key column: rows, distinct values, null fraction and share of the most frequent value.
+    """
+    cur.execute(f"SELECT COUNT(*), COUNT(DISTINCT {column}), SUM(CASE WHEN {column} IS NULL THEN 1 ELSE 0 END) "
+                f"FROM {table}")
+    rows, distinct, nulls = cur.fetchone()
+    cur.execute(f"SELECT MAX(value_rows) FROM (SELECT {column}, COUNT(*) AS value_rows FROM {table} "
+                f"GROUP BY {column}) AS value_counts")
+    top = cur.fetchone()[0] or 0
+    return {'rows': rows, 'distinct': distinct, 'null_fraction': (nulls or 0) / rows if rows else 0.0,
+            'top_value_share': top / rows if rows else 0.0}
+
+
+def slice_skew(profile, slices):
+    """
+    Expected ratio between the fullest slice and an average slice when distributing on the column:
+    the most frequent value lands on a single slice, as do all NULLs.
+    """
+    heaviest = max(profile['top_value_share'], profile['null_fraction'])
+    if profile['distinct'] and profile['distinct'] < slices:
+        heaviest = max(heaviest, 1.0 / profile['distinct'])
+    return max(1.0, heaviest * slices)
+
+
+def advise_table(table, columns, usage, profiles, slices, all_threshold):
+    """
+    Ranks the distribution and sort key options of one table.
+
+    Return:
+        List of designs, best first: {'diststyle', 'distkey', 'sortkey', 'score', 'reason'}
+    """
+    rows = max((profile['rows'] for profile in profiles.values()), default=0)
+    sortkey = sorted((column for column in columns if usage.get((table, column))),
+                     key=lambda column: (-(usage[(table, column)]['filter'] + usage[(table, column)]['group']),
+                                         -usage[(table, column)]['join'], columns.index(column)))[:3]
+    designs = [{'diststyle': 'even', 'distkey': None, 'sortkey': sortkey, 'score': 1.0,
+                'reason': 'even distribution, no co-located joins'}]
+    for column, profile in profiles.items():
+        joins = usage.get((table, column), Counter())['join']
+        if not joins:
+            continue
+        skew = slice_skew(profile, slices)
+        designs.append({'diststyle': 'key', 'distkey': column, 'sortkey': sortkey, 'score': (1 + joins) / skew,
+                        'reason': f"joined {joins}x, expected slice skew {skew:.2f}"})
+    if table != 'songplays' and rows <= all_threshold:
+        designs.append({'diststyle': 'all', 'distkey': None, 'sortkey': sortkey, 'score': 2.0 + slices / 4,
+                        'reason': f"{rows} rows, small enough to copy to every node"})
+    return sorted(designs, key=lambda design: -design['score'])
+
+
+def apply_design(create_query, design):
+    """
+    Rewrites a CREATE TABLE statement with another distribution style, distribution key and sort key.
+    """
+    query = strip_physical_design(create_query).rstrip().rstrip(';').rstrip()
+    clauses = [f"DISTSTYLE {design['diststyle'].upper()}"]
+    if design['distkey']:
+        clauses.append(f"DISTKEY ({design['distkey']})")
+    if design['sortkey']:
+        clauses.append(f"SORTKEY ({', '.join(design['sortkey'])})")
+    return query + '\n    ' + ' '.join(clauses) + ';\n'
+
+
+def build_variants(designs, count=3):
+    """
+    Combines the per table designs into complete create_table_queries variants, ranked by heuristic score.
+
+    Return:
+        List of {'name', 'score', 'designs', 'create_table_queries'}
+    """
+    variants = [{'name': 'current', 'score': None, 'designs': {}, 'create_table_queries': list(create_table_queries)}]
+    for rank in range(count):
+        chosen = {table: options[min(rank, len(options) - 1)] for table, options in designs.items()}
+        queries = [apply_design(query, chosen[table]) if table in chosen else query
+                   for table, query in create_table_queries_by_table.items()]
+        if any(queries == variant['create_table_queries'] for variant in variants):
+            continue
+        variants.append({'name': f"advised_{rank + 1}", 'score': round(sum(d['score'] for d in chosen.values()), 3),
+                         'designs': chosen, 'create_table_queries': queries})
+    return variants
+
+
+def benchmark_variant(cur, conn, backend, config, variant, repeat=3):
+    """
+    Rebuilds the schema with a variant, reloads it and times the insert and analytics workload.
+    Drops and recreates every table of the schema conn resolves unqualified names in, see benchmark_variants.
+
+    Return:
+        dict of workload name -> best elapsed seconds, plus 'total'
+    """
+    stages = run(cur, conn, backend, config, backend.create_queries(variant['create_table_queries']))
+    timings = {stage['stage']: stage['seconds'] for stage in stages if stage['stage'].startswith('insert:')}
+    for name, query in analytics_queries.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cur.execute(query)
+            cur.fetchall()
+            best = min(best or float('inf'), time.perf_counter() - start)
+        timings[f"query:{name}"] = round(best, 4)
+    conn.commit()
+    timings['total'] = round(sum(timings.values()), 4)
+    return timings
+
+
+def benchmark_variants(conn, backend, config, variants, schema):
+    """
+    Rebuilds, reloads and times every variant in a scratch schema, on a connection whose sessions only
+    resolve unqualified names in it, so the live tables, load_ledger, run_ledger, table_versions and
+    rollups are never dropped. The scratch schema is dropped at the end; the live schema keeps its DDL.
+    Arguments:
+        conn: connection to the live database, used to create and drop the scratch schema
+        variants: variants of build_variants, timings added to each
+        schema: name of the scratch schema
+    """
+    if not SCHEMA_NAME.match(schema) or schema.lower() in LIVE_SCHEMAS:
+        raise ValueError(f"Invalid scratch schema {schema}, expected a new schema name")
+    cur = conn.cursor()
+    cur.execute(scratch_schema_create.format(schema=schema))
+    conn.commit()
+    scratch = connect(backend, config, session_statements=[scratch_search_path.format(schema=schema)])
+    try:
+        scratch_cur = scratch.cursor()
+        for variant in variants:
+            logger.info(f"Benchmarking variant {variant['name']} in schema {schema}")
+            variant['timings'] = benchmark_variant(scratch_cur, scratch, backend, config, variant)
+    finally:
+        scratch.close()
+        cur.execute(scratch_schema_drop.format(schema=schema))
+        conn.commit()
+
+
+def main():
+    """
+    Profiles the loaded star schema and the workload, and ranks distribution/sort key variants of the DDL.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--variants', type=int, default=3, help='number of advised variants')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='rebuild, reload and time every variant in a scratch schema')
+    parser.add_argument('--schema', default='key_advisor_scratch', help='scratch schema of --benchmark')
+    parser.add_argument('--output', default='key_advice.json')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    slices = config.getint('ETL', 'CLUSTER_SLICES', fallback=8)
+    all_threshold = config.getint('ETL', 'DISTSTYLE_ALL_MAX_ROWS', fallback=5000000)
+
+    schema = {table: table_columns(create_table_queries_by_table[table]) for table in insert_table_order}
+    workload = list(insert_table_queries_by_table.values()) + list(analytics_queries.values())
+    usage = capture_workload(workload, schema)
+
+    conn = connect(backend, config)
+    cur = conn.cursor()
+    designs = {}
+    for table, columns in schema.items():
+        candidates = [column for column in columns if usage.get((table, column), Counter())['join']] or columns[:1]
+        profiles = {column: profile_column(cur, table, column) for column in candidates}
+        designs[table] = advise_table(table, columns, usage, profiles, slices, all_threshold)
+        logger.info(f"{table}: {designs[table][0]['diststyle']} {designs[table][0]['distkey'] or ''} "
+                    f"sortkey {designs[table][0]['sortkey']} ({designs[table][0]['reason']})")
+    conn.commit()
+
+    variants = build_variants(designs, args.variants)
+    if args.benchmark:
+        benchmark_variants(conn, backend, config, variants, args.schema)
+        variants.sort(key=lambda variant: variant['timings']['total'])
+        logger.info(f"Fastest variant: {variants[0]['name']}, the live tables keep their current DDL")
+    conn.close()
+
+    report = {'slices': slices,
+              'usage': {f"{table}.{column}": dict(counts) for (table, column), counts in usage.items()},
+              'variants': variants}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    logger.info(f"Wrote {len(variants)} variants to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
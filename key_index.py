@@ -0,0 +1,209 @@
+import argparse
+import bisect
+import configparser
+import gzip
+import json
+import logging.config
+import os
+
+import metrics
+from sql_queries import (key_index_flags, key_index_new_keys, key_index_select, key_index_tables,
+                         table_versions_select)
+
+logger = logging.getLogger(__name__)
+
+
+class KeyIndex:
+    """
+    Sorted arrays of the song_id and artist_id values already loaded into songs and artists, persisted
+    between runs with the table_versions they were read at. A Bloom filter would be smaller, but each
+    false positive would flag a new song as known and keep it out of the dimensions for good.
+    """
+
+    def __init__(self, keys=None, versions=None):
+        self.keys = {column: sorted(set((keys or {}).get(column, []))) for column in key_index_tables}
+        self.versions = dict(versions or {})
+
+    def contains(self, column, key):
+        """
+        Tells whether a key was already loaded, by binary search.
+        """
+        if key is None:
+            return False
+        keys = self.keys[column]
+        index = bisect.bisect_left(keys, key)
+        return index < len(keys) and keys[index] == key
+
+    def add(self, column, keys):
+        """
+        Adds newly loaded keys.
+        """
+        self.keys[column] = sorted(set(self.keys[column]).union(keys))
+
+    def current(self, versions):
+        """
+        Tells whether the index was read at the current versions of songs and artists, i.e. no load
+        outside of the ETL and no create_tables.py run changed them since.
+        """
+        return all(table in versions and self.versions.get(table) == versions[table]
+                   for table in key_index_tables.values())
+
+    def save(self, path):
+        """
+        Writes the index as gzip compressed JSON, replacing the previous file atomically.
+        """
+        with gzip.open(path + '.tmp', 'wt') as f:
+            json.dump({'versions': self.versions, 'keys': self.keys}, f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads an index written by save, None when there is none.
+        """
+        if not os.path.exists(path):
+            return None
+        with gzip.open(path, 'rt') as f:
+            data = json.load(f)
+        return cls(data['keys'], data['versions'])
+
+
+class KeyIndexAnnotator:
+    """
+    Flags the song records whose song_id or artist_id is already loaded, as the records are staged, so the
+    song and artist inserts only rank the new ones. Records are never dropped: songplays still matches
+    plays against every staged song.
+    """
+
+    def __init__(self, index, table='staging_songs_table'):
+        self.index = index
+        self.table = table
+        self.rows_in = 0
+        self.known = {column: 0 for column in key_index_flags}
+
+    def apply(self, line):
+        """
+        Annotates one JSON line.
+
+        Return:
+            The record with its song_known and artist_known flags
+        """
+        self.rows_in += 1
+        record = json.loads(line)
+        for column, flag in key_index_flags.items():
+            record[flag] = self.index.contains(column, record.get(column))
+            self.known[column] += record[flag]
+        return record
+
+    def report(self):
+        """
+        Logs and emits the number of records whose keys were already loaded.
+
+        Return:
+            dict of counters
+        """
+        counters = dict({f"{column}_known": count for column, count in self.known.items()}, rows_in=self.rows_in)
+        metrics.recorder.emit(dict(counters, type='key_index', table=self.table))
+        logger.info(f"Key index {self.table}: " + ', '.join(f"{count} of {self.rows_in} {column}s already loaded"
+                                                            for column, count in self.known.items()))
+        return counters
+
+
+def read_versions(cur):
+    """
+    Current data versions of the tables the index is built from.
+    """
+    cur.execute(table_versions_select)
+    versions = dict(cur.fetchall())
+    return {table: versions[table] for table in key_index_tables.values() if table in versions}
+
+
+def build_key_index(cur, conn):
+    """
+    Reads every song_id and artist_id from the warehouse.
+    """
+    versions = read_versions(cur)
+    keys = {}
+    for column, table in key_index_tables.items():
+        cur.execute(key_index_select.format(column=column, table=table))
+        keys[column] = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    logger.info(f"Built the key index from the warehouse: " +
+                ', '.join(f"{len(values)} {column}s" for column, values in keys.items()))
+    return KeyIndex(keys, versions)
+
+
+def prepare_key_index(cur, conn, path):
+    """
+    Makes sure the index at path matches the warehouse before staging, rebuilding it when it is
+    missing or songs or artists changed since it was written.
+
+    Return:
+        KeyIndex
+    """
+    index = KeyIndex.load(path)
+    versions = read_versions(cur)
+    conn.commit()
+    if index is None or not index.current(versions):
+        logger.info(f"Key index {path} is missing or out of date, rebuilding it")
+        index = build_key_index(cur, conn)
+        index.save(path)
+    return index
+
+
+def update_key_index(cur, conn, path):
+    """
+    Adds the keys staged as new to the index once the song and artist inserts committed,
+    and records the versions the inserts gave songs and artists. staging_songs_table is emptied before
+    every load, so its unflagged rows are only the new keys.
+
+    Return:
+        KeyIndex
+    """
+    index = KeyIndex.load(path)
+    if index is None:
+        index = build_key_index(cur, conn)
+    else:
+        for column, flag in key_index_flags.items():
+            cur.execute(key_index_new_keys.format(column=column, flag=flag))
+            index.add(column, [row[0] for row in cur.fetchall()])
+        index.versions = read_versions(cur)
+        conn.commit()
+    index.save(path)
+    return index
+
+
+def key_index_annotator(config, table):
+    """
+    Returns the annotator of the song records when ETL.KEY_INDEX is set and the index exists, None otherwise.
+    """
+    if table != 'staging_songs_table' or not config.getboolean('ETL', 'KEY_INDEX', fallback=False):
+        return None
+    index = KeyIndex.load(config.get('ETL', 'KEY_INDEX_FILE', fallback='key_index.json.gz'))
+    return KeyIndexAnnotator(index, table) if index is not None else None
+
+
+def main():
+    """
+    Rebuilds the local index of the loaded song and artist ids from the warehouse.
+    """
+    from backends import get_backend
+    from connection import connect
+
+    logging.config.fileConfig("logging.conf")
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    conn = connect(backend, config)
+    cur = conn.cursor()
+    try:
+        build_key_index(cur, conn).save(config.get('ETL', 'KEY_INDEX_FILE', fallback='key_index.json.gz'))
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import argparse
+import configparser
+import logging.config
+import time
+
+import metrics
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# churn measures compared with their thresholds, and the operation fixing them
+CHURN_OPERATIONS = {'unsorted_pct': 'sort', 'deleted_pct': 'delete', 'stats_off_pct': 'analyze'}
+
+
+def table_churn(cur, backend, tables):
+    """
+    Reads the size, unsorted %, stats off % and deleted rows % of tables from the system views.
+
+    Return:
+        dict of table -> dict of measures, tables missing from the views (e.g. empty ones) being left out
+    """
+    cur.execute(backend.maintenance_info_query, (tuple(tables),))
+    churn = {}
+    for table, size_mb, unsorted, stats_off, deleted in cur.fetchall():
+        churn[table.strip()] = {'size_mb': float(size_mb or 0),
+                                'unsorted_pct': None if unsorted is None else float(unsorted),
+                                'stats_off_pct': float(stats_off or 0), 'deleted_pct': float(deleted or 0)}
+    return churn
+
+
+def plan_maintenance(churn, thresholds, commands):
+    """
+    Picks the operations each table needs: VACUUM SORT ONLY or DELETE ONLY when its unsorted or deleted rows
+    reach their threshold (a full VACUUM when both do), and ANALYZE when its statistics are off by more than
+    theirs. Tables furthest past a threshold come first; a table is vacuumed before it is analyzed.
+    Arguments:
+        churn: dict of table -> measures, see table_churn
+        thresholds: dict of churn measure -> threshold %, 0 disabling the operation
+        commands: operations supported by the backend
+
+    Return:
+        List of dicts: table, operation, size_mb, urgency (highest measure / threshold ratio) and reason
+    """
+    plan = []
+    for table, values in churn.items():
+        over = {measure: values[measure] / thresholds[measure] for measure in CHURN_OPERATIONS
+                if thresholds.get(measure) and values.get(measure) is not None
+                and values[measure] >= thresholds[measure] and CHURN_OPERATIONS[measure] in commands}
+        if not over:
+            logger.debug(f"{table} is within the maintenance thresholds: {values}")
+            continue
+        vacuum = [measure for measure in ('unsorted_pct', 'deleted_pct') if measure in over]
+        operations = []
+        if vacuum:
+            operations.append(('full' if len(vacuum) == 2 else CHURN_OPERATIONS[vacuum[0]], vacuum))
+        if 'stats_off_pct' in over:
+            operations.append(('analyze', ['stats_off_pct']))
+        urgency = max(over.values())
+        for operation, measures in operations:
+            reason = ', '.join(f"{measure} {values[measure]:.1f} >= {thresholds[measure]}" for measure in measures)
+            plan.append({'table': table, 'operation': operation, 'size_mb': values['size_mb'],
+                         'urgency': round(urgency, 2), 'reason': reason})
+    # stable sort: the vacuum of a table stays ahead of its analyze
+    return sorted(plan, key=lambda item: -item['urgency'])
+
+
+def run_maintenance(cur, conn, backend, plan, budget_seconds, seconds_per_gb, clock=time.monotonic):
+    """
+    Runs the planned operations in order while they fit in the time budget. The duration of an operation
+    is estimated from the table size and the seconds per GB observed so far for that operation (or the
+    configured ones), and operations that would overrun the remaining budget are skipped and logged.
+    A started operation always runs to completion. VACUUM cannot run inside a transaction, so the
+    connection is switched to autocommit meanwhile.
+    Arguments:
+        cur: cursor object
+        conn: connection object
+        backend: backend providing maintenance_commands
+        plan: list of operations, see plan_maintenance
+        budget_seconds: total time the operations may take
+        seconds_per_gb: dict of operation -> initial estimate of the seconds per GB of table
+
+    Return:
+        (operations run, operations skipped)
+    """
+    rates = dict(seconds_per_gb)
+    done, skipped = [], []
+    start = clock()
+    conn.commit()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        for item in plan:
+            operation = item['operation']
+            remaining = budget_seconds - (clock() - start)
+            estimate = item['size_mb'] / 1024 * rates[operation]
+            if estimate > remaining:
+                skipped.append(dict(item, estimate_seconds=round(estimate, 1)))
+                logger.info(f"Skipping {operation} of {item['table']} ({item['reason']}): estimated {estimate:.0f}s, "
+                            f"{max(remaining, 0):.0f}s of the budget left")
+                continue
+            began = clock()
+            with stage(f"maintenance:{item['table']}"):
+                cur.execute(backend.maintenance_commands[operation].format(table=item['table']))
+            elapsed = clock() - began
+            if item['size_mb']:
+                rates[operation] = elapsed / (item['size_mb'] / 1024)
+            done.append(dict(item, elapsed_seconds=round(elapsed, 3)))
+            logger.info(f"Ran {operation} of {item['table']} ({item['reason']}) in {elapsed:.1f}s")
+    finally:
+        conn.autocommit = autocommit
+
+    for item in done:
+        metrics.recorder.emit(dict(item, type='maintenance', status='done'))
+    for item in skipped:
+        metrics.recorder.emit(dict(item, type='maintenance', status='skipped'))
+    logger.info(f"Maintenance ran {len(done)} and skipped {len(skipped)} operations in {clock() - start:.1f}s "
+                f"of a {budget_seconds:.0f}s budget")
+    return done, skipped
+
+
+def maintenance_thresholds(config):
+    """
+    Thresholds of the churn measures, e.g. MAINTENANCE.UNSORTED_PCT for unsorted_pct, 10% by default.
+    """
+    return {measure: config.getfloat('MAINTENANCE', measure.upper(), fallback=10) for measure in CHURN_OPERATIONS}
+
+
+def maintenance_stage(cur, conn, backend, config, tables):
+    """
+    Reads the churn of tables and runs the VACUUM and ANALYZE they need, as set in the MAINTENANCE section.
+
+    Return:
+        (operations run, operations skipped)
+    """
+    section = 'MAINTENANCE'
+    vacuum_rate = config.getfloat(section, 'VACUUM_SECONDS_PER_GB', fallback=60)
+    seconds_per_gb = {'sort': vacuum_rate, 'delete': vacuum_rate, 'full': vacuum_rate * 2,
+                      'analyze': config.getfloat(section, 'ANALYZE_SECONDS_PER_GB', fallback=5)}
+    with stage('maintenance_plan'):
+        churn = table_churn(cur, backend, tables)
+    conn.commit()
+    plan = plan_maintenance(churn, maintenance_thresholds(config), backend.maintenance_commands)
+    return run_maintenance(cur, conn, backend, plan, config.getfloat(section, 'BUDGET_SECONDS', fallback=900),
+                           seconds_per_gb)
+
+
+def main():
+    """
+    Runs the VACUUM and ANALYZE operations the fact, dimension and rollup tables need.
+    """
+    from backends import get_backend
+    from connection import connect
+    from metrics import MetricsCursor
+    from sql_queries import insert_table_order, rollup_dimensions
+
+    logging.config.fileConfig("logging.conf")
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('tables', nargs='*', default=insert_table_order + list(rollup_dimensions))
+    parser.add_argument('--dry-run', action='store_true', help='only log the planned operations')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    metrics.configure(config, backend)
+    conn = connect(backend, config, MetricsCursor)
+    cur = conn.cursor()
+    try:
+        if args.dry_run:
+            churn = table_churn(cur, backend, args.tables)
+            for item in plan_maintenance(churn, maintenance_thresholds(config), backend.maintenance_commands):
+                logger.info(f"Would run {item['operation']} of {item['table']} ({item['reason']})")
+        else:
+            maintenance_stage(cur, conn, backend, config, args.tables)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from psycopg2.extensions import cursor
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsRecorder:
+    """
+    Collects one structured record per statement and writes them as JSON lines,
+    optionally summarizing them per stage in a Prometheus textfile.
+    """
+
+    def __init__(self, json_path=None, prometheus_path=None, query_id_query=None):
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.query_id_query = query_id_query
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def current_stage(self):
+        """
+        Name of the stage the current thread is running, 'unknown' outside of a stage.
+        """
+        stages = getattr(self.local, 'stages', None)
+        return stages[-1] if stages else 'unknown'
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Attributes every statement run by the current thread inside the block to the stage name.
+        """
+        if not hasattr(self.local, 'stages'):
+            self.local.stages = []
+        self.local.stages.append(name)
+        try:
+            yield
+        finally:
+            self.local.stages.pop()
+
+    def emit(self, record):
+        """
+        Stores a record and appends it to the JSON lines file, or logs it when no file is configured.
+        """
+        record = dict(record, timestamp=datetime.utcnow().isoformat(timespec='milliseconds'))
+        line = json.dumps(record, default=str, sort_keys=True)
+        with self.lock:
+            self.records.append(record)
+            if self.json_path:
+                with open(self.json_path, 'a') as f:
+                    f.write(line + '\n')
+            else:
+                logger.info(line)
+
+    def summary(self):
+        """
+        Aggregates the statement records per stage.
+
+        Return:
+            dict of stage -> {'seconds', 'rows', 'statements'}
+        """
+        stages = {}
+        with self.lock:
+            for record in self.records:
+                if record.get('type') != 'statement':
+                    continue
+                stage = stages.setdefault(record['stage'], {'seconds': 0.0, 'rows': 0, 'statements': 0})
+                stage['seconds'] += record['elapsed_seconds']
+                stage['rows'] += max(record['rowcount'] or 0, 0)
+                stage['statements'] += 1
+        return stages
+
+    def reset(self):
+        """
+        Forgets the records collected so far, so long running processes summarize one cycle at a time.
+        """
+        with self.lock:
+            self.records = []
+
+    def write_prometheus(self):
+        """
+        Writes the per stage summary in the Prometheus textfile format, replacing the file atomically.
+        """
+        if not self.prometheus_path:
+            return
+        lines = ['# HELP sparkify_etl_stage_duration_seconds Time spent running the statements of a stage.',
+                 '# TYPE sparkify_etl_stage_duration_seconds gauge',
+                 '# HELP sparkify_etl_stage_rows Rows affected by the statements of a stage.',
+                 '# TYPE sparkify_etl_stage_rows gauge',
+                 '# HELP sparkify_etl_stage_statements Statements run by a stage.',
+                 '# TYPE sparkify_etl_stage_statements gauge']
+        for stage, values in sorted(self.summary().items()):
+            lines.append(f'sparkify_etl_stage_duration_seconds{{stage="{stage}"}} {values["seconds"]:.6f}')
+            lines.append(f'sparkify_etl_stage_rows{{stage="{stage}"}} {values["rows"]}')
+            lines.append(f'sparkify_etl_stage_statements{{stage="{stage}"}} {values["statements"]}')
+        lines.append(f'sparkify_etl_last_run_timestamp_seconds {time.time():.0f}')
+        temporary = self.prometheus_path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temporary, self.prometheus_path)
+
+
+recorder = MetricsRecorder()
+
+
+def configure(config, backend=None):
+    """
+    Points the module recorder at the outputs of the METRICS section of the config.
+    """
+    global recorder
+    recorder = MetricsRecorder(config.get('METRICS', 'JSON_PATH', fallback=None),
+                               config.get('METRICS', 'PROMETHEUS_PATH', fallback=None),
+                               getattr(backend, 'query_id_query', None))
+    return recorder
+
+
+def stage(name):
+    """
+    Context manager attributing the statements of the current thread to a stage.
+    """
+    return recorder.stage(name)
+
+
+def statement_summary(query):
+    """
+    First line of a statement, used to identify it in the records.
+    """
+    lines = [line.strip() for line in str(query).strip().splitlines() if line.strip()]
+    return lines[0][:200] if lines else ''
+
+
+class MetricsCursor(cursor):
+    """
+    Cursor recording elapsed time, row count, backend query id and stage of every statement it runs.
+    Pass it as cursor_factory to psycopg2.connect or to a connection pool.
+    """
+
+    def _record(self, query, start, error=None):
+        elapsed = time.perf_counter() - start
+        query_id = None
+        if error is None and recorder.query_id_query:
+            with self.connection.cursor(cursor_factory=cursor) as id_cursor:
+                id_cursor.execute(recorder.query_id_query)
+                query_id = id_cursor.fetchone()[0]
+        recorder.emit({'type': 'statement', 'stage': recorder.current_stage(), 'statement': statement_summary(query),
+                       'elapsed_seconds': round(elapsed, 6), 'rowcount': self.rowcount, 'query_id': query_id,
+                       'error': str(error) if error else None})
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except Exception as e:
+            self._record(query, start, e)
+            raise
+        self._record(query, start)
+        return result
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            result = super().executemany(query, vars_list)
+        except Exception as e:
+            self._record(query, start, e)
+            raise
+        self._record(query, start)
+        return result
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            result = super().copy_expert(sql, file, size)
+        except Exception as e:
+            self._record(sql, start, e)
+            raise
+        self._record(sql, start)
+        return result
@@ -0,0 +1,427 @@
+import argparse
+import configparser
+import json
+import logging.config
+import math
+import os
+import re
+from decimal import Decimal
+
+from compression import CREATE_TABLE, saving
+from file_splitter import read_lines
+from incremental import list_source_files
+from sql_queries import create_table_queries, profile_groups, profiled_columns, staging_columns
+
+logger = logging.getLogger(__name__)
+
+# column name, then its data type with optional length/precision, then an optional IDENTITY
+COLUMN_TYPE = re.compile(r'^(\s*([a-z_]\w*)\s+)((BIGINT|INTEGER|INT|SMALLINT|VARCHAR|CHAR|NUMERIC|DECIMAL|FLOAT4|'
+                         r'FLOAT8|FLOAT|REAL|TIMESTAMP|DATE|BOOLEAN)\b(?:\s*\(([^)]*)\))?)(\s+IDENTITY\b)?',
+                         re.IGNORECASE | re.MULTILINE)
+NUMBER = re.compile(r'^\s*-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\s*$')
+# identifiers and counters keep their declared integer type, their range growing with the data: every new user
+# and session, longer sessions, files holding more songs
+ID_COLUMN = re.compile(r'(^|_)id$')
+COUNTER_COLUMNS = {'item_in_session', 'num_songs'}
+
+# integer types from the narrowest, with their largest value
+INTEGER_TYPES = [('SMALLINT', 2 ** 15 - 1), ('INT', 2 ** 31 - 1), ('BIGINT', 2 ** 63 - 1)]
+FLOAT_TYPES = {'FLOAT4', 'REAL', 'FLOAT8', 'FLOAT'}
+# bytes a value takes in memory, for the fixed width types
+TYPE_WIDTHS = {'SMALLINT': 2, 'INT': 4, 'INTEGER': 4, 'BIGINT': 8, 'FLOAT4': 4, 'REAL': 4, 'FLOAT8': 8, 'FLOAT': 8,
+               'BOOLEAN': 1, 'TIMESTAMP': 8, 'DATE': 4}
+
+
+class ColumnProfile:
+    """
+    Running statistics of one column of the source JSON: rows seen, NULL or empty values, longest value
+    in bytes, and for numbers their range, integer digits and decimal places. Memory stays constant
+    however many rows are profiled.
+    """
+
+    def __init__(self, rows=0, nulls=0, max_bytes=0, texts=0, low=None, high=None, integer_digits=0, scale=0):
+        self.rows = rows
+        self.nulls = nulls
+        self.max_bytes = max_bytes
+        self.texts = texts
+        self.low = low
+        self.high = high
+        self.integer_digits = integer_digits
+        self.scale = scale
+
+    def add(self, value):
+        """
+        Adds a value, empty strings counting as NULL like COPY loads them.
+        """
+        self.rows += 1
+        if value is None or value == '':
+            self.nulls += 1
+            return
+        text = str(value)
+        self.max_bytes = max(self.max_bytes, len(text.encode('utf-8')))
+        if isinstance(value, bool) or not (isinstance(value, (int, Decimal)) or NUMBER.match(text)):
+            self.texts += 1
+            return
+        number = Decimal(text.strip())
+        self.low = number if self.low is None else min(self.low, number)
+        self.high = number if self.high is None else max(self.high, number)
+        _, digits, exponent = number.as_tuple()
+        self.integer_digits = max(self.integer_digits, len(digits) + exponent)
+        self.scale = max(self.scale, -exponent)
+
+    def merge(self, other):
+        """
+        Adds the statistics of another profile, e.g. of a column sized together with this one.
+        """
+        self.rows += other.rows
+        self.nulls += other.nulls
+        self.max_bytes = max(self.max_bytes, other.max_bytes)
+        self.texts += other.texts
+        if other.low is not None:
+            self.low = other.low if self.low is None else min(self.low, other.low)
+            self.high = other.high if self.high is None else max(self.high, other.high)
+        self.integer_digits = max(self.integer_digits, other.integer_digits)
+        self.scale = max(self.scale, other.scale)
+
+    def summary(self):
+        """
+        Statistics written to the profile report.
+        """
+        return {'rows': self.rows, 'null_rate': round(self.nulls / self.rows, 4) if self.rows else None,
+                'max_bytes': self.max_bytes, 'non_numeric': self.texts,
+                'min': None if self.low is None else float(self.low),
+                'max': None if self.high is None else float(self.high), 'scale': self.scale}
+
+
+def sample_files(files, max_files=0):
+    """
+    Picks up to max_files files spread evenly over the dataset, all of them when max_files is 0.
+    """
+    if not max_files or len(files) <= max_files:
+        return files
+    step = len(files) / max_files
+    return [files[int(index * step)] for index in range(max_files)]
+
+
+def profile_source(urls, columns, s3_client=None, sample_rows=0):
+    """
+    Profiles the staging columns of newline delimited JSON files, streaming them one line at a time.
+    Numbers are parsed as decimals, so their digits are profiled exactly as written.
+    Arguments:
+        urls: local paths or s3:// urls of the files
+        columns: list of (staging column, JSON key), see staging_columns
+        s3_client: boto3 S3 client, required for s3:// urls
+        sample_rows: rows profiled at most, 0 for all of them
+
+    Return:
+        dict of staging column -> ColumnProfile
+    """
+    profiles = {column: ColumnProfile() for column, _ in columns}
+    rows = 0
+    for url in urls:
+        for line in read_lines(url, s3_client):
+            record = json.loads(line, parse_float=Decimal)
+            for column, key in columns:
+                profiles[column].add(record.get(key))
+            rows += 1
+            if sample_rows and rows >= sample_rows:
+                return profiles
+    return profiles
+
+
+def column_profiles(profiles):
+    """
+    Profiles of every staging, fact and dimension column loaded from the profiled staging columns.
+    Columns loaded from the same staging column, or sized together by profile_groups, share one profile,
+    so joined and compared columns get the same type.
+    Arguments:
+        profiles: dict of (staging table, staging column) -> ColumnProfile
+
+    Return:
+        dict of (table, column) -> ColumnProfile
+    """
+    sources = dict(profiles)
+    for group in profile_groups:
+        merged = ColumnProfile()
+        for source in group:
+            if source in profiles:
+                merged.merge(profiles[source])
+        sources.update({source: merged for source in group if source in profiles})
+    result = dict(sources)
+    for table, columns in profiled_columns.items():
+        result.update({(table, column): sources[source] for column, source in columns.items() if source in sources})
+    return result
+
+
+def declared_types(queries=create_table_queries):
+    """
+    Data types of the columns of CREATE TABLE statements, identity columns left out.
+
+    Return:
+        dict of (table, column) -> (data type, arguments or None)
+    """
+    types = {}
+    for query in queries:
+        table = CREATE_TABLE.search(query).group(1).lower()
+        for match in COLUMN_TYPE.finditer(query):
+            if not match.group(6):
+                types[(table, match.group(2).lower())] = (match.group(4).upper(), match.group(5))
+    return types
+
+
+def sized_type(data_type, profile, exact=False, headroom=1.25, range_headroom=10, max_scale=6, length=None,
+               varchar_floor=64, keep_integer=False):
+    """
+    Smallest type of the same family holding every profiled value with some headroom:
+    VARCHAR lengths get headroom (rounded up to a multiple of 8), CHAR the longest value, integers the
+    narrowest type holding range_headroom times the largest magnitude, and NUMERIC the observed decimal
+    places (at most max_scale) plus one spare integer digit. Floating point columns sized together with a
+    NUMERIC one (exact) take that NUMERIC type, so values are not rounded through FLOAT4 on their way.
+    VARCHARs only shrink down to varchar_floor and grow past their declared length only when a profiled
+    value does not fit it, and integers keep their declared type with keep_integer, see integer_fallback.
+    Arguments:
+        data_type: declared data type, e.g. 'VARCHAR'
+        profile: ColumnProfile of the column
+        exact: whether the column shares its profile with a NUMERIC column
+        length: declared length of a VARCHAR, None when not declared
+        varchar_floor: shortest VARCHAR length given to a column
+        keep_integer: whether an integer column keeps its declared type
+
+    Return:
+        Type definition, e.g. 'VARCHAR(64)', None to keep the declared type
+    """
+    if profile is None or profile.rows == profile.nulls:
+        return None
+    if data_type == 'VARCHAR':
+        sized = max(varchar_floor, math.ceil(profile.max_bytes * headroom / 8) * 8)
+        if length is not None and profile.max_bytes <= length:
+            sized = min(sized, length)
+        return None if sized == length else f"VARCHAR({sized})"
+    if data_type == 'CHAR':
+        return f"CHAR({profile.max_bytes})"
+    if profile.texts:
+        return None
+    if data_type in ('SMALLINT', 'INT', 'INTEGER', 'BIGINT'):
+        if profile.scale or keep_integer:
+            return None
+        bound = max(abs(profile.low), abs(profile.high)) * range_headroom
+        return next((name for name, maximum in INTEGER_TYPES if bound <= maximum), None)
+    if data_type in ('NUMERIC', 'DECIMAL') or (data_type in FLOAT_TYPES and exact):
+        scale = min(profile.scale, max_scale)
+        return f"NUMERIC({min(38, max(profile.integer_digits, 0) + 1 + scale)},{scale})"
+    return None
+
+
+def integer_fallback(column, sampled=False):
+    """
+    Why an integer column keeps its declared type instead of the narrowest one holding its profiled range:
+    'identifier' or 'counter' when its range grows with the data, so a later load would overflow a type sized
+    from today's values, 'sampled' when the profile does not cover the whole dataset.
+
+    Return:
+        The reason, None when the column can be narrowed
+    """
+    if ID_COLUMN.search(column):
+        return 'identifier'
+    if column in COUNTER_COLUMNS:
+        return 'counter'
+    return 'sampled' if sampled else None
+
+
+def integer_fallbacks(profiles, queries=create_table_queries, sampled=False):
+    """
+    Profiled integer columns of CREATE TABLE statements keeping their declared type, see integer_fallback.
+
+    Return:
+        dict of 'table.column' -> reason
+    """
+    fallbacks = {}
+    for (table, column), (data_type, _) in declared_types(queries).items():
+        reason = integer_fallback(column, sampled)
+        if data_type in ('SMALLINT', 'INT', 'INTEGER', 'BIGINT') and (table, column) in profiles and reason:
+            fallbacks[f"{table}.{column}"] = reason
+    return fallbacks
+
+
+def column_types(profiles, queries=create_table_queries, headroom=1.25, range_headroom=10, max_scale=6,
+                 varchar_floor=64, sampled=False):
+    """
+    Right-sized types of the profiled columns of CREATE TABLE statements.
+    Arguments:
+        profiles: dict of (table, column) -> ColumnProfile, see column_profiles
+        varchar_floor: shortest VARCHAR length given to a column, see sized_type
+        sampled: whether the profiles only cover a sample, integers then keep their declared types
+
+    Return:
+        dict of table -> dict of column -> type definition
+    """
+    declared = declared_types(queries)
+    exact = {id(profiles[key]) for key, (data_type, _) in declared.items()
+             if key in profiles and data_type in ('NUMERIC', 'DECIMAL')}
+    types = {}
+    for (table, column), (data_type, arguments) in declared.items():
+        profile = profiles.get((table, column))
+        length = int(arguments) if data_type == 'VARCHAR' and arguments and arguments.strip().isdigit() else None
+        sized = sized_type(data_type, profile, id(profile) in exact, headroom, range_headroom, max_scale, length,
+                           varchar_floor, integer_fallback(column, sampled) is not None)
+        if sized is not None:
+            types.setdefault(table, {})[column] = sized
+    return types
+
+
+def apply_column_types(create_query, types):
+    """
+    Rewrites the data types of the columns of a CREATE TABLE statement found in types.
+    """
+    def retype(match):
+        column = match.group(2).lower()
+        if match.group(6) or column not in types:
+            return match.group(0)
+        return f"{match.group(1)}{types[column]}"
+    return COLUMN_TYPE.sub(retype, create_query)
+
+
+def type_width(data_type, arguments=None):
+    """
+    Bytes a value of a type takes in memory: the declared length of character types, 8 bytes for
+    NUMERIC up to 19 digits (the Redshift default being NUMERIC(18,0)) and 16 beyond.
+    """
+    if data_type == 'VARCHAR':
+        return int(arguments) if arguments else 256
+    if data_type == 'CHAR':
+        return int(arguments) if arguments else 1
+    if data_type in ('NUMERIC', 'DECIMAL'):
+        precision = int(arguments.split(',')[0]) if arguments else 18
+        return 8 if precision <= 19 else 16
+    return TYPE_WIDTHS.get(data_type, 8)
+
+
+def row_widths(query):
+    """
+    Declared width of every column of a CREATE TABLE statement, identity columns included.
+    """
+    return {match.group(2).lower(): type_width(match.group(4).upper(), match.group(5))
+            for match in COLUMN_TYPE.finditer(query)}
+
+
+def width_report(types, queries=create_table_queries):
+    """
+    Projects the declared row width of every table before and after right-sizing, the width Redshift
+    reserves per row in hash joins, sorts and aggregations.
+
+    Return:
+        dict of table -> widths, saving in percent and the changed column types
+    """
+    report = {}
+    for query in queries:
+        table = CREATE_TABLE.search(query).group(1).lower()
+        if table not in types:
+            continue
+        before = row_widths(query)
+        after = row_widths(apply_column_types(query, types[table]))
+        declared = {match.group(2).lower(): match.group(3) for match in COLUMN_TYPE.finditer(query)}
+        report[table] = {'row_width': sum(before.values()), 'sized_row_width': sum(after.values()),
+                         'saving_pct': saving(sum(before.values()), sum(after.values())),
+                         'changes': {column: [declared[column], sized] for column, sized in types[table].items()
+                                     if sized.replace(' ', '').upper() != declared[column].replace(' ', '').upper()}}
+    return report
+
+
+def read_column_types(path):
+    """
+    Reads the types written by profiler.py: dict of table -> dict of column -> type definition.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def typed_create_queries(config, queries):
+    """
+    Applies the column types selected by ETL.COLUMN_TYPES to CREATE TABLE statements: 'declared'
+    (default) keeps the types of sql_queries.py, 'profiled' uses the ones written to ETL.COLUMN_TYPES_FILE.
+    """
+    mode = config.get('ETL', 'COLUMN_TYPES', fallback='declared')
+    if mode == 'declared':
+        return list(queries)
+    if mode != 'profiled':
+        raise ValueError(f"Unknown column types mode {mode}, expected 'declared' or 'profiled'")
+    path = config.get('ETL', 'COLUMN_TYPES_FILE', fallback='column_types.json')
+    if not os.path.exists(path):
+        logger.warning(f"{path} not found, using the declared column types")
+        return list(queries)
+    types = read_column_types(path)
+    return [apply_column_types(query, types.get(CREATE_TABLE.search(query).group(1).lower(), {}))
+            for query in queries]
+
+
+def main():
+    """
+    Profiles the source JSON and writes right-sized column types and the projected row width savings.
+    """
+    import boto3
+    from backends import get_backend
+
+    logging.config.fileConfig("logging.conf")
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--output', default='profile_report.json')
+    parser.add_argument('--ddl', action='store_true', help='print the right-sized CREATE TABLE statements')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    section = 'PROFILE'
+    sample_rows = config.getint(section, 'SAMPLE_ROWS', fallback=0)
+    max_files = config.getint(section, 'SAMPLE_FILES', fallback=0)
+    s3_client = None
+    if backend.log_data().startswith('s3://'):
+        s3_client = boto3.client('s3', region_name='us-west-2', aws_access_key_id=config.get('AWS', 'KEY'),
+                                 aws_secret_access_key=config.get('AWS', 'SECRET'))
+
+    sources = {'staging_events_table': backend.log_data(), 'staging_songs_table': backend.song_data()}
+    profiles = {}
+    sampled = []
+    for table, source in sources.items():
+        source_files = list_source_files(source, s3_client=s3_client)
+        files = sample_files(source_files, max_files)
+        logger.info(f"Profiling {table} from {len(files)} files of {source}")
+        table_profiles = profile_source([url for url, _ in files], staging_columns[table], s3_client, sample_rows)
+        profiles.update({(table, column): profile for column, profile in table_profiles.items()})
+        rows = max((profile.rows for profile in table_profiles.values()), default=0)
+        if len(files) < len(source_files) or (sample_rows and rows >= sample_rows):
+            sampled.append(table)
+
+    profiles_by_column = column_profiles(profiles)
+    types = column_types(profiles_by_column, create_table_queries,
+                         config.getfloat(section, 'HEADROOM', fallback=1.25),
+                         config.getfloat(section, 'RANGE_HEADROOM', fallback=10),
+                         config.getint(section, 'MAX_SCALE', fallback=6),
+                         config.getint(section, 'VARCHAR_FLOOR', fallback=64), bool(sampled))
+    path = config.get('ETL', 'COLUMN_TYPES_FILE', fallback='column_types.json')
+    with open(path, 'w') as f:
+        json.dump(types, f, indent=2, sort_keys=True)
+    logger.info(f"Wrote the profiled column types to {path}")
+
+    widths = width_report(types)
+    for table, values in widths.items():
+        logger.info(f"{table}: declared row width {values['row_width']} -> {values['sized_row_width']} bytes "
+                    f"({values['saving_pct']}%)")
+    report = {'columns': {f"{table}.{column}": profile.summary() for (table, column), profile in profiles.items()},
+              'tables': widths, 'sampled': sampled,
+              'kept_integer_types': integer_fallbacks(profiles_by_column, create_table_queries, bool(sampled))}
+    if sampled:
+        report['warning'] = (f"{', '.join(sampled)} sized from a sample: integers keep their declared types, and a "
+                             f"later value longer than its VARCHAR fails the load. Profile the whole dataset with "
+                             f"SAMPLE_FILES = 0 and SAMPLE_ROWS = 0 before using COLUMN_TYPES = profiled.")
+        logger.warning(report['warning'])
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    logger.info(f"Wrote the profile report to {args.output}")
+
+    if args.ddl:
+        for query in create_table_queries:
+            print(apply_column_types(query, types.get(CREATE_TABLE.search(query).group(1).lower(), {})))
+
+
+if __name__ == '__main__':
+    main()
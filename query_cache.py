@@ -0,0 +1,341 @@
+import argparse
+import configparser
+import hashlib
+import logging.config
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import metrics
+from sql_queries import (table_versions_existing, table_versions_insert, table_versions_lock, table_versions_select,
+                         table_versions_update)
+
+logger = logging.getLogger(__name__)
+
+# pseudo table versioning the catalog, changed whenever create_tables.py recreates the schema
+CATALOG = 'catalog'
+CATALOG_TABLE = re.compile(r'^(?:pg_catalog\.|information_schema\.|pg_)', re.IGNORECASE)
+# catalog relations and system views changing with every load or statement, never cached
+STATISTICS_TABLE = re.compile(r'^(?:pg_catalog\.)?(?:pg_class|pg_stat\w*|svv_\w+|stv_\w+|stl_\w+|svl_\w+)$',
+                              re.IGNORECASE)
+
+STRING_OR_TEXT = re.compile(r"('(?:[^']|'')*')|([^']+)", re.DOTALL)
+COMMENT = re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL)
+# FROM/JOIN followed by one table or a comma separated list of tables, each with an optional alias
+TABLE_LIST = re.compile(r'\b(?:from|join)\s+([a-z_][\w.]*(?:\s+(?:as\s+)?[a-z_]\w*)?'
+                        r'(?:\s*,\s*[a-z_][\w.]*(?:\s+(?:as\s+)?[a-z_]\w*)?)*)')
+# functions taking a FROM inside their arguments, e.g. EXTRACT(HOUR FROM start_time)
+FROM_FUNCTION = re.compile(r'\b(?:extract|substring|trim|overlay|position)\s*\([^()]*\)')
+CTE_NAME = re.compile(r'(?:\bwith|,)\s+([a-z_]\w*)\s+as\s*\(')
+READ_QUERY = re.compile(r'^\s*(?:select|with)\b')
+SELECT_INTO = re.compile(r'\binto\s')
+# results of these change between two runs of the same query on the same data
+VOLATILE = re.compile(r'\b(?:now|getdate|sysdate|random|current_date|current_time|current_timestamp|'
+                      r'timeofday|nextval)\b')
+
+
+def normalize_sql(query):
+    """
+    Normalizes a query so that formatting differences do not miss the cache: comments are removed,
+    whitespace is collapsed and the text outside string literals is lower cased.
+    """
+    parts = []
+    for literal, text in STRING_OR_TEXT.findall(query):
+        parts.append(literal or re.sub(r'\s+', ' ', COMMENT.sub(' ', text)).lower())
+    return ' '.join(''.join(parts).split()).rstrip(';').strip()
+
+
+def referenced_tables(query):
+    """
+    Tables a normalized query reads. Catalog tables and views are reported as the catalog pseudo table,
+    and names defined by a WITH clause are left out.
+
+    Return:
+        set of table names, None when the query reads statistics that change without a load
+    """
+    tables = set()
+    for table_list in TABLE_LIST.findall(FROM_FUNCTION.sub(' ', query)):
+        for reference in table_list.split(','):
+            name = reference.split()[0]
+            if STATISTICS_TABLE.match(name):
+                return None
+            tables.add(CATALOG if CATALOG_TABLE.match(name) else name.split('.')[-1])
+    return tables - set(CTE_NAME.findall(query))
+
+
+def bump_versions(cur, conn, tables):
+    """
+    Gives tables a new data version, invalidating every cached result read from them.
+    Called by the loading stages once their changes are committed. Existing versions are updated in
+    place and only the missing tables inserted, under a lock held until the commit, so concurrent
+    loads never insert the same table twice.
+    """
+    tables = sorted(set(tables))
+    if not tables:
+        return
+    version = time.time_ns()
+    now = datetime.utcnow()
+    cur.execute(table_versions_lock)
+    cur.execute(table_versions_update, (version, now, tuple(tables)))
+    cur.execute(table_versions_existing, (tuple(tables),))
+    existing = {row[0] for row in cur.fetchall()}
+    missing = [(table, version, now) for table in tables if table not in existing]
+    if missing:
+        cur.executemany(table_versions_insert, missing)
+    conn.commit()
+    logger.debug(f"Bumped the data version of {tables} to {version}")
+
+
+class ResultCache:
+    """
+    Client side cache of query results, keyed on the normalized SQL, its parameters and the data version
+    of every table the query reads, so a result is reused until one of its tables is loaded again.
+    Queries reading tables without a version in table_versions always run on the warehouse.
+    Results are kept in a size bounded LRU in memory and, when a directory is given, in pickle files
+    surviving the process. Table versions are read from the warehouse at most every version_ttl seconds.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024, directory=None,
+                 max_disk_bytes=512 * 1024 * 1024, version_ttl=30, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.version_ttl = version_ttl
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (pickled (columns, rows), size)
+        self.bytes = 0
+        self.versions = None
+        self.versions_read_at = None
+        self.lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = self.uncacheable = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def table_versions(self, cur):
+        """
+        Data version of every table, re-read from table_versions once version_ttl seconds have passed.
+        """
+        now = self.clock()
+        if self.versions is None or now - self.versions_read_at >= self.version_ttl:
+            cur.execute(table_versions_select)
+            self.versions = dict(cur.fetchall())
+            self.versions_read_at = now
+        return self.versions
+
+    def invalidate(self):
+        """
+        Forces the table versions to be re-read by the next query, e.g. right after a load.
+        """
+        self.versions = None
+
+    def key(self, cur, query, params=None):
+        """
+        Cache key of a query, None when its result must not be cached: statements other than SELECT,
+        volatile functions, or tables without a data version.
+        """
+        normalized = normalize_sql(query)
+        if not READ_QUERY.match(normalized) or VOLATILE.search(normalized) or SELECT_INTO.search(normalized):
+            return None
+        tables = referenced_tables(normalized)
+        if tables is None:
+            return None
+        versions = self.table_versions(cur)
+        if any(table not in versions for table in tables):
+            return None
+        tables = sorted(tables)
+        text = repr((normalized, params, [(table, versions[table]) for table in tables]))
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Cached (columns, rows) of a key, from memory or disk, None on a miss.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return pickle.loads(self.entries[key][0])
+        path = self.path(key)
+        if path:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)
+            except FileNotFoundError:
+                data = None
+            if data is not None:
+                self.remember(key, data)
+                with self.lock:
+                    self.disk_hits += 1
+                return pickle.loads(data)
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, columns, rows):
+        """
+        Caches a result in memory and on disk. Results larger than the memory bound are not cached.
+        """
+        data = pickle.dumps((columns, rows), protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        self.remember(key, data)
+        path = self.path(key)
+        if path:
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            self.trim_disk()
+
+    def remember(self, key, data):
+        """
+        Stores a pickled result in memory, evicting the least recently used ones beyond the bounds.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (data, len(data))
+            self.bytes += len(data)
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                self.bytes -= self.entries.popitem(last=False)[1][1]
+
+    def path(self, key):
+        """
+        File holding a result on disk, None without a disk tier.
+        """
+        return os.path.join(self.directory, f"{key}.pickle") if self.directory else None
+
+    def trim_disk(self):
+        """
+        Removes the least recently read result files until the disk tier fits max_disk_bytes.
+        Results of old table versions are never read again, so they are the first to go.
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle'):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def execute(self, cur, query, params=None):
+        """
+        Returns the result of a read query from the cache, running it on the warehouse on a miss.
+        Arguments:
+            cur: cursor object
+            query: SQL statement
+            params: optional query parameters
+
+        Return:
+            (list of column names, list of rows)
+        """
+        key = self.key(cur, query, params)
+        if key is not None:
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+        else:
+            with self.lock:
+                self.uncacheable += 1
+        cur.execute(query, params)
+        columns = [column[0] for column in cur.description] if cur.description else []
+        rows = cur.fetchall() if cur.description else []
+        if key is not None:
+            self.put(key, columns, rows)
+        return columns, rows
+
+    def fetchall(self, cur, query, params=None):
+        """
+        Rows of a read query, from the cache when possible.
+        """
+        return self.execute(cur, query, params)[1]
+
+    def clear(self):
+        """
+        Empties the memory and disk tiers.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+        if self.directory:
+            for name in os.listdir(self.directory):
+                if name.endswith('.pickle'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def report(self):
+        """
+        Logs and emits the hits and misses so far.
+
+        Return:
+            dict of counters
+        """
+        counters = {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'uncacheable': self.uncacheable, 'entries': len(self.entries), 'bytes': self.bytes}
+        metrics.recorder.emit(dict(counters, type='query_cache'))
+        lookups = self.hits + self.disk_hits + self.misses
+        if lookups:
+            logger.info(f"Query cache: {self.hits + self.disk_hits} of {lookups} lookups served from the cache "
+                        f"({self.disk_hits} from disk), {len(self.entries)} results in memory ({self.bytes} bytes)")
+        return counters
+
+
+def cache_from_config(config):
+    """
+    Builds the result cache described by the CACHE section of dwh.cfg.
+    """
+    section = 'CACHE'
+    return ResultCache(max_entries=config.getint(section, 'MAX_ENTRIES', fallback=256),
+                       max_bytes=config.getint(section, 'MAX_MB', fallback=64) * 1024 * 1024,
+                       directory=config.get(section, 'DIRECTORY', fallback='') or None,
+                       max_disk_bytes=config.getint(section, 'DISK_MAX_MB', fallback=512) * 1024 * 1024,
+                       version_ttl=config.getfloat(section, 'VERSION_TTL', fallback=30))
+
+
+def main():
+    """
+    Runs read queries through the result cache, or empties its disk tier with --clear.
+    """
+    from backends import get_backend
+    from connection import connect
+
+    logging.config.fileConfig("logging.conf")
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('queries', nargs='*', help='SELECT statements to run')
+    parser.add_argument('--clear', action='store_true', help='remove the cached results from disk')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    cache = cache_from_config(config)
+    if args.clear:
+        cache.clear()
+        logger.info(f"Cleared the result cache")
+    if not args.queries:
+        return
+
+    backend = get_backend(config)
+    conn = connect(backend, config)
+    cur = conn.cursor()
+    for query in args.queries:
+        start = time.perf_counter()
+        columns, rows = cache.execute(cur, query)
+        logger.info(f"{len(rows)} rows in {time.perf_counter() - start:.3f}s: {query}")
+    conn.commit()
+    conn.close()
+    cache.report()
+
+
+if __name__ == '__main__':
+    main()
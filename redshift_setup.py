@@ -2,6 +2,7 @@ import configparser
 import json
 import logging.config
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 
@@ -13,18 +14,92 @@ logger = logging.getLogger(__name__)
 config = configparser.ConfigParser()
 config.read('dwh.cfg')
 
-KEY = config.get('AWS', 'KEY')
-SECRET = config.get('AWS', 'SECRET')
+# Missing keys fall back to the default boto3 credential chain
+KEY = config.get('AWS', 'KEY', fallback=None)
+SECRET = config.get('AWS', 'SECRET', fallback=None)
+
+S3_READ_ONLY_POLICY = "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
+
+# States from which the cluster will not become available without intervention
+CLUSTER_FAILED_STATES = ('incompatible-network', 'incompatible-hsm', 'incompatible-restore',
+                         'insufficient-capacity', 'hardware-failure')
+
+
+def cluster_settings(config):
+    """
+    Reads the cluster settings of the DWH section.
+    """
+    return {'cluster_identifier': config.get('DWH', 'DWH_CLUSTER_IDENTIFIER'),
+            'cluster_type': config.get('DWH', 'DWH_CLUSTER_TYPE'),
+            'node_type': config.get('DWH', 'DWH_NODE_TYPE'),
+            'cluster_size': config.getint('DWH', 'DWH_NUM_NODES'),
+            'db_name': config.get('DWH', 'DWH_DB'),
+            'db_user': config.get('DWH', 'DWH_DB_USER'),
+            'db_password': config.get('DWH', 'DWH_DB_PASSWORD'),
+            'port': config.getint('DWH', 'DWH_PORT'),
+            'role_name': config.get('DWH', 'DWH_IAM_ROLE_NAME'),
+            'security_group': config.get('DWH', 'DWH_SECURITY_GROUP'),
+            'timeout': config.getint('DWH', 'DWH_WAIT_TIMEOUT', fallback=1800)}
+
+
+def error_code(error):
+    """
+    Returns the AWS error code of a botocore ClientError, None for other exceptions.
+    """
+    return getattr(error, 'response', {}).get('Error', {}).get('Code')
+
+
+# Wait with exponential backoff
+def wait_until(check, description, timeout=1800, initial_delay=5, max_delay=60, sleep=time.sleep,
+               clock=time.monotonic):
+    """
+    Calls check until it returns a truthy value, doubling the delay between calls up to max_delay.
+    Arguments:
+        check: callable returning the awaited value, or a falsy value to keep waiting
+        description: what is waited for, used in log and error messages
+        timeout: overall number of seconds to wait
+        initial_delay: seconds to wait after the first check
+        max_delay: longest wait between two checks
+
+    Return:
+        The value returned by check
+    """
+    deadline = clock() + timeout
+    delay = initial_delay
+    while True:
+        result = check()
+        if result:
+            return result
+        remaining = deadline - clock()
+        if remaining <= 0:
+            raise TimeoutError(f"Timed out after {timeout}s waiting for {description}")
+        logger.info(f"Waiting {min(delay, remaining):.0f}s for {description}")
+        sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
 
 
 # Create IAM role
-def create_iam_role(iam_client):
-    role_name = config.get("DWH", "DWH_IAM_ROLE_NAME")
-    logger.info("Creating IAM role")
+def ensure_iam_role(iam_client, role_name):
+    """
+    Creates the IAM role Redshift assumes to read from S3, unless it already exists, and attaches the
+    S3 read only policy to it.
+    Arguments:
+        iam_client: an IAM service client instance
+        role_name: name of the role
+
+    Return:
+        ARN of the role
+    """
     try:
-        response = iam_client.create_role(
+        role = iam_client.get_role(RoleName=role_name)['Role']
+        logger.info(f"IAM role {role_name} already exists")
+    except Exception as e:
+        if error_code(e) != 'NoSuchEntity':
+            raise
+        logger.info(f"Creating IAM role {role_name}")
+        role = iam_client.create_role(
             Path='/',
-            RoleName='{}'.format(role_name),
+            RoleName=role_name,
             Description="Allows Redshift clusters to call AWS services on your behalf.",
             AssumeRolePolicyDocument=json.dumps(
                 {
@@ -38,91 +113,55 @@ def create_iam_role(iam_client):
                 indent=4,
                 separators=(',', ': ')
             )
-        )
-        logger.debug(f"Response from create_role: {response}")
-        logger.info(f"Role create response: {response['ResponseMetadata']['HTTPStatusCode']}")
-
-        # Attach policy to IAM role
-        try:
-            response = iam_client.attach_role_policy(
-                RoleName='{}'.format(role_name),
-                PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
-            )
-            logger.debug(f"Response from attach_role_policy: {response}")
-            logger.info(f"Policy attach response: {response['ResponseMetadata']['HTTPStatusCode']}")
-            return response['ResponseMetadata']['HTTPStatusCode']
-            # role_arn = iam.get_role(RoleName=DWH_IAM_ROLE_NAME)['Role']['Arn']
-        except Exception as e:
-            logger.error(f"Error attaching policy to IAM role: {e}")
-            return False
-    except Exception as e:
-        logger.error(f"Error creating IAM role: {e}")
-        return False
+        )['Role']
+
+    # Attaching an already attached policy is a no-op
+    iam_client.attach_role_policy(RoleName=role_name, PolicyArn=S3_READ_ONLY_POLICY)
+    logger.info(f"Role ARN: {role['Arn']}")
+    return role['Arn']
 
 
-# Get IAM role ARN
-def get_iam_role_arn(iam_client):
-    role_name = config.get("DWH", "DWH_IAM_ROLE_NAME")
+# Create ec2 security group
+def ensure_security_group(ec2_client, group_name, port):
+    """
+    Creates the EC2 security group opening the cluster port, unless it already exists.
+    Arguments:
+        ec2_client: an EC2 service client instance
+        group_name: name of the security group
+        port: port of the cluster
+
+    Return:
+        Id of the security group
+    """
+    groups = ec2_client.describe_security_groups(
+        Filters=[{'Name': 'group-name', 'Values': [group_name]}])['SecurityGroups']
+    if groups:
+        group_id = groups[0]['GroupId']
+        logger.info(f"Security group {group_name} already exists")
+    else:
+        logger.info(f"Creating security group {group_name}")
+        group_id = ec2_client.create_security_group(GroupName=group_name,
+                                                    Description='Security group for Redshift cluster')['GroupId']
     try:
-        response = iam_client.get_role(
-            RoleName='{}'.format(role_name)
-        )
-        logger.debug(f"Response from get_role: {response}")
-        logger.info(f"Role ARN: {response['Role']['Arn']}")
-        return response['Role']['Arn']
+        ec2_client.authorize_security_group_ingress(GroupId=group_id, IpProtocol='tcp', FromPort=port, ToPort=port,
+                                                    CidrIp='0.0.0.0/0')
+        logger.info(f"Opened port {port} in security group {group_name}")
     except Exception as e:
-        logger.error(f"Error getting IAM role ARN: {e}")
-        return False
+        if error_code(e) != 'InvalidPermission.Duplicate':
+            raise
+    return group_id
 
 
-# Create Redshift cluster
-def create_redshift_cluster(redshift_client, iam_role_arn, cluster_type, node_type, cluster_size, db_name, db_user,
-                            db_password):
+def describe_cluster(redshift_client, cluster_identifier):
+    """
+    Returns the description of a cluster, None when it does not exist.
     """
-    Create a Redshift cluster
-    :param redshift_client: an Redshift service client instance
-    :param node_type: node type of the cluster
-    :param db_name: name of the database
-    :param db_user: name of the database user
-    :param db_password: password of the database user
-    :param cluster_type: type of the cluster
-    :param cluster_size: size of the cluster
-    :param iam_role_arn: IAM role ARN
-    :return: True if cluster created successfully.
-    """
-
-    # Cluster hardware config
-    cluster_type = config.get('DWH', 'DWH_CLUSTER_TYPE')
-    cluster_size = config.get('DWH', 'DWH_NUM_NODES')
-    node_type = config.get('DWH', 'DWH_NODE_TYPE')
-
-    # Cluster identifiers and credentials
-    cluster_identifier = config.get('DWH', 'DWH_CLUSTER_IDENTIFIER')
-    db_name = config.get('DWH', 'DWH_DB')
-    db_user = config.get('DWH', 'DWH_DB_USER')
-    db_password = config.get('DWH', 'DWH_DB_PASSWORD')
-    port = config.get('DWH', 'DWH_PORT')
-
-    # IAM role ARN
-    iam_role = None
-
     try:
-        response = redshift_client.create_cluster(
-            ClusterIdentifier=cluster_identifier,
-            DBName=db_name,
-            ClusterType=cluster_type,
-            NodeType=node_type,
-            NumberOfNodes=int(cluster_size),
-            MasterUsername=db_user,
-            MasterUserPassword=db_password,
-            IamRoles=[iam_role_arn]
-        )
-        logger.debug(f"Response from create_cluster: {response}")
-        logger.info(f"Cluster create response: {response['ResponseMetadata']['HTTPStatusCode']}")
-        return response['ResponseMetadata']['HTTPStatusCode']
+        return redshift_client.describe_clusters(ClusterIdentifier=cluster_identifier)['Clusters'][0]
     except Exception as e:
-        logger.error(f"Error creating Redshift cluster: {e}")
-        return False
+        if error_code(e) == 'ClusterNotFound':
+            return None
+        raise
 
 
 # Get cluster status
@@ -132,74 +171,109 @@ def get_cluster_status(redshift_client, cluster_identifier):
     :param cluster_identifier: name of the cluster
     :return: True if cluster is in 'available' state.
     """
-    cluster_identifier = config.get('DWH', 'DWH_CLUSTER_IDENTIFIER')
-    response = redshift_client.describe_clusters(
-        ClusterIdentifier=cluster_identifier
-    )
-    cluster_status = response['Clusters'][0]['ClusterStatus']
+    cluster = describe_cluster(redshift_client, cluster_identifier)
+    cluster_status = cluster['ClusterStatus'] if cluster else 'missing'
     logger.info(f"Cluster status : {cluster_status.upper()}")
-    return True if (cluster_status.upper() in (
-        'AVAILABLE', 'ACTIVE', 'INCOMPATIBLE_NETWORK', 'INCOMPATIBLE_HSM', 'INCOMPATIBLE_RESTORE',
-        'INSUFFICIENT_CAPACITY', 'HARDWARE_FAILURE')) else False
+    return cluster_status == 'available'
 
 
-# Create ec2 security group
-def create_ec2_security_group(ec2_client):
+# Create Redshift cluster
+def ensure_cluster(redshift_client, settings, iam_role_arn, security_group_ids=None):
     """
-    Create an EC2 security group
-    :param ec2_client: an EC2 service client instance
-    :return: True if security group created successfully.
+    Starts creating the Redshift cluster, unless it already exists. Does not wait for it to become available.
+    Arguments:
+        redshift_client: a Redshift service client instance
+        settings: cluster settings read by cluster_settings
+        iam_role_arn: ARN of the role the cluster reads S3 with
+        security_group_ids: VPC security groups of the cluster
+
+    Return:
+        Status of the cluster
     """
-    group_name = config.get('DWH', 'DWH_SECURITY_GROUP')
-    port = config.get('DWH', 'DWH_PORT')
-    cluster_identifier = config.get('DWH', 'DWH_CLUSTER_IDENTIFIER')
-    redshift_client = boto3.client('redshift', region_name='us-west-2', aws_access_key_id=KEY,
-                                aws_secret_access_key=SECRET)
-    try:
-        while not get_cluster_status(redshift_client, cluster_identifier=cluster_identifier):
-            logger.info("Waiting for cluster to become ACTIVE")
-            time.sleep(10)
-        response = \
-            ec2_client.create_security_group(GroupName=group_name,
-                                            Description='Security group for Redshift cluster')
-        logger.debug(f"Response from create_security_group: {response}")
-        logger.info(f"Security group create response: {response['ResponseMetadata']['HTTPStatusCode']}")
-
-        ec2_client.authorize_security_group_ingress(
-            GroupName=group_name,
-            IpProtocol='tcp',
-            FromPort=int(port),
-            ToPort=int(port),
-            CidrIp='0.0.0.0/0',
-        )
-        logger.debug(f"Response from authorize_security_group_ingress: {response}")
-        logger.info(f"Security group authorize response: {response['ResponseMetadata']['HTTPStatusCode']}")
-        
-        return response['ResponseMetadata']['HTTPStatusCode']
+    cluster = describe_cluster(redshift_client, settings['cluster_identifier'])
+    if cluster:
+        logger.info(f"Cluster {settings['cluster_identifier']} already exists ({cluster['ClusterStatus']})")
+        return cluster['ClusterStatus']
+
+    logger.info(f"Creating cluster {settings['cluster_identifier']}")
+    arguments = {'ClusterIdentifier': settings['cluster_identifier'], 'DBName': settings['db_name'],
+                 'ClusterType': settings['cluster_type'], 'NodeType': settings['node_type'],
+                 'MasterUsername': settings['db_user'], 'MasterUserPassword': settings['db_password'],
+                 'Port': settings['port'], 'IamRoles': [iam_role_arn]}
+    if settings['cluster_type'] == 'multi-node':
+        arguments['NumberOfNodes'] = settings['cluster_size']
+    if security_group_ids:
+        arguments['VpcSecurityGroupIds'] = security_group_ids
+    return redshift_client.create_cluster(**arguments)['Cluster']['ClusterStatus']
+
+
+def wait_for_cluster(redshift_client, cluster_identifier, timeout=1800, sleep=time.sleep):
+    """
+    Waits for a cluster to become available.
 
-    except Exception as e:
-        logger.error(f"Error creating EC2 security group: {e}")
-        return False
+    Return:
+        Description of the cluster
+    """
+    def available():
+        cluster = describe_cluster(redshift_client, cluster_identifier)
+        if cluster is None:
+            raise RuntimeError(f"Cluster {cluster_identifier} does not exist")
+        if cluster['ClusterStatus'] in CLUSTER_FAILED_STATES:
+            raise RuntimeError(f"Cluster {cluster_identifier} is {cluster['ClusterStatus']}")
+        return cluster if cluster['ClusterStatus'] == 'available' else None
+    return wait_until(available, f"cluster {cluster_identifier} to become available", timeout, sleep=sleep)
 
 
-# 
+def ensure_cluster_security_group(redshift_client, cluster, group_id, timeout=1800, sleep=time.sleep):
+    """
+    Adds the security group to an available cluster, unless it is attached already, and waits until the
+    cluster is available again with the group active.
 
-def main():
+    Return:
+        Description of the cluster
     """
-    Main function.
+    cluster_identifier = cluster['ClusterIdentifier']
+    attached = [group['VpcSecurityGroupId'] for group in cluster.get('VpcSecurityGroups', [])]
+    if group_id in attached:
+        return cluster
+    logger.info(f"Attaching security group {group_id} to cluster {cluster_identifier}")
+    redshift_client.modify_cluster(ClusterIdentifier=cluster_identifier, VpcSecurityGroupIds=attached + [group_id])
+
+    def modified():
+        cluster = wait_for_cluster(redshift_client, cluster_identifier, timeout, sleep)
+        groups = {group['VpcSecurityGroupId']: group.get('Status') for group in cluster.get('VpcSecurityGroups', [])}
+        return cluster if groups.get(group_id) == 'active' else None
+    return wait_until(modified, f"security group {group_id} to be active on cluster {cluster_identifier}", timeout,
+                      sleep=sleep)
+
+
+def provision(iam_client, ec2_client, redshift_client, settings, sleep=time.sleep):
     """
+    Provisions the IAM role, security group and cluster. The security group is created while the role is
+    set up and the cluster boots; every step skips resources that already exist, so a failed run can be
+    re-run.
 
-    # Cluster hardware config
-    cluster_type = config.get('DWH', 'DWH_CLUSTER_TYPE')
-    cluster_size = config.get('DWH', 'DWH_NUM_NODES')
-    node_type = config.get('DWH', 'DWH_NODE_TYPE')
+    Return:
+        Description of the available cluster
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        security_group = executor.submit(ensure_security_group, ec2_client, settings['security_group'],
+                                         settings['port'])
+        iam_role_arn = ensure_iam_role(iam_client, settings['role_name'])
+        ensure_cluster(redshift_client, settings, iam_role_arn)
+        cluster = wait_for_cluster(redshift_client, settings['cluster_identifier'], settings['timeout'], sleep)
+        group_id = security_group.result()
+    cluster = ensure_cluster_security_group(redshift_client, cluster, group_id, settings['timeout'], sleep)
+    logger.info(f"Cluster endpoint: {cluster['Endpoint']['Address']}")
+    logger.info(f"Role ARN: {iam_role_arn}")
+    return cluster
 
-    # Cluster identifiers and credentials
-    cluster_identifier = config.get('DWH', 'DWH_CLUSTER_IDENTIFIER')
-    db_name = config.get('DWH', 'DWH_DB')
-    db_user = config.get('DWH', 'DWH_DB_USER')
-    db_password = config.get('DWH', 'DWH_DB_PASSWORD')
-    port = config.get('DWH', 'DWH_PORT')
+
+def main():
+    """
+    Main function.
+    """
+    settings = cluster_settings(config)
 
     # Create boto3 clients
     iam_client = boto3.client('iam', region_name='us-west-2', aws_access_key_id=KEY, aws_secret_access_key=SECRET)
@@ -207,21 +281,12 @@ def main():
                                    aws_secret_access_key=SECRET)
     ec2_client = boto3.client('ec2', region_name='us-west-2', aws_access_key_id=KEY, aws_secret_access_key=SECRET)
 
-    # Create IAM role
-    create_iam_role(iam_client)
-
-    # Get IAM role ARN
-    iam_role_arn = get_iam_role_arn(iam_client)
-
-    # Create Redshift cluster
-    cluster_arn = create_redshift_cluster(redshift_client, iam_role_arn, cluster_type, node_type, cluster_size, db_name,
-                                          db_user, db_password)
-
-    # Get cluster status
-    # get_cluster_status(redshift_client, cluster_identifier)
-
-    # Create EC2 security group
-    create_ec2_security_group(ec2_client)
+    try:
+        provision(iam_client, ec2_client, redshift_client, settings)
+    except Exception as e:
+        logger.error(f"Error provisioning the Redshift cluster: {e}")
+        return False
+    return True
 
 
 if __name__ == '__main__':
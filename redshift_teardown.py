@@ -1,12 +1,14 @@
 import configparser
 import logging.config
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 
-# Setting up logger
-from redshift_setup import get_cluster_status
+from redshift_setup import (S3_READ_ONLY_POLICY, CLUSTER_FAILED_STATES, cluster_settings, describe_cluster,
+                            error_code, wait_until)
 
+# Setting up logger
 logging.config.fileConfig("logging.conf")
 logger = logging.getLogger(__name__)
 
@@ -14,113 +16,109 @@ logger = logging.getLogger(__name__)
 config = configparser.ConfigParser()
 config.read('dwh.cfg')
 
-KEY = config.get('AWS', 'KEY')
-SECRET = config.get('AWS', 'SECRET')
+KEY = config.get('AWS', 'KEY', fallback=None)
+SECRET = config.get('AWS', 'SECRET', fallback=None)
+
+# States in which a delete request is accepted
+CLUSTER_DELETABLE_STATES = ('available',) + CLUSTER_FAILED_STATES
+
 
 # Detach policy
-def detach_policy(iam_client, role_name, policy_arn):
+def detach_policy(iam_client, role_name, policy_arn=S3_READ_ONLY_POLICY):
     """
-    Detach a policy from an IAM role
+    Detach a policy from an IAM role, unless the role or the attachment is already gone
     :param iam_client: an IAM service client instance
     :param role_name: name of the role
     :param policy_arn: ARN of the policy
     :return: None
     """
-    role_name = config.get('DWH', 'DWH_IAM_ROLE_NAME')
     try:
-        iam_client.detach_role_policy(
-            RoleName=role_name,
-            PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
-        )
+        iam_client.detach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
         logger.info("Detached policy from role")
     except Exception as e:
-        logger.error(f"Error detaching policy from role: {e}")
+        if error_code(e) != 'NoSuchEntity':
+            raise
+        logger.info(f"Policy is not attached to role {role_name}")
+
 
 # Delete IAM role
 def delete_iam_role(iam_client, role_name):
     """
-    Delete an IAM role
+    Detach the policy from an IAM role and delete it, unless it is already gone
     :param iam_client: an IAM service client instance
     :param role_name: name of the role
-    :return: True if role deleted successfully.
+    :return: None
     """
-    role_name = config.get('DWH', 'DWH_IAM_ROLE_NAME')
+    detach_policy(iam_client, role_name)
     try:
-        response = iam_client.delete_role(
-            RoleName=role_name
-        )
-        logger.debug(f"Response from delete_iam_role: {response}")
-        logger.info(f"IAM role delete response: {response['ResponseMetadata']['HTTPStatusCode']}")
-        return response['ResponseMetadata']['HTTPStatusCode']
+        iam_client.delete_role(RoleName=role_name)
+        logger.info(f"Deleted IAM role {role_name}")
     except Exception as e:
-        logger.error(f"Error deleting IAM role: {e}")
-        return False
+        if error_code(e) != 'NoSuchEntity':
+            raise
+        logger.info(f"IAM role {role_name} does not exist")
 
 
 # Delete EC2 security group
-def delete_security_group(ec2_client):
+def delete_security_group(ec2_client, group_name):
     """
-    Delete an EC2 security group
+    Delete an EC2 security group, unless it is already gone
     :param ec2_client: an EC2 service client instance
-    :return: True if security group deleted successfully.
+    :param group_name: name of the security group
+    :return: None
     """
-    group_name = config.get('DWH', 'DWH_SECURITY_GROUP')
-    try:
-        response = ec2_client.delete_security_group(
-            GroupName=group_name
-        )
-        logger.debug(f"Response from delete_security_group: {response}")
-        logger.info(f"Security group delete response: {response['ResponseMetadata']['HTTPStatusCode']}")
-        return response['ResponseMetadata']['HTTPStatusCode']
-    except Exception as e:
-        logger.error(f"Error deleting EC2 security group: {e}")
-        return False
+    groups = ec2_client.describe_security_groups(
+        Filters=[{'Name': 'group-name', 'Values': [group_name]}])['SecurityGroups']
+    if not groups:
+        logger.info(f"Security group {group_name} does not exist")
+        return
+    ec2_client.delete_security_group(GroupId=groups[0]['GroupId'])
+    logger.info(f"Deleted security group {group_name}")
 
 
 # Delete cluster
-def delete_cluster(redshift_client, cluster_identifier):
+def delete_cluster(redshift_client, cluster_identifier, timeout=1800, sleep=time.sleep):
     """
-    Delete a Redshift cluster
+    Delete a Redshift cluster and wait until it is gone
     :param redshift_client: a Redshift service client instance
     :param cluster_identifier: name of the cluster
-    :return: True if cluster deleted successfully.
+    :param timeout: overall number of seconds to wait
+    :return: None
     """
-    if len(redshift_client.describe_clusters()['Clusters']) == 0:
+    def deletable():
+        cluster = describe_cluster(redshift_client, cluster_identifier)
+        return cluster is None or cluster['ClusterStatus'] in CLUSTER_DELETABLE_STATES + ('deleting',)
+
+    wait_until(deletable, f"cluster {cluster_identifier} to accept a delete request", timeout, sleep=sleep)
+    cluster = describe_cluster(redshift_client, cluster_identifier)
+    if cluster is None:
         logger.info(f"Redshift cluster {cluster_identifier} does not exist")
-        return True
-    try:
-        while not get_cluster_status(redshift_client, cluster_identifier=cluster_identifier):
-            logger.info("Can't delete cluster. Waiting for cluster to become ACTIVE")
-            time.sleep(10)
-        response = \
-            redshift_client.delete_cluster(
-                ClusterIdentifier=cluster_identifier,
-                SkipFinalClusterSnapshot=True
-            )
-        logger.debug(f"Response from delete_cluster: {response}")
-        logger.info(f"Cluster delete response: {response['ResponseMetadata']['HTTPStatusCode']}")
-        return response['ResponseMetadata']['HTTPStatusCode']
-    except Exception as e:
-        logger.error(f"Error deleting Redshift cluster: {e}")
-        return False
+        return
+    if cluster['ClusterStatus'] != 'deleting':
+        logger.info(f"Deleting Redshift cluster {cluster_identifier}")
+        redshift_client.delete_cluster(ClusterIdentifier=cluster_identifier, SkipFinalClusterSnapshot=True)
+    wait_until(lambda: describe_cluster(redshift_client, cluster_identifier) is None,
+               f"cluster {cluster_identifier} to be deleted", timeout, sleep=sleep)
+    logger.info(f"Deleted Redshift cluster {cluster_identifier}")
+
+
+def teardown(iam_client, ec2_client, redshift_client, settings, sleep=time.sleep):
+    """
+    Removes the cluster, IAM role and security group. The role is removed while the cluster shuts down;
+    the security group is removed once the cluster no longer uses it. Resources already gone are skipped.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        role = executor.submit(delete_iam_role, iam_client, settings['role_name'])
+        delete_cluster(redshift_client, settings['cluster_identifier'], settings['timeout'], sleep)
+        role.result()
+    delete_security_group(ec2_client, settings['security_group'])
 
 
 def main():
     """
     Main function
     """
-    # Cluster hardware config
-    cluster_type = config.get('DWH', 'DWH_CLUSTER_TYPE')
-    cluster_size = config.get('DWH', 'DWH_NUM_NODES')
-    node_type = config.get('DWH', 'DWH_NODE_TYPE')
-
-    # Cluster identifiers and credentials
-    cluster_identifier = config.get('DWH', 'DWH_CLUSTER_IDENTIFIER')
-    db_name = config.get('DWH', 'DWH_DB')
-    db_user = config.get('DWH', 'DWH_DB_USER')
-    db_password = config.get('DWH', 'DWH_DB_PASSWORD')
-    port = config.get('DWH', 'DWH_PORT')
-    role_name = config.get('DWH', 'DWH_IAM_ROLE_NAME')
+    settings = cluster_settings(config)
 
     # Create boto3 clients
     iam_client = boto3.client('iam', region_name='us-west-2', aws_access_key_id=KEY, aws_secret_access_key=SECRET)
@@ -128,29 +126,12 @@ def main():
                                 aws_secret_access_key=SECRET)
     ec2_client = boto3.client('ec2', region_name='us-west-2', aws_access_key_id=KEY, aws_secret_access_key=SECRET)
 
-    # Detach policy
-    logger.info(f"Detaching policy from role: {role_name}")
-    detach_policy(iam_client, role_name, "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess")
-
-    # Delete IAM role
-    logger.info(f"Deleting IAM role: {role_name}")
-    delete_iam_role(iam_client, role_name)
-
-    # Delete ec2 security group
-    logger.info(f"Deleting EC2 security group: {ec2_client}")
-    if delete_security_group(ec2_client):
-        logger.info(f"EC2 security group deleted successfully")
-    else:
-        logger.error(f"Error deleting EC2 security group")
-        return False
-
-    # Delete cluster
-    logger.info(f"Deleting Redshift cluster: {cluster_identifier}")
-    if delete_cluster(redshift_client, cluster_identifier):
-        logger.info(f"Redshift cluster deleted successfully")
-    else:
-        logger.error(f"Error deleting Redshift cluster")
+    try:
+        teardown(iam_client, ec2_client, redshift_client, settings)
+    except Exception as e:
+        logger.error(f"Error tearing down the Redshift cluster: {e}")
         return False
+    return True
 
 
 if __name__ == '__main__':
@@ -0,0 +1,224 @@
+import argparse
+import configparser
+import logging.config
+import re
+import time
+from datetime import datetime
+
+from backends import get_backend
+from connection import connect
+from metrics import stage
+from query_cache import bump_versions
+from sql_queries import (analytics_queries, rollup_delete_delta, rollup_delta_create, rollup_delta_drop,
+                         rollup_dimensions, rollup_freshness_select, rollup_insert, rollup_match, rollup_new_songplays,
+                         rollup_nullable, rollup_nullable_match, rollup_routes, rollup_state_delete, rollup_state_insert,
+                         rollup_state_lock, rollup_state_select, rollup_update, songplays_version_select)
+
+logger = logging.getLogger(__name__)
+
+# single table aggregate over songplays: SELECT ... FROM songplays [WHERE ...] GROUP BY ... [HAVING/ORDER BY/LIMIT]
+AGGREGATE_QUERY = re.compile(r'^\s*SELECT\s+(?P<select>.+?)\s+FROM\s+songplays(?:\s+WHERE\s+(?P<where>.+?))?'
+                             r'\s+GROUP\s+BY\s+(?P<group>.+?)(?P<tail>\s+(?:HAVING|ORDER\s+BY|LIMIT)\b.*?)?\s*;?\s*$',
+                             re.IGNORECASE | re.DOTALL)
+COUNT_ALL = re.compile(r'COUNT\s*\(\s*\*\s*\)', re.IGNORECASE)
+COUNT_USERS = re.compile(r'COUNT\s*\(\s*DISTINCT\s+user_id\s*\)', re.IGNORECASE)
+ALIAS = re.compile(r'\s+AS\s+\w+$', re.IGNORECASE)
+STRING_LITERAL = re.compile(r"'[^']*'")
+WORD = re.compile(r'\b[a-z_]\w*\b', re.IGNORECASE)
+SQL_WORDS = {'and', 'or', 'not', 'in', 'is', 'null', 'like', 'between', 'having', 'order', 'by', 'limit', 'asc',
+             'desc', 'sum', 'plays', 'count', 'distinct'}
+
+# songplays columns stored as is by the rollups, and the rollups smallest first
+ROUTABLE_COLUMNS = {'level', 'artist_id', 'user_id'}
+ROLLUP_ORDER = ['songplays_hourly', 'songplays_artist_daily', 'songplays_user_daily']
+
+
+def rollup_queries(rollup, low, high):
+    """
+    Builds the statements adding the songplays with low < songplay_id <= high to a rollup.
+
+    Return:
+        List of statements
+    """
+    delta = f"{rollup}_delta"
+    dimensions = rollup_dimensions[rollup]
+    columns = ', '.join(dimensions)
+    match = ' AND '.join((rollup_nullable_match if column in rollup_nullable else rollup_match)
+                         .format(rollup=rollup, delta=delta, column=column) for column in dimensions)
+    return [rollup_delta_create.format(delta=delta, groups=', '.join(dimensions.values()), low=int(low),
+                                       high=int(high), dimensions=', '.join(f"{expression} AS {column}"
+                                                                            for column, expression
+                                                                            in dimensions.items())),
+            rollup_update.format(rollup=rollup, delta=delta, match=match),
+            rollup_delete_delta.format(rollup=rollup, delta=delta, match=match),
+            rollup_insert.format(rollup=rollup, delta=delta, columns=columns),
+            rollup_delta_drop.format(delta=delta)]
+
+
+def refresh_rollups(cur, conn):
+    """
+    Adds the songplays inserted since the last refresh, the ones above the high water songplay_id of
+    rollup_state, to every rollup in a single transaction, then records the new high water and the
+    songplays data version the rollups now reflect. Called right after the songplays insert, this reads
+    the songplays of that insert only, through the songplay_id sort key, never the whole table.
+
+    Return:
+        Number of songplays added
+    """
+    cur.execute(rollup_state_lock)
+    cur.execute(rollup_state_select)
+    row = cur.fetchone()
+    low = row[0] if row else -1
+    cur.execute(rollup_new_songplays, (low,))
+    added, high = cur.fetchone()
+    cur.execute(songplays_version_select)
+    row = cur.fetchone()
+    version = row[0] if row else None
+
+    if added:
+        for rollup in rollup_dimensions:
+            with stage(f"rollup:{rollup}"):
+                for query in rollup_queries(rollup, low, high):
+                    cur.execute(query)
+    cur.execute(rollup_state_delete)
+    cur.execute(rollup_state_insert, (high if added else low, version, datetime.utcnow()))
+    conn.commit()
+    if not added:
+        logger.info("Rollups are up to date")
+        return 0
+    bump_versions(cur, conn, list(rollup_dimensions))
+    logger.info(f"Added {added} songplays to the rollups")
+    return added
+
+
+def split_list(text):
+    """
+    Splits a comma separated SQL list, ignoring commas inside parentheses.
+    """
+    items, depth, current = [], 0, ''
+    for char in text:
+        depth += (char == '(') - (char == ')')
+        if char == ',' and depth == 0:
+            items.append(current.strip())
+            current = ''
+        else:
+            current += char
+    return items + [current.strip()] if current.strip() else items
+
+
+def route_aggregate(query):
+    """
+    Rewrites a plays count over songplays grouped and filtered by level, artist_id or user_id
+    to the smallest rollup holding those columns.
+
+    Return:
+        (rewritten query, rollup) or (query, None) when no rollup can answer it
+    """
+    match = AGGREGATE_QUERY.match(query)
+    if not match:
+        return query, None
+    needed = set()
+    for item in split_list(match.group('select')):
+        item = ALIAS.sub('', item).strip()
+        if COUNT_USERS.fullmatch(item):
+            needed.add('user_id')
+        elif not COUNT_ALL.fullmatch(item):
+            if item.lower() not in ROUTABLE_COLUMNS:
+                return query, None
+            needed.add(item.lower())
+    for item in split_list(match.group('group')):
+        if item.lower() not in ROUTABLE_COLUMNS:
+            return query, None
+        needed.add(item.lower())
+    where = STRING_LITERAL.sub('', match.group('where') or '')
+    for word in WORD.findall(where):
+        if word.lower() not in SQL_WORDS | ROUTABLE_COLUMNS:
+            return query, None
+        if word.lower() in ROUTABLE_COLUMNS:
+            needed.add(word.lower())
+    tail = STRING_LITERAL.sub('', match.group('tail') or '')
+    if COUNT_USERS.search(tail):
+        needed.add('user_id')
+
+    for rollup in ROLLUP_ORDER:
+        if needed <= set(rollup_dimensions[rollup]):
+            rewritten = re.sub(r'\bFROM\s+songplays\b', f"FROM {rollup}", query, flags=re.IGNORECASE)
+            return COUNT_ALL.sub('SUM(plays)', rewritten), rollup
+    return query, None
+
+
+def route_query(query):
+    """
+    Picks the rollup answering a query: the prepared equivalent of a dashboard query, or a rewrite
+    of a plays count over songplays.
+
+    Return:
+        (query to run, rollup) or (query, None) when it has to run on songplays
+    """
+    if query in rollup_routes:
+        rollup, routed = rollup_routes[query]
+        return routed, rollup
+    return route_aggregate(query)
+
+
+def rollups_current(cur):
+    """
+    Tells whether every songplay has been added to the rollups: the songplays data version recorded by
+    the last refresh is still the current one, or songplays was never loaded.
+    """
+    cur.execute(rollup_freshness_select)
+    current, refreshed = cur.fetchone()
+    return current is None or current == refreshed
+
+
+def execute_routed(cur, query, require_current=True):
+    """
+    Runs a query on the rollups when one can answer it, on songplays otherwise, e.g. when
+    require_current is set and the rollups lag behind songplays.
+
+    Return:
+        (rows, rollup the query ran on or None)
+    """
+    routed, rollup = route_query(query)
+    if rollup and require_current and not rollups_current(cur):
+        logger.warning(f"Rollups are behind songplays, running the query on songplays")
+        routed, rollup = query, None
+    cur.execute(routed)
+    return cur.fetchall(), rollup
+
+
+def main():
+    """
+    Refreshes the songplays rollups and times the dashboard queries on the rollups and on songplays.
+    """
+    logging.config.fileConfig("logging.conf")
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--refresh', action='store_true', help='add new songplays to the rollups first')
+    parser.add_argument('--compare', action='store_true', help='also time every dashboard query on songplays')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    conn = connect(backend, config)
+    cur = conn.cursor()
+    if args.refresh:
+        refresh_rollups(cur, conn)
+
+    for name, query in analytics_queries.items():
+        start = time.perf_counter()
+        rows, rollup = execute_routed(cur, query)
+        elapsed = time.perf_counter() - start
+        message = f"{name}: {len(rows)} rows in {elapsed:.3f}s from {rollup or 'songplays'}"
+        if args.compare and rollup:
+            start = time.perf_counter()
+            cur.execute(query)
+            cur.fetchall()
+            message += f", {time.perf_counter() - start:.3f}s from songplays"
+        logger.info(message)
+    conn.commit()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
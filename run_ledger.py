@@ -0,0 +1,141 @@
+import hashlib
+import logging
+import uuid
+from datetime import datetime
+
+from incremental import list_source_files
+from sql_queries import (insert_table_dependencies, run_ledger_completed, run_ledger_finish, run_ledger_insert,
+                         run_ledger_invalidate, run_ledger_rows)
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(*parts):
+    """
+    Hash of the inputs of a stage, e.g. the files it loads or the statements it runs.
+    """
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+def staging_fingerprints(backend, tables, files=None, s3_client=None):
+    """
+    Fingerprints of the staging table loads: the urls and sizes of the files each table is loaded from.
+    Arguments:
+        backend: backend holding the dataset locations
+        tables: staging tables
+        files: optional dict of table -> list of (file url, size), e.g. the new files of an incremental load
+        s3_client: boto3 S3 client, required for s3:// datasets
+
+    Return:
+        dict of table -> fingerprint
+    """
+    sources = {'staging_events_table': backend.log_data(), 'staging_songs_table': backend.song_data()}
+    fingerprints = {}
+    for table in tables:
+        table_files = (files or {}).get(table)
+        if table_files is None:
+            table_files = list_source_files(sources[table], s3_client=s3_client)
+        fingerprints[table] = fingerprint(table, table_files)
+    return fingerprints
+
+
+def insert_fingerprints(queries, staging):
+    """
+    Fingerprints of the inserts: their statements and the fingerprints of the staging tables they read.
+    Arguments:
+        queries: dict of table name -> list of statements
+        staging: dict of staging table -> fingerprint of its load
+
+    Return:
+        dict of table -> fingerprint
+    """
+    return {table: fingerprint(table, statements, [staging.get(dependency)
+                                                   for dependency in insert_table_dependencies.get(table, [])])
+            for table, statements in queries.items()}
+
+
+def stage_names(tables):
+    """
+    Ledger stages loading tables, e.g. 'load_staging:staging_events_table' or 'insert:users'.
+    """
+    return [f"{prefix}:{table}" for table in tables for prefix in ('load_staging', 'insert')]
+
+
+def invalidate_tables(cur, conn, tables):
+    """
+    Forgets the completed loads of tables, e.g. once they are recreated empty, so the next run loads them again.
+    """
+    if tables:
+        cur.execute(run_ledger_invalidate, (tuple(stage_names(tables)),))
+        conn.commit()
+
+
+class RunLedger:
+    """
+    Records every stage of a run in the run_ledger table: its input fingerprint, status
+    (running, completed, failed or skipped) and row count. When resuming, a stage that already
+    completed with the same fingerprint is skipped, so a failed run only repeats what did not finish.
+    """
+
+    def __init__(self, cur, conn, resume=False, run_id=None):
+        self.cur = cur
+        self.conn = conn
+        self.resume = resume
+        self.run_id = run_id or uuid.uuid4().hex
+        self.completed = None
+
+    def last_completed(self):
+        """
+        Fingerprint each stage last completed with, read once per run.
+        """
+        if self.completed is None:
+            self.cur.execute(run_ledger_completed)
+            self.completed = dict(self.cur.fetchall())
+            self.conn.commit()
+        return self.completed
+
+    def pending(self, prefix, fingerprints):
+        """
+        Splits the tables of a stage into those to run and those to skip, recording the skipped ones.
+        Arguments:
+            prefix: stage prefix, e.g. 'load_staging'
+            fingerprints: dict of table -> fingerprint of its inputs
+
+        Return:
+            list of tables to run
+        """
+        if not self.resume:
+            return list(fingerprints)
+        completed = self.last_completed()
+        skipped = [table for table, value in fingerprints.items() if completed.get(f"{prefix}:{table}") == value]
+        if skipped:
+            logger.info(f"Resuming: skipping {prefix} of {skipped}, completed earlier with the same inputs")
+            self.record(prefix, {table: fingerprints[table] for table in skipped}, 'skipped')
+        return [table for table in fingerprints if table not in skipped]
+
+    def record(self, prefix, fingerprints, status='running'):
+        """
+        Records the start of the stages of tables, or their skipping.
+        """
+        now = datetime.utcnow()
+        self.cur.executemany(run_ledger_insert, [(self.run_id, f"{prefix}:{table}", value, status, now)
+                                                 for table, value in fingerprints.items()])
+        self.conn.commit()
+
+    def finish(self, prefix, tables, status='completed'):
+        """
+        Marks the stages of tables completed or failed.
+        """
+        tables = list(tables)
+        if tables:
+            self.cur.execute(run_ledger_finish, (status, datetime.utcnow(), self.run_id,
+                                                 tuple(f"{prefix}:{table}" for table in tables)))
+            self.conn.commit()
+
+    def record_rows(self, prefix, stats):
+        """
+        Stores the row counts of the tables of a stage, stats being a dict of table -> dict with 'rows'.
+        """
+        self.cur.executemany(run_ledger_rows, [(values.get('rows'), self.run_id, f"{prefix}:{table}")
+                                               for table, values in stats.items()])
+        self.conn.commit()
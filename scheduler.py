@@ -0,0 +1,124 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+
+def run_stage(connection_pool, name, query):
+    """
+    Runs a single stage on its own pooled connection and commits it.
+    Arguments:
+        connection_pool: pool to borrow the connection from
+        name: name of the stage
+        query: SQL statement, or list of statements, executed by the stage
+
+    Return:
+        Elapsed time in seconds
+    """
+    queries = [query] if isinstance(query, str) else query
+    conn = connection_pool.getconn()
+    try:
+        start = time.perf_counter()
+        with conn.cursor() as cur:
+            for statement in queries:
+                cur.execute(statement)
+        conn.commit()
+        return time.perf_counter() - start
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        connection_pool.putconn(conn)
+
+
+def stage_order(stages, dependencies):
+    """
+    Orders stages so every stage comes after the stages it depends on.
+    Dependencies that are not part of stages are treated as already satisfied.
+    Arguments:
+        stages: iterable of stage names
+        dependencies: dict of stage name -> list of stage names it depends on
+
+    Return:
+        List of stage names in a valid execution order
+    """
+    stages = list(stages)
+    pending = {name: {dep for dep in dependencies.get(name, []) if dep in stages} for name in stages}
+    order = []
+    while pending:
+        ready = [name for name in stages if name in pending and not pending[name]]
+        if not ready:
+            raise ValueError(f"Cyclic dependencies between stages: {sorted(pending)}")
+        for name in ready:
+            del pending[name]
+            order.append(name)
+        for deps in pending.values():
+            deps.difference_update(ready)
+    return order
+
+
+def run_in_stage(label, runner, *args):
+    """
+    Calls runner with the statements it runs attributed to the metrics stage label.
+    """
+    with stage(label):
+        return runner(*args)
+
+
+def run_stages(connection_pool, stages, dependencies, max_workers=4, runner=run_stage, stage_prefix='',
+               on_complete=None):
+    """
+    Runs stages concurrently, starting each one as soon as the stages it depends on have completed.
+    No new stage is started once a stage fails; running stages are allowed to finish and the
+    first error is re-raised.
+    Arguments:
+        connection_pool: pool to borrow connections from
+        stages: dict of stage name -> SQL statement (or list of statements)
+        dependencies: dict of stage name -> list of stage names it depends on
+        max_workers: maximum number of stages running at the same time
+        runner: callable(connection_pool, name, query) executing one stage
+        stage_prefix: prefix of the metrics stage name of every stage
+        on_complete: optional callable(name, elapsed) called in the calling thread as each stage completes
+
+    Return:
+        dict of stage name -> elapsed time in seconds
+    """
+    stage_order(stages, dependencies)  # fail fast on cycles
+    remaining = {name: {dep for dep in dependencies.get(name, []) if dep in stages} for name in stages}
+    timings = {}
+    error = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while remaining or running:
+            if error is None:
+                for name in [name for name, deps in remaining.items() if not deps]:
+                    del remaining[name]
+                    logger.info(f"Starting stage {name}")
+                    future = executor.submit(run_in_stage, stage_prefix + name, runner, connection_pool, name,
+                                             stages[name])
+                    running[future] = name
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    timings[name] = future.result()
+                    logger.info(f"Completed stage {name} in {timings[name]:.2f}s")
+                except Exception as e:
+                    logger.error(f"Stage {name} failed: {e}")
+                    error = error or e
+                    continue
+                if on_complete is not None:
+                    on_complete(name, timings[name])
+                for deps in remaining.values():
+                    deps.discard(name)
+
+    if error is not None:
+        raise error
+    return timings
@@ -1,14 +1,29 @@
 import configparser
+from datetime import datetime, timezone
 
 # CONFIG
 config = configparser.ConfigParser()
 config.read('dwh.cfg')
 
-HOST = config.get('CLUSTER', 'HOST')
-DB_NAME = config.get('CLUSTER', 'DB_NAME')
-DB_USER = config.get('CLUSTER', 'DB_USER')
-DB_PASSWORD = config.get('CLUSTER', 'DB_PASSWORD')
-DB_PORT = config.get('CLUSTER', 'DB_PORT')
+# Redshift specific settings fall back to empty values so the local backend runs without them
+HOST = config.get('CLUSTER', 'HOST', fallback='')
+DB_NAME = config.get('CLUSTER', 'DB_NAME', fallback='')
+DB_USER = config.get('CLUSTER', 'DB_USER', fallback='')
+DB_PASSWORD = config.get('CLUSTER', 'DB_PASSWORD', fallback='')
+DB_PORT = config.get('CLUSTER', 'DB_PORT', fallback='')
+
+LOG_DATA = config.get('S3', 'LOG_DATA', fallback="''")
+LOG_JSONPATH = config.get('S3', 'LOG_JSONPATH', fallback="'auto'")
+SONG_DATA = config.get('S3', 'SONG_DATA', fallback="''")
+IAM_ROLE_ARN = config.get('IAM_ROLE', 'ARN', fallback="''")
+# compression of the JSON files in S3 (gzip, zstd or bzip2), empty for uncompressed files
+COMPRESSION = config.get('S3', 'COMPRESSION', fallback='').strip().upper()
+COPY_COMPRESSION = f" {COMPRESSION}" if COMPRESSION in ('GZIP', 'ZSTD', 'BZIP2') else ''
+# log events outside these dates are reported by the data quality checks, as epoch milliseconds
+QUALITY_TS_MIN, QUALITY_TS_MAX = (
+    int(datetime.strptime(config.get('QUALITY', key, fallback=default), '%Y-%m-%d')
+        .replace(tzinfo=timezone.utc).timestamp() * 1000)
+    for key, default in (('TS_MIN', '2000-01-01'), ('TS_MAX', '2100-01-01')))
 
 # DROP TABLES
 
@@ -19,6 +34,14 @@ user_table_drop = "DROP TABLE IF EXISTS users"  # drop users table
 song_table_drop = "DROP TABLE IF EXISTS songs"  # drop song_table
 artist_table_drop = "DROP TABLE IF EXISTS artists"  # drop artist_table
 time_table_drop = "DROP TABLE IF EXISTS time"  # drop time_table
+load_ledger_table_drop = "DROP TABLE IF EXISTS load_ledger"  # drop load_ledger
+calendar_table_drop = "DROP TABLE IF EXISTS calendar"  # drop calendar
+songplays_hourly_drop = "DROP TABLE IF EXISTS songplays_hourly"  # drop songplays_hourly rollup
+songplays_artist_daily_drop = "DROP TABLE IF EXISTS songplays_artist_daily"  # drop songplays_artist_daily rollup
+songplays_user_daily_drop = "DROP TABLE IF EXISTS songplays_user_daily"  # drop songplays_user_daily rollup
+rollup_state_drop = "DROP TABLE IF EXISTS rollup_state"  # drop rollup_state
+table_versions_drop = "DROP TABLE IF EXISTS table_versions"  # drop table_versions
+run_ledger_drop = "DROP TABLE IF EXISTS run_ledger"  # drop run_ledger
 
 # CREATE TABLES
 
@@ -33,8 +56,12 @@ staging_songs_table_create = (""" CREATE TABLE staging_songs_table (
     artist_latitude     REAL,
     artist_longitude    REAL,
     artist_location     VARCHAR(200),
-    num_songs           INT
-    );
+    num_songs           INT,
+    song_known          BOOLEAN,
+    artist_known        BOOLEAN,
+    song_key            VARCHAR(32) distkey
+    )
+    sortkey(song_key);
 """)
 
 staging_events_table_create = (""" CREATE TABLE staging_events_table (
@@ -56,9 +83,10 @@ staging_events_table_create = (""" CREATE TABLE staging_events_table (
     status              INT,
     ts                  BIGINT,
     user_agent          VARCHAR(300),
-    user_id             INT
+    user_id             INT,
+    song_key            VARCHAR(32) distkey
     )
-    ;
+    sortkey(song_key);
 """)
 
 songplay_table_create = (""" CREATE TABLE songplays (
@@ -121,96 +149,570 @@ time_table_create = ("""CREATE TABLE time (
     sortkey(year, month, day);
 """)
 
+load_ledger_table_create = ("""CREATE TABLE load_ledger (
+    file_key            VARCHAR(1024) NOT NULL,
+    partition_key       VARCHAR(20) NOT NULL,
+    file_size           BIGINT,
+    loaded_at           TIMESTAMP NOT NULL
+)
+    sortkey(partition_key);
+""")
+
+calendar_table_create = ("""CREATE TABLE calendar (
+    calendar_hour       TIMESTAMP PRIMARY KEY,
+    hour                SMALLINT NOT NULL,
+    day                 SMALLINT NOT NULL,
+    week                SMALLINT NOT NULL,
+    month               SMALLINT NOT NULL,
+    year                SMALLINT NOT NULL,
+    weekday             SMALLINT NOT NULL
+)
+    diststyle all
+    sortkey(calendar_hour);
+""")
+
+# level is NULL for the songplays without one, so the rollups are unique rather than keyed on it
+songplays_hourly_create = ("""CREATE TABLE songplays_hourly (
+    hour_start          TIMESTAMP NOT NULL,
+    level               VARCHAR(10),
+    plays               BIGINT NOT NULL,
+    UNIQUE (hour_start, level)
+)
+    diststyle all
+    sortkey(hour_start);
+""")
+
+songplays_artist_daily_create = ("""CREATE TABLE songplays_artist_daily (
+    artist_id           VARCHAR(20) NOT NULL distkey,
+    day                 DATE NOT NULL,
+    plays               BIGINT NOT NULL,
+    PRIMARY KEY (artist_id, day)
+)
+    sortkey(day);
+""")
+
+songplays_user_daily_create = ("""CREATE TABLE songplays_user_daily (
+    user_id             VARCHAR(100) NOT NULL distkey,
+    day                 DATE NOT NULL,
+    level               VARCHAR(10),
+    plays               BIGINT NOT NULL,
+    UNIQUE (user_id, day, level)
+)
+    sortkey(day);
+""")
+
+# highest songplay_id added to the rollups, and the songplays data version they reflect
+rollup_state_create = ("""CREATE TABLE rollup_state (
+    high_water          BIGINT NOT NULL,
+    songplays_version   BIGINT,
+    refreshed_at        TIMESTAMP NOT NULL
+)
+    diststyle all;
+""")
+
+# data version of every table, changed by each load, the query result cache is keyed by
+table_versions_create = ("""CREATE TABLE table_versions (
+    table_name          VARCHAR(128) PRIMARY KEY,
+    version             BIGINT NOT NULL,
+    updated_at          TIMESTAMP NOT NULL
+)
+    diststyle all;
+""")
+
+# every stage of every etl.py run, with the fingerprint of its inputs, resumed runs skip completed stages
+run_ledger_create = ("""CREATE TABLE run_ledger (
+    run_id              VARCHAR(32) NOT NULL,
+    stage               VARCHAR(128) NOT NULL,
+    fingerprint         VARCHAR(64) NOT NULL,
+    status              VARCHAR(10) NOT NULL,
+    row_count           BIGINT,
+    started_at          TIMESTAMP NOT NULL,
+    finished_at         TIMESTAMP
+)
+    diststyle all
+    sortkey(stage, started_at);
+""")
+
 # STAGING TABLES
 
+# (staging column, key in the source JSON) in COPY column order, used by the local loaders
+staging_events_columns = [('artist', 'artist'), ('auth', 'auth'), ('first_name', 'firstName'),
+                          ('gender', 'gender'), ('item_in_session', 'itemInSession'), ('last_name', 'lastName'),
+                          ('length', 'length'), ('level', 'level'), ('location', 'location'),
+                          ('method', 'method'), ('page', 'page'), ('registration', 'registration'),
+                          ('session_id', 'sessionId'), ('song', 'song'), ('status', 'status'), ('ts', 'ts'),
+                          ('user_agent', 'userAgent'), ('user_id', 'userId')]
+staging_songs_columns = [('song_id', 'song_id'), ('title', 'title'), ('duration', 'duration'), ('year', 'year'),
+                         ('artist_id', 'artist_id'), ('artist_name', 'artist_name'),
+                         ('artist_latitude', 'artist_latitude'), ('artist_longitude', 'artist_longitude'),
+                         ('artist_location', 'artist_location'), ('num_songs', 'num_songs'),
+                         ('song_known', 'song_known'), ('artist_known', 'artist_known')]  # flags set by key_index.py
+staging_columns = {'staging_events_table': staging_events_columns, 'staging_songs_table': staging_songs_columns}
+
+# column profile: staging column each fact and dimension column is loaded from, sized by profiler.py from the
+# source JSON of that staging column (staging columns are their own source)
+profiled_columns = {
+    'songplays': {'start_time': ('staging_events_table', 'ts'), 'user_id': ('staging_events_table', 'user_id'),
+                  'level': ('staging_events_table', 'level'), 'song_id': ('staging_songs_table', 'song_id'),
+                  'artist_id': ('staging_songs_table', 'artist_id'),
+                  'session_id': ('staging_events_table', 'session_id'),
+                  'location': ('staging_events_table', 'location'),
+                  'user_agent': ('staging_events_table', 'user_agent')},
+    'users': {'user_id': ('staging_events_table', 'user_id'), 'first_name': ('staging_events_table', 'first_name'),
+              'last_name': ('staging_events_table', 'last_name'), 'gender': ('staging_events_table', 'gender'),
+              'level': ('staging_events_table', 'level')},
+    'songs': {'song_id': ('staging_songs_table', 'song_id'), 'title': ('staging_songs_table', 'title'),
+              'artist_id': ('staging_songs_table', 'artist_id'), 'year': ('staging_songs_table', 'year'),
+              'duration': ('staging_songs_table', 'duration')},
+    'artists': {'artist_id': ('staging_songs_table', 'artist_id'), 'name': ('staging_songs_table', 'artist_name'),
+                'location': ('staging_songs_table', 'artist_location'),
+                'latitude': ('staging_songs_table', 'artist_latitude'),
+                'longitude': ('staging_songs_table', 'artist_longitude')},
+}
+# staging columns sized together: the song match key rounds length and duration, which must share a type
+profile_groups = [[('staging_events_table', 'length'), ('staging_songs_table', 'duration')]]
+
+# ingest filter: log rows each table loaded from staging_events_table needs, as staging column -> required value
+# (None for any non empty value), and the staging columns it reads, song match key inputs included
+ingest_filter_rules = {'songplays': {'page': 'NextSong'}, 'time': {'page': 'NextSong'}, 'users': {'user_id': None}}
+ingest_filter_columns = {'songplays': ['ts', 'user_id', 'level', 'session_id', 'location', 'user_agent', 'page',
+                                       'song', 'artist', 'length'],
+                         'time': ['ts', 'page'],
+                         'users': ['user_id', 'first_name', 'last_name', 'gender', 'level', 'ts']}
+
 staging_events_copy = (""" COPY staging_events_table (
     artist, auth, first_name, gender, item_in_session, last_name,
     length, level, location, method, page, registration,
     session_id, song, status, ts, user_agent, user_id
 )
-FROM {} iam_role {} json {} region 'us-west-2';
-""").format(config['S3']['log_data'], config['IAM_ROLE']['ARN'], config['S3']['log_jsonpath'])
+FROM {} iam_role {} json {}{} region 'us-west-2';
+""").format(LOG_DATA, IAM_ROLE_ARN, LOG_JSONPATH, COPY_COMPRESSION)
 
 staging_songs_copy = ("""
 copy staging_songs_table (
-    song_id, title, duration, year, artist_id, artist_name, artist_latitude, artist_longitude, artist_location, num_songs
+    song_id, title, duration, year, artist_id, artist_name, artist_latitude, artist_longitude, artist_location, num_songs,
+    song_known, artist_known
 )
-FROM {} iam_role {} json 'auto' region 'us-west-2';
-""").format(config['S3']['song_data'], config['IAM_ROLE']['ARN'])
+FROM {} iam_role {} json 'auto'{} region 'us-west-2';
+""").format(SONG_DATA, IAM_ROLE_ARN, COPY_COMPRESSION)
+
+# incremental load of the log dataset through a manifest of new files, formatted with the manifest url
+staging_events_manifest_copy = (""" COPY staging_events_table (
+    artist, auth, first_name, gender, item_in_session, last_name,
+    length, level, location, method, page, registration,
+    session_id, song, status, ts, user_agent, user_id
+)
+FROM '{{}}' iam_role {} json {}{} region 'us-west-2' manifest;
+""").format(IAM_ROLE_ARN, LOG_JSONPATH, COPY_COMPRESSION)
+
+# song dataset through a manifest, e.g. of the evenly sized parts written by file_splitter.py
+staging_songs_manifest_copy = ("""
+copy staging_songs_table (
+    song_id, title, duration, year, artist_id, artist_name, artist_latitude, artist_longitude, artist_location, num_songs,
+    song_known, artist_known
+)
+FROM '{{}}' iam_role {} json 'auto'{} region 'us-west-2' manifest;
+""").format(IAM_ROLE_ARN, COPY_COMPRESSION)
+
+staging_manifest_copies = {'staging_events_table': staging_events_manifest_copy,
+                           'staging_songs_table': staging_songs_manifest_copy}
+
+staging_events_truncate = "TRUNCATE staging_events_table"
+# the song dataset is staged whole on every load, so its staging table is emptied first instead of appended to
+staging_songs_truncate = "TRUNCATE staging_songs_table"
+
+# song match key: hash of normalized title, artist and duration rounded to 1/100 s, computed once per staged row
+song_key_expression = ("MD5(LOWER(TRIM({title})) || '|' || LOWER(TRIM({artist})) || '|' "
+                       "|| CAST(CAST({duration} AS DECIMAL(10,2)) AS VARCHAR))")
+song_key_sources = {
+    'staging_events_table': song_key_expression.format(title='song', artist='artist', duration='length'),
+    'staging_songs_table': song_key_expression.format(title='title', artist='artist_name', duration='duration')}
+
+# staging rows are loaded into an empty temporary table, then inserted with their song match key: they are written
+# once, distributed and sorted on the key, where an UPDATE after the COPY rewrote every row, left the table unsorted
+# and had first put every row on the slice of the NULL key
+staging_load_create = "CREATE TEMP TABLE {load} AS SELECT {columns} FROM {table} WHERE 1 = 0;"
+staging_keyed_insert = "INSERT INTO {table} ({columns}, song_key) SELECT {columns}, {song_key} FROM {load};"
+staging_load_drop = "DROP TABLE {load};"
+
+calendar_columns = ['calendar_hour', 'hour', 'day', 'week', 'month', 'year', 'weekday']
+calendar_bounds = "SELECT MIN(calendar_hour), MAX(calendar_hour) FROM calendar"
+
+# LOAD LEDGER
+
+load_ledger_watermark = "SELECT MAX(partition_key) FROM load_ledger"
+load_ledger_select = "SELECT file_key FROM load_ledger WHERE partition_key >= %s"
+load_ledger_insert = ("""INSERT INTO load_ledger (file_key, partition_key, file_size, loaded_at)
+    VALUES (%s, %s, %s, %s);
+""")
+
+# TABLE VERSIONS
+
+table_versions_select = "SELECT table_name, version FROM table_versions"
+# writers take the lock first, so two of them never insert the same missing table
+table_versions_lock = "LOCK TABLE table_versions;"
+table_versions_update = "UPDATE table_versions SET version = %s, updated_at = %s WHERE table_name IN %s;"
+table_versions_existing = "SELECT table_name FROM table_versions WHERE table_name IN %s;"
+table_versions_insert = "INSERT INTO table_versions (table_name, version, updated_at) VALUES (%s, %s, %s);"
+
+# RUN LEDGER
+
+run_ledger_insert = ("""INSERT INTO run_ledger (run_id, stage, fingerprint, status, started_at)
+    VALUES (%s, %s, %s, %s, %s);
+""")
+run_ledger_finish = "UPDATE run_ledger SET status = %s, finished_at = %s WHERE run_id = %s AND stage IN %s;"
+run_ledger_rows = "UPDATE run_ledger SET row_count = %s WHERE run_id = %s AND stage = %s;"
+# fingerprint each stage last completed with
+run_ledger_completed = ("""SELECT stage, fingerprint
+    FROM run_ledger
+    WHERE status = 'completed'
+    ORDER BY finished_at;
+""")
+run_ledger_invalidate = "DELETE FROM run_ledger WHERE stage IN %s;"
+
+# tables of the current schema, compared with create_table_queries_by_table by create_tables.py --missing-only
+existing_tables = "SELECT tablename FROM pg_tables WHERE schemaname = current_schema()"
+
+# KEY INDEX
+
+# tables holding the keys of the local key index, and the keys staged as new by the last load
+key_index_tables = {'song_id': 'songs', 'artist_id': 'artists'}
+key_index_select = "SELECT {column} FROM {table}"
+key_index_new_keys = ("""SELECT DISTINCT {column}
+    FROM staging_songs_table
+    WHERE {column} IS NOT NULL AND {flag} IS NOT TRUE
+""")
+# staging_songs_table flag set by the key index on rows whose key is already loaded
+key_index_flags = {'song_id': 'song_known', 'artist_id': 'artist_known'}
 
 # FINAL TABLES
 
-songplay_table_insert = (""" INSERT INTO songplays (
-        start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
-    SELECT
+# rows each fact and dimension table is loaded with, shared by the ON CONFLICT inserts and upsert.py
+
+songplay_table_select = ("""SELECT
         st.ts, st.user_id, st.level, s.song_id, s.artist_id, st.session_id, st.location, st.user_agent
     FROM staging_events_table st
     JOIN  staging_songs_table s
-    ON st.song = s.title AND st.artist = s.artist_name AND st.length = s.duration
-    ON CONFLICT (start_time, user_id, session_id) DO NOTHING;
-""")
+    ON st.song_key = s.song_key
+    WHERE st.page = 'NextSong'""")
 
-user_table_insert = (""" INSERT INTO users (
-        user_id, first_name, last_name, gender, level)
-    SELECT user_id, first_name, last_name, gender, level
+user_table_select = ("""SELECT user_id, first_name, last_name, gender, level
     FROM (
         SELECT user_id, first_name, last_name, gender, level,
         ROW_NUMBER() OVER (PARTITION BY user_id
-                            ORDER BY first_name, last_name, gender, level) AS rank_user_by_id
+                            ORDER BY ts DESC, first_name, last_name, gender, level) AS rank_user_by_id
         FROM staging_events_table
         WHERE user_id IS NOT NULL
     ) AS ranked
-    WHERE ranked.rank_user_by_id = 1
-    ON CONFLICT (user_id) DO UPDATE SET level=EXCLUDED.level;
-""")
+    WHERE ranked.rank_user_by_id = 1""")
 
-song_table_insert = (""" INSERT INTO songs (song_id, title, artist_id, year, duration)
-SELECT song_id, title, artist_id, year, duration
+song_table_select = ("""SELECT song_id, title, artist_id, year, duration
 FROM (
     SELECT song_id, title, artist_id, year, duration,
     ROW_NUMBER() OVER (PARTITION BY song_id
                         ORDER BY title, artist_id, year, duration) AS rank_song_by_id
     FROM staging_songs_table
-    WHERE song_id IS NOT NULL
+    WHERE song_id IS NOT NULL AND song_known IS NOT TRUE
 ) AS ranked
-WHERE ranked.rank_song_by_id = 1
-ON CONFLICT (song_id) DO NOTHING;
-""")
+WHERE ranked.rank_song_by_id = 1""")
 
-artist_table_insert = (""" INSERT INTO artists (artist_id, name, location, latitude, longitude)
-SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+artist_table_select = ("""SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
 FROM (
     SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude,
     ROW_NUMBER() OVER (PARTITION BY artist_id
                         ORDER BY artist_name, artist_location, artist_latitude, artist_longitude) AS rank_artist_by_id
     FROM staging_songs_table
-    WHERE artist_id IS NOT NULL
+    WHERE artist_id IS NOT NULL AND artist_known IS NOT TRUE
 ) AS ranked
-WHERE ranked.rank_artist_by_id = 1
-ON CONFLICT (artist_id) DO NOTHING;
-""")
+WHERE ranked.rank_artist_by_id = 1""")
 
-time_table_insert = ("""INSERT INTO time (start_time, hour, day, week, month, year, weekday)
-    SELECT TIMESTAMP 'epoch' + ts/1000 * interval '1 second' AS start_time,
+# new distinct event times: non NextSong events never reach songplays and times already in the dimension are skipped
+new_event_times = ("""
+        SELECT event_seconds.start_time
+        FROM (
+            SELECT TIMESTAMP 'epoch' + epoch_seconds * interval '1 second' AS start_time
+            FROM (
+                SELECT DISTINCT ts / 1000 AS epoch_seconds
+                FROM staging_events_table
+                WHERE ts IS NOT NULL AND page = 'NextSong'
+            ) AS distinct_seconds
+        ) AS event_seconds
+        LEFT JOIN time t ON t.start_time = event_seconds.start_time
+        WHERE t.start_time IS NULL""")
+
+time_table_select = ("""SELECT start_time,
             EXTRACT(HOUR FROM start_time) AS hour,
             EXTRACT(DAY FROM start_time) AS day,
             EXTRACT(WEEK FROM start_time) AS week,
             EXTRACT(MONTH FROM start_time) AS month,
             EXTRACT(YEAR FROM start_time) AS year,
             EXTRACT(DOW FROM start_time) AS weekday
-    FROM staging_events_table
-    WHERE ts IS NOT NULL
-    ON CONFLICT (start_time) DO NOTHING;
+    FROM ({}
+    ) AS event_times""").format(new_event_times)
+
+# same as time_table_select, looking the date parts up in the calendar table and computing them only for missing hours
+time_table_select_from_calendar = ("""SELECT event_times.start_time,
+            COALESCE(c.hour, EXTRACT(HOUR FROM event_times.start_time)) AS hour,
+            COALESCE(c.day, EXTRACT(DAY FROM event_times.start_time)) AS day,
+            COALESCE(c.week, EXTRACT(WEEK FROM event_times.start_time)) AS week,
+            COALESCE(c.month, EXTRACT(MONTH FROM event_times.start_time)) AS month,
+            COALESCE(c.year, EXTRACT(YEAR FROM event_times.start_time)) AS year,
+            COALESCE(c.weekday, EXTRACT(DOW FROM event_times.start_time)) AS weekday
+    FROM ({}
+    ) AS event_times
+    LEFT JOIN calendar c ON c.calendar_hour = DATE_TRUNC('hour', event_times.start_time)""").format(new_event_times)
+
+songplay_table_insert = (""" INSERT INTO songplays (
+        start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    {}
+    ON CONFLICT (start_time, user_id, session_id) DO NOTHING;
+""").format(songplay_table_select)
+
+user_table_insert = (""" INSERT INTO users (
+        user_id, first_name, last_name, gender, level)
+    {}
+    ON CONFLICT (user_id) DO UPDATE SET level=EXCLUDED.level;
+""").format(user_table_select)
+
+song_table_insert = (""" INSERT INTO songs (song_id, title, artist_id, year, duration)
+{}
+ON CONFLICT (song_id) DO NOTHING;
+""").format(song_table_select)
+
+artist_table_insert = (""" INSERT INTO artists (artist_id, name, location, latitude, longitude)
+{}
+ON CONFLICT (artist_id) DO NOTHING;
+""").format(artist_table_select)
+
+time_table_insert = ("""INSERT INTO time (start_time, hour, day, week, month, year, weekday)
+    {};
+""").format(time_table_select)
+
+time_table_insert_from_calendar = ("""INSERT INTO time (start_time, hour, day, week, month, year, weekday)
+    {};
+""").format(time_table_select_from_calendar)
+
+# UPSERT
+
+# set based replacement for ON CONFLICT: deduplicated rows go to a temp table, then are merged into the target
+upsert_stage_create = "CREATE TEMP TABLE {stage} AS SELECT {columns} FROM {table} WHERE 1 = 0;"
+upsert_stage_insert = ("""INSERT INTO {stage} ({columns})
+    SELECT {columns}
+    FROM (
+        SELECT source.*, ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY {order}) AS upsert_rank
+        FROM ({select}) AS source ({columns})
+    ) AS ranked
+    WHERE ranked.upsert_rank = 1;
 """)
+upsert_update_target = "UPDATE {table} SET {assignments} FROM {stage} WHERE {match};"
+upsert_delete_stage = "DELETE FROM {stage} USING {table} WHERE {match};"
+upsert_insert = "INSERT INTO {table} ({columns}) SELECT {columns} FROM {stage};"
+upsert_stage_drop = "DROP TABLE {stage};"
 
 staging_row_count = "SELECT COUNT(*) AS count FROM {}"
 
+# ANALYTICS
+
+# representative dashboard queries, used as workload by the key advisor
+songplays_per_hour = ("""SELECT t.year, t.month, t.day, t.hour, sp.level, COUNT(*) AS plays
+    FROM songplays sp
+    JOIN time t ON t.start_time = TIMESTAMP 'epoch' + sp.start_time / 1000 * interval '1 second'
+    GROUP BY t.year, t.month, t.day, t.hour, sp.level;
+""")
+
+top_artists = ("""SELECT a.name, COUNT(*) AS plays
+    FROM songplays sp
+    JOIN artists a ON sp.artist_id = a.artist_id
+    GROUP BY a.name
+    ORDER BY plays DESC
+    LIMIT 10;
+""")
+
+top_paid_songs = ("""SELECT s.title, COUNT(*) AS plays
+    FROM songplays sp
+    JOIN songs s ON sp.song_id = s.song_id
+    WHERE sp.level = 'paid'
+    GROUP BY s.title
+    ORDER BY plays DESC
+    LIMIT 10;
+""")
+
+level_usage = ("""SELECT level, COUNT(*) AS plays, COUNT(DISTINCT user_id) AS listeners
+    FROM songplays
+    GROUP BY level;
+""")
+
+analytics_queries = {'songplays_per_hour': songplays_per_hour, 'top_artists': top_artists,
+                     'top_paid_songs': top_paid_songs, 'level_usage': level_usage}
+
+# KEY ADVISOR
+
+# schema the DDL variants are rebuilt and benchmarked in, leaving the live tables and ledgers untouched
+scratch_schema_create = "CREATE SCHEMA IF NOT EXISTS {schema};"
+scratch_schema_drop = "DROP SCHEMA IF EXISTS {schema} CASCADE;"
+scratch_search_path = "SET search_path TO {schema};"
+
+# ROLLUPS
+
+# songplays expressions each rollup is keyed by, level kept as is, NULL included
+songplay_hour = "DATE_TRUNC('hour', TIMESTAMP 'epoch' + start_time / 1000 * interval '1 second')"
+songplay_day = "CAST(TIMESTAMP 'epoch' + start_time / 1000 * interval '1 second' AS DATE)"
+rollup_dimensions = {'songplays_hourly': {'hour_start': songplay_hour, 'level': 'level'},
+                     'songplays_artist_daily': {'artist_id': 'artist_id', 'day': songplay_day},
+                     'songplays_user_daily': {'user_id': 'user_id', 'day': songplay_day, 'level': 'level'}}
+# rollup columns that can be NULL, matched with rollup_nullable_match instead of rollup_match
+rollup_nullable = {'level'}
+rollup_match = "{rollup}.{column} = {delta}.{column}"
+rollup_nullable_match = "COALESCE({rollup}.{column}, '') = COALESCE({delta}.{column}, '')"
+
+# songplays are written by one loader at a time, so their songplay_ids commit in order and the songplays above
+# the high water are the ones inserted since the last refresh; the lock keeps concurrent refreshes from adding
+# the same songplays twice
+rollup_state_lock = "LOCK TABLE rollup_state;"
+rollup_state_select = "SELECT high_water FROM rollup_state;"
+rollup_state_delete = "DELETE FROM rollup_state;"
+rollup_state_insert = ("""INSERT INTO rollup_state (high_water, songplays_version, refreshed_at)
+    VALUES (%s, %s, %s);
+""")
+rollup_new_songplays = "SELECT COUNT(*), MAX(songplay_id) FROM songplays WHERE songplay_id > %s;"
+songplays_version_select = "SELECT version FROM table_versions WHERE table_name = 'songplays';"
+# two single row lookups, whatever the size of songplays
+rollup_freshness_select = ("""SELECT (SELECT version FROM table_versions WHERE table_name = 'songplays'),
+    (SELECT songplays_version FROM rollup_state);
+""")
+
+# additive merge of the new songplays: aggregate them, add them to existing rows, and insert the
+# remaining keys
+rollup_delta_create = ("""CREATE TEMP TABLE {delta} AS
+    SELECT {dimensions}, COUNT(*) AS plays
+    FROM songplays
+    WHERE songplay_id > {low} AND songplay_id <= {high}
+    GROUP BY {groups};
+""")
+rollup_update = "UPDATE {rollup} SET plays = {rollup}.plays + {delta}.plays FROM {delta} WHERE {match};"
+rollup_delete_delta = "DELETE FROM {delta} USING {rollup} WHERE {match};"
+rollup_insert = "INSERT INTO {rollup} ({columns}, plays) SELECT {columns}, plays FROM {delta};"
+rollup_delta_drop = "DROP TABLE {delta};"
+
+# dashboard queries answered from the rollups instead of songplays
+songplays_per_hour_rollup = ("""SELECT EXTRACT(YEAR FROM hour_start) AS year, EXTRACT(MONTH FROM hour_start) AS month,
+        EXTRACT(DAY FROM hour_start) AS day, EXTRACT(HOUR FROM hour_start) AS hour, level, SUM(plays) AS plays
+    FROM songplays_hourly
+    GROUP BY hour_start, level;
+""")
+
+top_artists_rollup = ("""SELECT a.name, SUM(r.plays) AS plays
+    FROM songplays_artist_daily r
+    JOIN artists a ON r.artist_id = a.artist_id
+    GROUP BY a.name
+    ORDER BY plays DESC
+    LIMIT 10;
+""")
+
+level_usage_rollup = ("""SELECT level, SUM(plays) AS plays, COUNT(DISTINCT user_id) AS listeners
+    FROM songplays_user_daily
+    GROUP BY level;
+""")
+
+rollup_routes = {songplays_per_hour: ('songplays_hourly', songplays_per_hour_rollup),
+                 top_artists: ('songplays_artist_daily', top_artists_rollup),
+                 level_usage: ('songplays_user_daily', level_usage_rollup)}
+
+# TABLE STATISTICS
+
+# one arm per table, joined with UNION ALL so every exact count comes back in one round trip
+table_row_count_arm = "SELECT '{0}' AS table_name, COUNT(*) AS row_count FROM {0}"
+
+# approximate statistics read from the catalog without scanning the tables:
+# table, rows, size in MB, unsorted %, skew ratio, stats off %
+redshift_table_info = ("""SELECT "table", estimated_visible_rows, size, unsorted, skew_rows, stats_off
+    FROM svv_table_info
+    WHERE "table" IN %s;
+""")
+
+postgres_table_info = ("""SELECT c.relname, CAST(c.reltuples AS BIGINT), pg_total_relation_size(c.oid) / (1024 * 1024),
+        NULL, NULL, NULL
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = current_schema() AND c.relkind = 'r' AND c.relname IN %s;
+""")
+
+# MAINTENANCE
+
+# churn of each table read by maintenance.py: table, size in MB, unsorted %, stats off %, deleted rows %
+redshift_maintenance_info = ("""SELECT "table", size, unsorted, stats_off,
+        CASE WHEN tbl_rows > 0 THEN 100.0 * (tbl_rows - estimated_visible_rows) / tbl_rows ELSE 0 END
+    FROM svv_table_info
+    WHERE "table" IN %s;
+""")
+
+postgres_maintenance_info = ("""SELECT s.relname, pg_total_relation_size(s.relid) / (1024 * 1024), NULL,
+        CASE WHEN s.n_live_tup > 0 THEN 100.0 * s.n_mod_since_analyze / s.n_live_tup ELSE 0 END,
+        CASE WHEN s.n_live_tup + s.n_dead_tup > 0 THEN 100.0 * s.n_dead_tup / (s.n_live_tup + s.n_dead_tup)
+             ELSE 0 END
+    FROM pg_stat_user_tables s
+    WHERE s.schemaname = current_schema() AND s.relname IN %s;
+""")
+
+# maintenance operations: re-sort, reclaim deleted rows, both, refresh the planner statistics
+redshift_maintenance_commands = {'sort': "VACUUM SORT ONLY {table}", 'delete': "VACUUM DELETE ONLY {table}",
+                                 'full': "VACUUM FULL {table}", 'analyze': "ANALYZE {table}"}
+# Postgres tables are not sorted, VACUUM reclaims the deleted rows
+postgres_maintenance_commands = {'delete': "VACUUM {table}", 'full': "VACUUM {table}", 'analyze': "ANALYZE {table}"}
+
+# COMPRESSION
+
+# encodings suggested by Redshift for a sample of the rows of a table: table, column, encoding, est. reduction %
+redshift_analyze_compression = "ANALYZE COMPRESSION {} COMPROWS {}"
+# reads every column of a table, so the scan time covers all encoded blocks
+column_scan = "SELECT {columns} FROM {table}"
+redshift_disable_result_cache = "SET enable_result_cache_for_session TO off"
+
+# DATA QUALITY
+
+# checks of each table as (check, column, argument), all the checks of a table are computed by a single scan:
+# not_null: column is never NULL, unique: no value appears twice, references: every value exists in the
+# argument table, range: values fall within the argument (low, high)
+quality_checks = {
+    'staging_events_table': [('range', 'ts', (QUALITY_TS_MIN, QUALITY_TS_MAX))],
+    'songplays': [('unique', 'songplay_id', None), ('not_null', 'start_time', None), ('not_null', 'user_id', None),
+                  ('references', 'song_id', 'songs'), ('references', 'artist_id', 'artists'),
+                  ('range', 'start_time', (QUALITY_TS_MIN, QUALITY_TS_MAX))],
+    'users': [('not_null', 'user_id', None), ('unique', 'user_id', None), ('not_null', 'level', None)],
+    'songs': [('not_null', 'song_id', None), ('unique', 'song_id', None), ('not_null', 'title', None)],
+    'artists': [('not_null', 'artist_id', None), ('unique', 'artist_id', None), ('not_null', 'name', None)],
+    'time': [('not_null', 'start_time', None), ('unique', 'start_time', None)],
+}
+
+# violation condition of each row, and the aggregates counting the violations over the scanned rows
+quality_conditions = {'not_null': "t.{column} IS NULL",
+                      'references': "t.{column} IS NOT NULL AND {alias}.{column} IS NULL",
+                      'range': "t.{column} < {low} OR t.{column} > {high}"}
+quality_violation_count = "SUM(CASE WHEN {condition} THEN 1 ELSE 0 END)"
+quality_duplicate_count = "COUNT(t.{column}) - COUNT(DISTINCT t.{column})"
+quality_reference_join = "LEFT JOIN (SELECT DISTINCT {column} FROM {reference}) {alias} ON t.{column} = {alias}.{column}"
+quality_scan = "SELECT COUNT(*), {aggregates} FROM {table} t {joins}"
+
+# rows violating a check, streamed through a server side cursor
+quality_sample = "SELECT t.* FROM {table} t {joins} WHERE {condition} LIMIT {limit}"
+quality_duplicate_sample = ("""SELECT t.{column}, COUNT(*) AS occurrences
+    FROM {table} t
+    GROUP BY t.{column}
+    HAVING COUNT(*) > 1
+    LIMIT {limit}
+""")
+
 # QUERY LISTS
 
 create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create,
-                        user_table_create, song_table_create, artist_table_create, time_table_create]
+                        user_table_create, song_table_create, artist_table_create, time_table_create,
+                        load_ledger_table_create, calendar_table_create, songplays_hourly_create,
+                        songplays_artist_daily_create, songplays_user_daily_create, rollup_state_create,
+                        table_versions_create, run_ledger_create]
 drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop,
-                    song_table_drop, artist_table_drop, time_table_drop]
+                    song_table_drop, artist_table_drop, time_table_drop, load_ledger_table_drop, calendar_table_drop,
+                    songplays_hourly_drop, songplays_artist_daily_drop, songplays_user_daily_drop, rollup_state_drop,
+                    table_versions_drop, run_ledger_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
 insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert,
                         time_table_insert]
@@ -221,6 +723,53 @@ count_staging_queries = [staging_row_count.format(table) for table in
 
 insert_table_order = ['users', 'songs', 'artists', 'time', 'songplays']
 
+create_table_queries_by_table = {'staging_events_table': staging_events_table_create,
+                                 'staging_songs_table': staging_songs_table_create,
+                                 'songplays': songplay_table_create, 'users': user_table_create,
+                                 'songs': song_table_create, 'artists': artist_table_create,
+                                 'time': time_table_create, 'load_ledger': load_ledger_table_create,
+                                 'calendar': calendar_table_create, 'songplays_hourly': songplays_hourly_create,
+                                 'songplays_artist_daily': songplays_artist_daily_create,
+                                 'songplays_user_daily': songplays_user_daily_create,
+                                 'rollup_state': rollup_state_create, 'table_versions': table_versions_create,
+                                 'run_ledger': run_ledger_create}
+
+table_row_counts = "\nUNION ALL\n".join(table_row_count_arm.format(table) for table in
+                                         copy_staging_order + insert_table_order) + ";"
+
+insert_table_queries_by_table = {'songplays': songplay_table_insert, 'users': user_table_insert,
+                                 'songs': song_table_insert, 'artists': artist_table_insert,
+                                 'time': time_table_insert}
+
+# tables each insert reads from, tables not scheduled in the same run are treated as already loaded
+insert_table_dependencies = {'users': ['staging_events_table'],
+                             'time': ['staging_events_table'],
+                             'songs': ['staging_songs_table'],
+                             'artists': ['staging_songs_table'],
+                             'songplays': ['staging_events_table', 'staging_songs_table']}
+
+insert_table_selects = {'songplays': songplay_table_select, 'users': user_table_select,
+                        'songs': song_table_select, 'artists': artist_table_select, 'time': time_table_select}
+
+insert_table_columns = {'songplays': ['start_time', 'user_id', 'level', 'song_id', 'artist_id', 'session_id',
+                                      'location', 'user_agent'],
+                        'users': ['user_id', 'first_name', 'last_name', 'gender', 'level'],
+                        'songs': ['song_id', 'title', 'artist_id', 'year', 'duration'],
+                        'artists': ['artist_id', 'name', 'location', 'latitude', 'longitude'],
+                        'time': ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']}
+
+# conflict keys of the upsert mode, and whether a conflicting row updates the existing one (update) or is
+# skipped (ignore)
+upsert_keys = {'songplays': ['start_time', 'user_id', 'session_id'], 'users': ['user_id'], 'songs': ['song_id'],
+               'artists': ['artist_id'], 'time': ['start_time']}
+upsert_actions = {'songplays': 'ignore', 'users': 'update', 'songs': 'ignore', 'artists': 'ignore', 'time': 'ignore'}
+# columns an update sets, like ON CONFLICT DO UPDATE SET; the other columns keep their first loaded value
+upsert_update_columns = {'users': ['level']}
+# row kept when the rows to load repeat a key, e.g. a play matched to the same song staged from several files:
+# the latest event first where the rows carry their event time outside of the key, then every other column, so
+# the same row wins on every run and backend (users are already ranked latest event first by user_table_select)
+upsert_order = {'songplays': ['start_time DESC']}
+
 # count_fact_dim_queries = [staging_row_count.format(table) for table in copy_staging_order] + [staging_row_count.format(table) for table in insert_table_order if table != 'songplays' and table != 'time' and table != 'artists' and table != 'songs' and table != 'users' ]
 
 count_fact_dim_queries = [staging_row_count.format(insert_table_order[0]),
@@ -0,0 +1,246 @@
+import argparse
+import configparser
+import logging.config
+import time
+
+import boto3
+from backends import get_backend
+from connection import connect
+from etl import insert_table_statements, insert_tables
+from incremental import list_source_files, log_late_files, partition_of, record_loaded_files, write_manifest
+import metrics
+from metrics import MetricsCursor, stage
+from query_cache import bump_versions
+from rollups import refresh_rollups
+from sql_queries import load_ledger_select, staging_events_truncate
+
+logger = logging.getLogger(__name__)
+
+# tables a micro-batch of log files is applied to, in order
+STREAM_TABLES = ['users', 'time', 'songplays']
+
+
+class MicroBatcher:
+    """
+    Groups newly arrived log files into micro-batches. A batch is ready once the pending files reach
+    max_files or max_bytes, or the oldest pending file has waited max_age seconds.
+    At most max_pending files are held, the others are left in the source until there is room.
+    """
+
+    def __init__(self, max_files=50, max_bytes=64 * 1024 * 1024, max_age=30, max_pending=1000, clock=time.monotonic):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_pending = max_pending
+        self.clock = clock
+        self.pending = []  # (url, size, arrival time) in arrival order
+        self.urls = set()
+
+    def offer(self, files):
+        """
+        Adds files not pending yet.
+
+        Return:
+            Number of files left out because max_pending files are already pending
+        """
+        files = [(url, size) for url, size in files if url not in self.urls]
+        room = max(self.max_pending - len(self.pending), 0)
+        now = self.clock()
+        for url, size in files[:room]:
+            self.pending.append((url, size, now))
+            self.urls.add(url)
+        return len(files) - min(room, len(files))
+
+    def age(self):
+        """
+        Seconds the oldest pending file has been waiting.
+        """
+        return self.clock() - self.pending[0][2] if self.pending else 0.0
+
+    def ready(self, scale=1):
+        """
+        Tells whether a batch should be taken, batch size thresholds being multiplied by scale.
+        """
+        if not self.pending:
+            return False
+        return (len(self.pending) >= self.max_files * scale
+                or sum(size for _, size, _ in self.pending) >= self.max_bytes * scale
+                or self.age() >= self.max_age)
+
+    def take(self, scale=1):
+        """
+        Removes the oldest pending files, up to the batch size thresholds multiplied by scale.
+
+        Return:
+            (list of (url, size), seconds the oldest file of the batch waited)
+        """
+        age = self.age()
+        batch, total = [], 0
+        for url, size, _ in self.pending:
+            if batch and (len(batch) >= self.max_files * scale or total + size > self.max_bytes * scale):
+                break
+            batch.append((url, size))
+            total += size
+        self.pending = self.pending[len(batch):]
+        self.urls.difference_update(url for url, _ in batch)
+        return batch, age
+
+
+def adjust_scale(scale, latency, target, max_scale=8):
+    """
+    Backpressure: doubles the batch size scale while batches miss the latency target, so the warehouse
+    applies fewer, larger batches, and halves it again once they land well within the target.
+    """
+    if latency > target:
+        return min(scale * 2, max_scale)
+    if latency < target / 2:
+        return max(scale // 2, 1)
+    return scale
+
+
+def apply_batch(cur, conn, backend, files, insert_queries, manifest_location, s3_client=None, rollups=False):
+    """
+    Loads a micro-batch of log files into the emptied events staging table and applies it to the
+    tables of insert_queries, recording the files in the load ledger.
+    Arguments:
+        cur: cursor object
+        conn: connection object
+        backend: backend loading the staging table
+        files: list of (file url, size in bytes)
+        insert_queries: dict of table name -> list of statements applying the staged rows
+        manifest_location: s3:// url or local path the batch manifest is written to
+        s3_client: boto3 S3 client, required for s3:// locations
+        rollups: add the new songplays to the rollups
+    """
+    cur.execute(staging_events_truncate)
+    conn.commit()
+    manifest = write_manifest(files, manifest_location, s3_client)
+    with stage('stream:load_staging'):
+        backend.load_staging_table(cur, 'staging_events_table', backend.manifest_source(manifest))
+    conn.commit()
+    insert_tables(cur, conn, insert_queries)
+    bump_versions(cur, conn, ['staging_events_table'] + list(insert_queries))
+    if rollups:
+        refresh_rollups(cur, conn)
+    with stage('stream:record'):
+        record_loaded_files(cur, conn, files)
+        bump_versions(cur, conn, ['load_ledger'])
+
+
+def stream(cur, conn, backend, config, s3_client=None, max_batches=None, sleep=time.sleep, clock=time.monotonic):
+    """
+    Watches the incoming log files and applies them to users, time and songplays in micro-batches,
+    until interrupted or max_batches batches have been applied.
+    A file is only picked up once its size did not change between two polls, so files still being
+    written are never loaded half way.
+
+    Return:
+        Number of batches applied
+    """
+    section = 'STREAMING'
+    source = config.get(section, 'SOURCE', fallback=backend.log_data())
+    manifest_location = backend.manifest_location(config.get(section, 'MANIFEST_LOCATION',
+                                                             fallback='manifests/stream.manifest'),
+                                                  f"{section}.MANIFEST_LOCATION")
+    poll_seconds = config.getfloat(section, 'POLL_SECONDS', fallback=5)
+    late_scan_seconds = config.getfloat(section, 'LATE_SCAN_SECONDS', fallback=300)
+    latency_target = config.getfloat(section, 'LATENCY_TARGET', fallback=60)
+    max_scale = config.getint(section, 'MAX_BATCH_SCALE', fallback=8)
+    batcher = MicroBatcher(config.getint(section, 'BATCH_MAX_FILES', fallback=50),
+                           config.getint(section, 'BATCH_MAX_BYTES', fallback=64 * 1024 * 1024),
+                           config.getfloat(section, 'BATCH_MAX_AGE', fallback=30),
+                           config.getint(section, 'MAX_PENDING_FILES', fallback=1000), clock)
+    insert_queries = insert_table_statements(config, backend, STREAM_TABLES)
+    rollups = config.getboolean('ETL', 'ROLLUPS', fallback=False)
+
+    cur.execute(load_ledger_select, ('',))
+    loaded = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    watermark = max((partition_of(url) for url in loaded), default='')
+    logger.info(f"Watching {source} for new log files, {len(loaded)} files already loaded")
+
+    sizes = {}
+    scale = 1
+    batches = 0
+    last_full_scan = None
+    while max_batches is None or batches < max_batches:
+        # polls list the partitions from the watermark on; every LATE_SCAN_SECONDS all of them are listed and
+        # checked against the ledger, so files arriving late in an older partition are picked up too
+        full_scan = last_full_scan is None or clock() - last_full_scan >= late_scan_seconds
+        if full_scan:
+            last_full_scan = clock()
+        listed = [(url, size) for url, size in list_source_files(source, '' if full_scan else watermark, s3_client)
+                  if url not in loaded]
+        settled = [(url, size) for url, size in listed if sizes.get(url) == size]
+        if full_scan:
+            log_late_files([(url, size) for url, size in settled if url not in batcher.urls], watermark)
+            sizes = dict(listed)
+        else:
+            # sizes of the older partitions are only refreshed by the full scans, a late file settles once two
+            # of them saw the same size
+            sizes = {url: size for url, size in sizes.items() if partition_of(url) < watermark}
+            sizes.update(listed)
+        deferred = batcher.offer(settled)
+        if deferred:
+            logger.warning(f"Backpressure: {len(batcher.pending)} files pending, {deferred} left in the source")
+
+        if not batcher.ready(scale):
+            sleep(poll_seconds)
+            continue
+
+        files, waited = batcher.take(scale)
+        start = clock()
+        apply_batch(cur, conn, backend, files, insert_queries, manifest_location, s3_client, rollups)
+        elapsed = clock() - start
+        loaded.update(url for url, _ in files)
+        watermark = max([watermark] + [partition_of(url) for url, _ in files])
+        batches += 1
+
+        latency = waited + elapsed
+        metrics.recorder.emit({'type': 'micro_batch', 'stage': 'stream', 'files': len(files),
+                               'bytes': sum(size for _, size in files), 'apply_seconds': round(elapsed, 3),
+                               'latency_seconds': round(latency, 3), 'latency_target_seconds': latency_target,
+                               'pending_files': len(batcher.pending), 'batch_scale': scale})
+        metrics.recorder.write_prometheus()
+        metrics.recorder.reset()
+        scale = adjust_scale(scale, latency, latency_target, max_scale)
+        logger.info(f"Applied {len(files)} files in {elapsed:.2f}s, latency {latency:.1f}s "
+                    f"(target {latency_target:.0f}s), {len(batcher.pending)} pending, batch scale {scale}")
+        # behind: keep draining the backlog without waiting for the next poll
+        if not batcher.ready(scale):
+            sleep(poll_seconds)
+    return batches
+
+
+def main():
+    """
+    Runs the pipeline in streaming mode, applying new log files to songplays, users and time in micro-batches.
+    """
+    logging.config.fileConfig("logging.conf")
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--max-batches', type=int, help='stop after this many batches')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    backend = get_backend(config)
+    metrics.configure(config, backend)
+
+    s3_client = None
+    if config.get('STREAMING', 'SOURCE', fallback=backend.log_data()).startswith('s3://'):
+        s3_client = boto3.client('s3', region_name='us-west-2', aws_access_key_id=config.get('AWS', 'KEY'),
+                                 aws_secret_access_key=config.get('AWS', 'SECRET'))
+
+    conn = connect(backend, config, MetricsCursor)
+    cur = conn.cursor()
+    try:
+        batches = stream(cur, conn, backend, config, s3_client, args.max_batches)
+        logger.info(f"Applied {batches} batches")
+    except KeyboardInterrupt:
+        logger.info("Stopped, pending files are picked up by the next run")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import logging
+
+from sql_queries import table_row_count_arm
+
+logger = logging.getLogger(__name__)
+
+
+def exact_counts(cur, tables):
+    """
+    Counts the rows of every table in a single UNION ALL round trip.
+    Arguments:
+        cur: cursor object
+        tables: table names
+
+    Return:
+        dict of table name -> row count, in the order of tables
+    """
+    query = "\nUNION ALL\n".join(table_row_count_arm.format(table) for table in tables)
+    cur.execute(query)
+    counts = dict(cur.fetchall())
+    return {table: counts.get(table) for table in tables}
+
+
+def catalog_stats(cur, backend, tables):
+    """
+    Reads approximate statistics of every table from the system catalog, without scanning the tables.
+    Arguments:
+        cur: cursor object
+        backend: backend providing table_info_query
+        tables: table names
+
+    Return:
+        dict of table name -> {'rows', 'size_mb', 'unsorted_pct', 'skew_ratio', 'stats_off_pct'},
+        tables missing from the catalog (e.g. empty Redshift tables) being left out
+    """
+    cur.execute(backend.table_info_query, (tuple(tables),))
+    stats = {}
+    for table, rows, size_mb, unsorted, skew, stats_off in cur.fetchall():
+        stats[table.strip()] = {'rows': rows if rows is None or rows >= 0 else None, 'size_mb': size_mb,
+                                'unsorted_pct': unsorted, 'skew_ratio': skew, 'stats_off_pct': stats_off}
+    return {table: stats[table] for table in tables if table in stats}
+
+
+def table_stats(cur, backend, tables, mode='exact'):
+    """
+    Returns the statistics of tables.
+    Arguments:
+        cur: cursor object
+        backend: backend the tables live on
+        tables: table names
+        mode: 'exact' for scanned row counts, 'fast' for catalog statistics
+
+    Return:
+        dict of table name -> dict of statistics, always including 'rows'
+    """
+    if mode == 'exact':
+        return {table: {'rows': rows} for table, rows in exact_counts(cur, tables).items()}
+    if mode == 'fast':
+        return catalog_stats(cur, backend, tables)
+    raise ValueError(f"Unknown table stats mode {mode}, expected 'exact' or 'fast'")
@@ -0,0 +1,78 @@
+import logging
+
+from sql_queries import (insert_table_columns, upsert_actions, upsert_keys, upsert_order, upsert_stage_create,
+                         upsert_stage_insert, upsert_update_columns, upsert_update_target, upsert_delete_stage,
+                         upsert_insert, upsert_stage_drop)
+
+logger = logging.getLogger(__name__)
+
+
+def table_keys(config, table):
+    """
+    Returns the conflict key of a table, overridable as a comma separated list in the UPSERT section of the config.
+    """
+    keys = config.get('UPSERT', table, fallback=None)
+    if keys is None:
+        return upsert_keys[table]
+    return [key.strip() for key in keys.split(',') if key.strip()]
+
+
+def upsert_queries(table, select, keys, action='ignore', columns=None, update_columns=None, order=None):
+    """
+    Builds the statements merging the rows of a SELECT into a table without ON CONFLICT, which Redshift lacks.
+    The rows are deduplicated on the key into a temp table (the SELECTs already rank one row per key, e.g. the
+    latest event of a user), keeping the first row by order, then by every other column, so the row kept does not
+    change between runs or backends. Conflicting target rows then either get the update columns of their new row
+    (update) or are kept as they are (ignore), and the rows of new keys are inserted in bulk.
+    Arguments:
+        table: target table
+        select: SELECT returning the rows to load, in column order
+        keys: conflict key columns
+        action: 'update' or 'ignore'
+        columns: target columns, defaults to insert_table_columns[table]
+        update_columns: columns set by an update, defaults to upsert_update_columns[table] or every non key column
+        order: ORDER BY items ranking the rows of a key, defaults to upsert_order[table]
+
+    Return:
+        List of statements, to be run in a single transaction
+    """
+    if action not in ('update', 'ignore'):
+        raise ValueError(f"Unknown upsert action {action} for {table}, expected 'update' or 'ignore'")
+    columns = columns or insert_table_columns[table]
+    unknown = [key for key in keys if key not in columns]
+    if unknown:
+        raise ValueError(f"Upsert keys {unknown} are not columns of {table}")
+
+    update_columns = update_columns or upsert_update_columns.get(table) or [column for column in columns
+                                                                            if column not in keys]
+
+    order = order or upsert_order.get(table, [])
+    ranked = {item.split()[0] for item in order}
+    order = order + [column for column in columns if column not in keys and column not in ranked]
+
+    stage = f"{table}_upsert"
+    names = {'table': table, 'stage': stage, 'columns': ', '.join(columns), 'keys': ', '.join(keys),
+             'order': ', '.join(order or keys), 'select': select,
+             'match': ' AND '.join(f"{table}.{key} = {stage}.{key}" for key in keys),
+             'assignments': ', '.join(f"{column} = {stage}.{column}" for column in update_columns)}
+    merge = (upsert_update_target, upsert_delete_stage) if action == 'update' else (upsert_delete_stage,)
+    return [query.format(**names) for query in
+            (upsert_stage_create, upsert_stage_insert) + merge + (upsert_insert, upsert_stage_drop)]
+
+
+def upsert_table_queries(config, selects):
+    """
+    Builds the upsert statements of every fact and dimension table.
+    Arguments:
+        config: parsed dwh.cfg, keys can be overridden in its UPSERT section
+        selects: dict of table name -> SELECT returning the rows to load
+
+    Return:
+        dict of table name -> list of statements
+    """
+    queries = {}
+    for table, select in selects.items():
+        keys = table_keys(config, table)
+        queries[table] = upsert_queries(table, select, keys, upsert_actions[table])
+        logger.debug(f"Upsert {table} on {keys} ({upsert_actions[table]})")
+    return queries